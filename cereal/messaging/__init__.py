@@ -7,16 +7,30 @@ import msgq
 
 import os
 import capnp
+import heapq
+import math
 import time
 
-from typing import Optional, List, Union, Dict
+from collections.abc import MutableMapping
+from struct import unpack_from
+from typing import Optional, List, Union, Dict, Tuple
 
 from cereal import log
 from cereal.services import SERVICE_LIST
+from cereal.messaging.stats import MessagingStats, stats_enabled
 from openpilot.common.util import MovingAverage
 
 NO_TRAVERSAL_LIMIT = 2**64-1
 
+# layout of the Event header fields, used to read them without decoding the whole message
+_EVENT_DATA_OFFSETS = {
+  'logMonoTime': log.Event.schema.fields['logMonoTime'].proto.slot.offset,  # in words
+  'valid': log.Event.schema.fields['valid'].proto.slot.offset,  # in bits
+  'which': log.Event.schema.node.struct.discriminantOffset,  # in 16 bit units
+}
+_EVENT_VALID_DEFAULT = log.Event.schema.fields['valid'].proto.slot.defaultValue.bool
+_EVENT_UNION_FIELDS = {log.Event.schema.fields[f].proto.discriminantValue: f for f in log.Event.schema.union_fields}
+
 
 def reset_context():
   msgq.context = Context()
@@ -92,6 +106,79 @@ def recv_one_retry(sock: SubSocket) -> capnp.lib.capnp._DynamicStructReader:
       return log_from_bytes(dat)
 
 
+def event_header(dat: bytes) -> Optional[Tuple[str, int, bool]]:
+  """
+  Reads (which, logMonoTime, valid) of a serialized Event straight from the capnp wire format,
+  without creating a reader. Returns None if the message layout isn't the plain single root one.
+  """
+  if len(dat) < 8:
+    return None
+
+  # the segment table is padded to a word
+  segment0 = (4 + 4 * (unpack_from('<I', dat)[0] + 1) + 7) & ~7
+  if segment0 + 8 > len(dat):
+    return None
+
+  ptr = unpack_from('<Q', dat, segment0)[0]
+  if ptr == 0 or ptr & 3 != 0:
+    return None  # null or far root pointer
+
+  offset = (ptr & 0xFFFFFFFF) >> 2
+  if offset >= 1 << 29:
+    offset -= 1 << 30
+  data_words = (ptr >> 32) & 0xFFFF
+  data = segment0 + 8 * (1 + offset)
+  if data < segment0 or data + 8 * data_words > len(dat):
+    return None
+
+  # fields past the end of the data section have their default value
+  which_offset = _EVENT_DATA_OFFSETS['which']
+  which = unpack_from('<H', dat, data + 2 * which_offset)[0] if which_offset < 4 * data_words else 0
+  log_mono_time_offset = _EVENT_DATA_OFFSETS['logMonoTime']
+  log_mono_time = unpack_from('<Q', dat, data + 8 * log_mono_time_offset)[0] if log_mono_time_offset < data_words else 0
+  valid_offset = _EVENT_DATA_OFFSETS['valid']
+  valid = _EVENT_VALID_DEFAULT
+  if valid_offset < 64 * data_words:
+    valid ^= bool((dat[data + valid_offset // 8] >> (valid_offset % 8)) & 1)
+
+  if which not in _EVENT_UNION_FIELDS:
+    return None
+  return _EVENT_UNION_FIELDS[which], log_mono_time, valid
+
+
+class LazyEventData(MutableMapping):
+  """Service -> event reader, the last received message of a service is only decoded on first access"""
+  def __init__(self):
+    self.decoded: Dict[str, capnp.lib.capnp._DynamicStructReader] = {}
+    self.raw: Dict[str, bytes] = {}
+
+  def set_raw(self, s: str, dat: bytes) -> None:
+    self.raw[s] = dat
+
+  def __getitem__(self, s: str) -> capnp.lib.capnp._DynamicStructReader:
+    dat = self.raw.pop(s, None)
+    if dat is not None:
+      self.decoded[s] = getattr(log_from_bytes(dat), s)
+    return self.decoded[s]
+
+  def __setitem__(self, s: str, data: capnp.lib.capnp._DynamicStructReader) -> None:
+    self.raw.pop(s, None)
+    self.decoded[s] = data
+
+  def __delitem__(self, s: str) -> None:
+    self.raw.pop(s, None)
+    del self.decoded[s]
+
+  def __contains__(self, s: object) -> bool:
+    return s in self.decoded
+
+  def __iter__(self):
+    return iter(self.decoded)
+
+  def __len__(self) -> int:
+    return len(self.decoded)
+
+
 class FrequencyTracker:
   def __init__(self, service_freq: float, update_freq: float, is_poll: bool):
     freq = max(min(service_freq, update_freq), 1.)
@@ -138,7 +225,8 @@ class FrequencyTracker:
 class SubMaster:
   def __init__(self, services: List[str], poll: Optional[str] = None,
                ignore_alive: Optional[List[str]] = None, ignore_avg_freq: Optional[List[str]] = None,
-               ignore_valid: Optional[List[str]] = None, addr: str = "127.0.0.1", frequency: Optional[float] = None):
+               ignore_valid: Optional[List[str]] = None, addr: Optional[str] = "127.0.0.1", frequency: Optional[float] = None,
+               lazy: bool = False, stats: Optional[bool] = None):
     self.frame = -1
     self.services = services
     self.seen = {s: False for s in services}
@@ -148,7 +236,9 @@ class SubMaster:
     self.alive = {s: False for s in services}
     self.freq_ok = {s: False for s in services}
     self.sock = {}
-    self.data = {}
+    # lazy keeps the received bytes and only decodes them on the first sm[s] access
+    self.lazy = lazy
+    self.data: Union[Dict[str, capnp.lib.capnp._DynamicStructReader], LazyEventData] = LazyEventData() if lazy else {}
     self.valid = {}
     self.logMonoTime = {}
 
@@ -167,9 +257,21 @@ class SubMaster:
     assert frequency is None or poll is None, "Do not specify 'frequency' - frequency of the polled service will be used."
     self.update_freq = frequency or max([SERVICE_LIST[s].frequency for s in polled_services])
 
+    # alive and freq_ok only change for services that received a message, or whose alive deadline passed
+    self.alive_timeout = {s: 10. / SERVICE_LIST[s].frequency for s in services if SERVICE_LIST[s].frequency > 1e-5}
+    self.alive_deadlines: List[Tuple[float, str, float]] = []  # heap of (deadline, service, recv_time)
+    self.updated_services: List[str] = []
+    self.last_update_time: Optional[float] = None
+
+    # opt-in latency/jitter/drop instrumentation, also enabled by MESSAGING_STATS=1
+    enable_stats = stats_enabled() if stats is None else stats
+    self.stats = MessagingStats(services, {s: SERVICE_LIST[s].frequency for s in services}, "SubMaster") if enable_stats else None
+
     for s in services:
-      p = self.poller if s not in self.non_polled_services else None
-      self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
+      # without an addr no sockets are opened, messages are only fed in with update_msgs or update_raw
+      if addr is not None:
+        p = self.poller if s not in self.non_polled_services else None
+        self.sock[s] = sub_sock(s, poller=p, addr=addr, conflate=True)
 
       try:
         data = new_message(s)
@@ -188,6 +290,12 @@ class SubMaster:
     return SERVICE_LIST[s].frequency > 0.99 and (s not in self.ignore_average_freq) and (s not in self.ignore_alive)
 
   def update(self, timeout: int = 100) -> None:
+    if self.lazy:
+      dats = [sock.receive(non_blocking=True) for sock in self.poller.poll(timeout)]
+      dats += [self.sock[s].receive(non_blocking=True) for s in self.non_polled_services]
+      self.update_raw(time.monotonic(), dats)
+      return
+
     msgs = []
     for sock in self.poller.poll(timeout):
       msgs.append(recv_one_or_none(sock))
@@ -198,31 +306,102 @@ class SubMaster:
     self.update_msgs(time.monotonic(), msgs)
 
   def update_msgs(self, cur_time: float, msgs: List[capnp.lib.capnp._DynamicStructReader]) -> None:
-    self.frame += 1
-    self.updated = dict.fromkeys(self.services, False)
+    self._start_update()
     for msg in msgs:
       if msg is None:
         continue
 
       s = msg.which()
-      self.seen[s] = True
-      self.updated[s] = True
-
-      self.freq_tracker[s].record_recv_time(cur_time)
-      self.recv_time[s] = cur_time
-      self.recv_frame[s] = self.frame
+      self._record_recv(s, cur_time)
       self.data[s] = getattr(msg, s)
       self.logMonoTime[s] = msg.logMonoTime
       self.valid[s] = msg.valid
 
-    for s in self.services:
-      if SERVICE_LIST[s].frequency > 1e-5 and not self.simulation:
-        # alive if delay is within 10x the expected frequency
-        self.alive[s] = (cur_time - self.recv_time[s]) < (10. / SERVICE_LIST[s].frequency)
-        self.freq_ok[s] = self.freq_tracker[s].valid
+    self._update_checks(cur_time)
+    if self.stats is not None:
+      self._record_stats(cur_time)
+
+  def update_raw(self, cur_time: float, dats: List[Optional[bytes]]) -> None:
+    """Same as update_msgs for serialized events, only the header is read until the event is accessed"""
+    self._start_update()
+    for dat in dats:
+      if dat is None:
+        continue
+
+      header = event_header(dat)
+      if header is None:
+        msg = log_from_bytes(dat)
+        s = msg.which()
+        self.data[s] = getattr(msg, s)
+        header = (s, msg.logMonoTime, msg.valid)
+      elif isinstance(self.data, LazyEventData):
+        self.data.set_raw(header[0], dat)
       else:
-        self.freq_ok[s] = True
-        self.alive[s] = self.seen[s] if self.simulation else True
+        self.data[header[0]] = getattr(log_from_bytes(dat), header[0])
+
+      s, self.logMonoTime[s], self.valid[s] = header
+      self._record_recv(s, cur_time)
+
+    self._update_checks(cur_time)
+    if self.stats is not None:
+      self._record_stats(cur_time)
+
+  def _start_update(self) -> None:
+    self.frame += 1
+    for s in self.updated_services:
+      self.updated[s] = False
+    self.updated_services = []
+
+  def _record_recv(self, s: str, cur_time: float) -> None:
+    if not self.updated[s]:
+      self.updated_services.append(s)
+    self.seen[s] = True
+    self.updated[s] = True
+
+    self.freq_tracker[s].record_recv_time(cur_time)
+    self.recv_time[s] = cur_time
+    self.recv_frame[s] = self.frame
+
+  def _record_stats(self, cur_time: float) -> None:
+    assert self.stats is not None
+    for s in self.updated_services:
+      # reading frameId decodes lazy messages
+      frame_id = self.data[s].frameId if s in self.stats.frame_id_services else None
+      self.stats.record_recv(s, cur_time, self.logMonoTime[s], frame_id)
+    self.stats.maybe_report()
+
+  def _update_service_checks(self, s: str, cur_time: float) -> None:
+    if s in self.alive_timeout and not self.simulation:
+      # alive if delay is within 10x the expected frequency
+      self.alive[s] = (cur_time - self.recv_time[s]) < self.alive_timeout[s]
+      self.freq_ok[s] = self.freq_tracker[s].valid
+      if self.alive[s]:
+        heapq.heappush(self.alive_deadlines, (self.recv_time[s] + self.alive_timeout[s], s, self.recv_time[s]))
+    else:
+      self.freq_ok[s] = True
+      self.alive[s] = self.seen[s] if self.simulation else True
+
+  def _update_checks(self, cur_time: float) -> None:
+    if self.last_update_time is None or cur_time < self.last_update_time:
+      # first update, or time went backwards
+      self.alive_deadlines = []
+      for s in self.services:
+        self._update_service_checks(s, cur_time)
+    else:
+      for s in self.updated_services:
+        self._update_service_checks(s, cur_time)
+
+      # services without new messages only change once their alive deadline passes
+      while self.alive_deadlines and self.alive_deadlines[0][0] <= cur_time:
+        _, s, recv_time = heapq.heappop(self.alive_deadlines)
+        if recv_time != self.recv_time[s]:
+          continue  # superseded by a newer message
+
+        self.alive[s] = (cur_time - recv_time) < self.alive_timeout[s]
+        if self.alive[s]:
+          heapq.heappush(self.alive_deadlines, (math.nextafter(cur_time, math.inf), s, recv_time))
+
+    self.last_update_time = cur_time
 
   def all_alive(self, service_list: Optional[List[str]] = None) -> bool:
     return all(self.alive[s] for s in (service_list or self.services) if s not in self.ignore_alive)
@@ -238,15 +417,33 @@ class SubMaster:
 
 
 class PubMaster:
-  def __init__(self, services: List[str]):
+  def __init__(self, services: List[str], stats: Optional[bool] = None):
     self.sock = {}
     for s in services:
       self.sock[s] = pub_sock(s)
 
+    enable_stats = stats_enabled() if stats is None else stats
+    self.stats = MessagingStats(services, {s: SERVICE_LIST[s].frequency for s in services}, "PubMaster") if enable_stats else None
+
   def send(self, s: str, dat: Union[bytes, capnp.lib.capnp._DynamicStructBuilder]) -> None:
+    if self.stats is not None:
+      self._send_with_stats(s, dat)
+      return
+
+    if not isinstance(dat, bytes):
+      dat = dat.to_bytes()
+    self.sock[s].send(dat)
+
+  def _send_with_stats(self, s: str, dat: Union[bytes, capnp.lib.capnp._DynamicStructBuilder]) -> None:
+    assert self.stats is not None
+    serialize_time = None
     if not isinstance(dat, bytes):
+      start_time = time.perf_counter()
       dat = dat.to_bytes()
+      serialize_time = time.perf_counter() - start_time
     self.sock[s].send(dat)
+    self.stats.record_send(s, serialize_time)
+    self.stats.maybe_report()
 
   def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
     for _ in range(int(timeout*(1./dt))):
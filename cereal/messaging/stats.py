@@ -0,0 +1,162 @@
+import math
+import os
+import time
+from typing import Callable, Dict, List, Optional
+
+from cereal import log
+
+# HDR style log-linear buckets: SUB_BUCKETS per power of two, from MIN_VALUE up to MIN_VALUE * 2**OCTAVES
+MIN_VALUE = 1e-6  # 1 us
+OCTAVES = 24  # ~16 s
+SUB_BUCKETS = 8
+REPORT_INTERVAL = float(os.getenv("MESSAGING_STATS_INTERVAL", "10."))
+
+
+def stats_enabled() -> bool:
+  return bool(int(os.getenv("MESSAGING_STATS", "0")))
+
+
+class Histogram:
+  """Fixed bucket histogram of values in seconds, with ~9% relative precision and O(1) record"""
+  __slots__ = ('counts', 'count', 'total', 'min', 'max')
+
+  def __init__(self):
+    self.counts = [0] * (OCTAVES * SUB_BUCKETS + 2)
+    self.count = 0
+    self.total = 0.
+    self.min = math.inf
+    self.max = -math.inf
+
+  @staticmethod
+  def bucket(value: float) -> int:
+    if value < MIN_VALUE:
+      return 0
+    mantissa, exponent = math.frexp(value / MIN_VALUE)  # value / MIN_VALUE = mantissa * 2**exponent, 0.5 <= mantissa < 1
+    if exponent > OCTAVES:
+      return OCTAVES * SUB_BUCKETS + 1
+    return (exponent - 1) * SUB_BUCKETS + int((mantissa * 2 - 1) * SUB_BUCKETS) + 1
+
+  @staticmethod
+  def bucket_upper_bound(idx: int) -> float:
+    if idx == 0:
+      return MIN_VALUE
+    if idx > OCTAVES * SUB_BUCKETS:
+      return math.inf
+    exponent, sub = divmod(idx - 1, SUB_BUCKETS)
+    return MIN_VALUE * 2**exponent * (1 + (sub + 1) / SUB_BUCKETS)
+
+  def record(self, value: float) -> None:
+    self.counts[self.bucket(value)] += 1
+    self.count += 1
+    self.total += value
+    self.min = min(self.min, value)
+    self.max = max(self.max, value)
+
+  def percentile(self, p: float) -> float:
+    if self.count == 0:
+      return math.nan
+    target = p / 100. * self.count
+    seen = 0
+    for idx, n in enumerate(self.counts):
+      seen += n
+      if seen >= target and n > 0:
+        return min(self.bucket_upper_bound(idx), self.max)
+    return self.max
+
+  def summary(self) -> Dict[str, float]:
+    # in ms, for readability in logs
+    if self.count == 0:
+      return {'count': 0}
+    return {
+      'count': self.count,
+      'mean': 1e3 * self.total / self.count,
+      'min': 1e3 * self.min,
+      'p50': 1e3 * self.percentile(50),
+      'p90': 1e3 * self.percentile(90),
+      'p99': 1e3 * self.percentile(99),
+      'max': 1e3 * self.max,
+    }
+
+
+def has_frame_id(service: str) -> bool:
+  try:
+    return 'frameId' in log.Event.schema.fields[service].schema.fields
+  except Exception:
+    return False  # not a struct
+
+
+class ServiceStats:
+  __slots__ = ('expected_dt', 'latency', 'jitter', 'serialize', 'received', 'sent', 'drops', 'last_recv_time', 'last_frame_id')
+
+  def __init__(self, frequency: float):
+    self.expected_dt = 1. / frequency if frequency > 1e-5 else None
+    self.latency = Histogram()  # logMonoTime to receive
+    self.jitter = Histogram()  # deviation of the inter-arrival time from the service period
+    self.serialize = Histogram()  # to_bytes time on send
+    self.received = 0
+    self.sent = 0
+    self.drops = 0
+    self.last_recv_time: Optional[float] = None
+    self.last_frame_id: Optional[int] = None
+
+  def summary(self) -> Dict:
+    ret: Dict = {'received': self.received, 'sent': self.sent, 'drops': self.drops}
+    for name in ('latency', 'jitter', 'serialize'):
+      if getattr(self, name).count:
+        ret[name] = getattr(self, name).summary()
+    return ret
+
+
+class MessagingStats:
+  """
+  Per service messaging instrumentation for SubMaster and PubMaster: receive latency, inter-arrival
+  jitter, dropped frames from frameId gaps and send serialization time. Logged every report_interval
+  seconds, or call snapshot() directly.
+  """
+  def __init__(self, services: List[str], frequencies: Dict[str, float], name: str = "",
+               report_interval: float = REPORT_INTERVAL, report: Optional[Callable[[Dict], None]] = None):
+    self.name = name
+    self.services = {s: ServiceStats(frequencies[s]) for s in services}
+    self.frame_id_services = {s for s in services if has_frame_id(s)}
+    self.report_interval = report_interval
+    self.report = report if report is not None else self._log
+    self.last_report = time.monotonic()
+
+  def record_recv(self, s: str, cur_time: float, log_mono_time: int, frame_id: Optional[int] = None) -> None:
+    st = self.services[s]
+    st.received += 1
+    # logMonoTime and cur_time share a clock on device, where the boot and monotonic clocks don't drift apart
+    if log_mono_time > 0:
+      st.latency.record(max(cur_time - log_mono_time * 1e-9, 0.))
+
+    if st.last_recv_time is not None and st.expected_dt is not None:
+      st.jitter.record(abs(cur_time - st.last_recv_time - st.expected_dt))
+    st.last_recv_time = cur_time
+
+    if frame_id is not None:
+      if st.last_frame_id is not None and frame_id > st.last_frame_id + 1:
+        st.drops += frame_id - st.last_frame_id - 1
+      st.last_frame_id = frame_id
+
+  def record_send(self, s: str, serialize_time: Optional[float]) -> None:
+    st = self.services[s]
+    st.sent += 1
+    if serialize_time is not None:
+      st.serialize.record(serialize_time)
+
+  def snapshot(self) -> Dict[str, Dict]:
+    return {s: st.summary() for s, st in self.services.items() if st.received or st.sent}
+
+  def reset(self) -> None:
+    for s, st in self.services.items():
+      self.services[s] = ServiceStats(1. / st.expected_dt if st.expected_dt is not None else 0.)
+
+  def maybe_report(self) -> None:
+    now = time.monotonic()
+    if self.report_interval > 0 and now - self.last_report >= self.report_interval:
+      self.last_report = now
+      self.report(self.snapshot())
+
+  def _log(self, snapshot: Dict) -> None:
+    from openpilot.common.swaglog import cloudlog
+    cloudlog.event("messaging_stats", name=self.name, services=snapshot)
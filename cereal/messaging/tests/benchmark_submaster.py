@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import time
+
+import cereal.messaging as messaging
+from cereal.services import SERVICE_LIST
+
+# what a typical 100 Hz daemon subscribes to
+SERVICES = ['carState', 'carControl', 'carOutput', 'controlsState', 'selfdriveState', 'longitudinalPlan',
+            'liveCalibration', 'livePose', 'liveParameters', 'liveTorqueParameters', 'radarState', 'modelV2',
+            'deviceState', 'pandaStates', 'peripheralState', 'managerState', 'driverMonitoringState', 'gpsLocationExternal']
+UPDATE_FREQ = 100
+N_FRAMES = 6000
+N_RUNS = 5
+
+
+def make_frames(services, n_frames):
+  # serialized messages received in each frame, at each service's frequency
+  frames = []
+  for frame in range(n_frames):
+    dats = []
+    for s in services:
+      freq = SERVICE_LIST[s].frequency
+      if freq > 0 and frame % max(1, round(UPDATE_FREQ / freq)) == 0:
+        try:
+          msg = messaging.new_message(s)
+        except Exception:
+          msg = messaging.new_message(s, 1)
+        msg.valid = True
+        dats.append(msg.to_bytes())
+    frames.append(dats)
+  return frames
+
+
+def run(services, frames, lazy, accessed):
+  sm = messaging.SubMaster(services, poll='carState', lazy=lazy)
+  start_t = time.process_time_ns()
+  for i, dats in enumerate(frames):
+    cur_time = i / UPDATE_FREQ
+    if lazy:
+      sm.update_raw(cur_time, dats)
+    else:
+      # what update() does for every polled socket
+      sm.update_msgs(cur_time, [messaging.log_from_bytes(dat) for dat in dats])
+
+    for s in accessed:
+      sm[s]
+    sm.all_checks()
+  return (time.process_time_ns() - start_t) * 1e-3 / len(frames)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Per update cost of SubMaster, with and without lazy decoding")
+  parser.add_argument("--accessed", type=int, default=4, help="number of services read with sm[s] each frame")
+  args = parser.parse_args()
+
+  services = [s for s in SERVICES if s in SERVICE_LIST]
+  frames = make_frames(services, N_FRAMES)
+  accessed = services[:args.accessed]
+  print(f'{len(services)} services, {np.mean([len(f) for f in frames]):.1f} msgs per update, {len(accessed)} read per update')
+
+  for lazy in (False, True):
+    ets = [run(services, frames, lazy, accessed) for _ in range(N_RUNS)]
+    print(f'lazy={lazy}: {np.mean(ets):.2f} mean us, {max(ets):.2f} max us, {min(ets):.2f} min us, {np.std(ets):.2f} std us per update')
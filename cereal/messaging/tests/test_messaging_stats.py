@@ -0,0 +1,71 @@
+import math
+import random
+
+import cereal.messaging as messaging
+from cereal.messaging.stats import Histogram, MessagingStats, stats_enabled
+
+
+class TestHistogram:
+  def test_percentiles(self):
+    h = Histogram()
+    values = sorted(random.expovariate(100.) for _ in range(10000))
+    for v in values:
+      h.record(v)
+
+    assert h.count == len(values)
+    assert math.isclose(h.total, sum(values))
+    for p in (50, 90, 99):
+      exact = values[int(p / 100 * len(values)) - 1]
+      assert exact <= h.percentile(p) <= exact * (1 + 1 / 8)
+
+  def test_buckets(self):
+    for v in (0., 1e-7, 1e-6, 1.5e-6, 1e-3, 0.0123, 1., 10., 1e3):
+      idx = Histogram.bucket(v)
+      assert v <= Histogram.bucket_upper_bound(idx)
+      if idx > 1:
+        assert v >= Histogram.bucket_upper_bound(idx - 1)
+
+  def test_empty(self):
+    h = Histogram()
+    assert math.isnan(h.percentile(50))
+    assert h.summary() == {'count': 0}
+
+
+class TestMessagingStats:
+  def test_drops_and_jitter(self):
+    stats = MessagingStats(["roadCameraState"], {"roadCameraState": 20.})
+    assert stats.frame_id_services == {"roadCameraState"}
+
+    t = 100.
+    for frame_id in (0, 1, 2, 5, 6, 10):
+      t += 0.05
+      stats.record_recv("roadCameraState", t, int((t - 0.002) * 1e9), frame_id)
+
+    snapshot = stats.snapshot()["roadCameraState"]
+    assert snapshot["received"] == 6
+    assert snapshot["drops"] == 2 + 3
+    assert snapshot["jitter"]["max"] < 1e-3
+    assert 1.9 < snapshot["latency"]["p50"] <= 2.1 * (1 + 1 / 8)
+
+  def test_report_interval(self):
+    reports = []
+    stats = MessagingStats(["carState"], {"carState": 100.}, report_interval=1e-9, report=reports.append)
+    stats.record_send("carState", 1e-4)
+    stats.maybe_report()
+    assert reports[-1]["carState"]["sent"] == 1
+
+  def test_submaster(self):
+    sm = messaging.SubMaster(["carState"], stats=True)
+    assert messaging.SubMaster(["carState"], stats=False).stats is None
+
+    for i in range(10):
+      msg = messaging.new_message("carState")
+      sm.update_msgs(i * 0.01, [msg.as_reader()])
+    assert sm.stats.snapshot()["carState"]["received"] == 10
+
+  def test_env(self, monkeypatch):
+    for value, enabled in (("1", True), ("0", False)):
+      monkeypatch.setenv("MESSAGING_STATS", value)
+      assert stats_enabled() == enabled
+    monkeypatch.delenv("MESSAGING_STATS")
+    assert not stats_enabled()
@@ -1,8 +1,10 @@
+import os
 import random
 import time
 from typing import Sized, cast
 
 import cereal.messaging as messaging
+from cereal.services import SERVICE_LIST
 from cereal.messaging.tests.test_messaging import events, random_sock, random_socks, \
                                                   random_bytes, random_carstate, assert_carstate, \
                                                   zmq_sleep
@@ -93,6 +95,93 @@ class TestSubMaster:
         else:
           assert not sm._check_avg_freq(service)
 
+  def test_lazy_update(self):
+    socks = ["carState", "modelV2", "deviceState", "liveCalibration"]
+    sm = messaging.SubMaster(socks)
+    sm_lazy = messaging.SubMaster(socks, lazy=True)
+
+    t = 100.
+    for i in range(500):
+      t += random.choice([0.01, 0.05, 0.5, 2.])
+      msgs = []
+      for s in socks:
+        if random.random() < 0.5:
+          msg = messaging.new_message(s)
+          msg.valid = random.random() < 0.5
+          if s == "carState":
+            msg.carState.vEgo = i
+          msgs.append(msg)
+
+      sm.update_msgs(t, [m.as_reader() for m in msgs])
+      sm_lazy.update_raw(t, [m.to_bytes() for m in msgs])
+      for p in ["frame", "updated", "seen", "recv_time", "recv_frame", "alive", "freq_ok", "logMonoTime", "valid"]:
+        assert getattr(sm, p) == getattr(sm_lazy, p), p
+      assert sm["carState"].vEgo == sm_lazy["carState"].vEgo
+      assert sm.all_checks() == sm_lazy.all_checks()
+
+  def test_checks_match_full_recompute(self):
+    socks = ["carState", "modelV2", "deviceState", "liveCalibration", "carParams"]
+
+    def script():
+      # every service at its own rate
+      for i in range(300):
+        yield 0.01, [s for s in socks if i % max(1, round(100. / SERVICE_LIST[s].frequency)) == 0]
+      # gaps of exactly each service's alive timeout after its last message
+      for s in socks:
+        yield 0.001, [s]
+        yield 10. / SERVICE_LIST[s].frequency, []
+        yield 0.001, []
+      # short gaps, bursts and timeouts
+      for _ in range(500):
+        yield random.choice([0.0001, 0.001, 0.01, 0.05, 0.1, 0.5, 2.5, 5.]), random.sample(socks, random.randint(0, 3))
+      # everything times out, then recovers
+      yield 600., []
+      for _ in range(50):
+        yield 0.05, ["modelV2", "carState"]
+      # time going backwards
+      yield -1., ["carState"]
+      for _ in range(50):
+        yield 0.05, socks[:2]
+
+    for simulation in (False, True):
+      os.environ["SIMULATION"] = "1" if simulation else "0"
+      sm = messaging.SubMaster(socks, poll="modelV2", addr=None)
+
+      # the checks as they were recomputed for every service on every update
+      trackers = {s: messaging.FrequencyTracker(SERVICE_LIST[s].frequency, sm.update_freq, s == "modelV2") for s in socks}
+      recv_time, seen, valid = dict.fromkeys(socks, 0.), dict.fromkeys(socks, False), dict.fromkeys(socks, False)
+
+      t = 100.
+      for dt, services in script():
+        t += dt
+        msgs = []
+        for s in services:
+          msg = messaging.new_message(s)
+          msg.valid = random.random() < 0.8
+          msgs.append(msg.as_reader())
+          trackers[s].record_recv_time(t)
+          recv_time[s], seen[s], valid[s] = t, True, msg.valid
+        sm.update_msgs(t, msgs)
+
+        for s in socks:
+          if SERVICE_LIST[s].frequency > 1e-5 and not simulation:
+            alive = (t - recv_time[s]) < (10. / SERVICE_LIST[s].frequency)
+            freq_ok = trackers[s].valid
+          else:
+            freq_ok = True
+            alive = seen[s] if simulation else True
+          assert (sm.alive[s], sm.freq_ok[s], sm.valid[s]) == (alive, freq_ok, valid[s]), (s, t)
+
+  def test_event_header(self):
+    for s in random_socks():
+      try:
+        msg = messaging.new_message(s)
+      except Exception:
+        msg = messaging.new_message(s, random.randrange(50))
+      msg.valid = random.random() < 0.5
+      assert messaging.event_header(msg.to_bytes()) == (s, msg.logMonoTime, msg.valid)
+    assert messaging.event_header(b"") is None
+
   def test_alive(self):
     pass
 
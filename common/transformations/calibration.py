@@ -0,0 +1,70 @@
+import numpy as np
+from functools import lru_cache
+
+from openpilot.common.transformations.model import get_warp_matrix
+from openpilot.common.transformations.orientation import rot_from_euler, euler_from_rot
+
+# matrices are keyed on the exact calibration angles and intrinsics, including their dtype, and derived from the
+# same values the uncached functions would see, so results are bit identical to rot_from_euler and get_warp_matrix
+CACHE_SIZE = 32
+
+
+def _key(a) -> tuple:
+  a = np.asarray(a)
+  return a.dtype.str, tuple(a.ravel().tolist())
+
+
+def _array(key: tuple) -> np.ndarray:
+  dtype, values = key
+  return np.array(values, dtype=dtype)
+
+
+def _read_only(m: np.ndarray) -> np.ndarray:
+  # cached matrices are shared by all callers
+  m.setflags(write=False)
+  return m
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _device_from_calib(key: tuple) -> np.ndarray:
+  return _read_only(rot_from_euler(_array(key)))
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def _warp_matrix(key: tuple, intrinsics: tuple, bigmodel_frame: bool, dtype: np.dtype) -> np.ndarray:
+  warp = get_warp_matrix(_array(key), _array(intrinsics).reshape(3, 3), bigmodel_frame)
+  return _read_only(warp.astype(dtype))
+
+
+def device_from_calib(calib_euler) -> np.ndarray:
+  return _device_from_calib(_key(calib_euler))
+
+
+def calib_from_device(calib_euler) -> np.ndarray:
+  return _device_from_calib(_key(calib_euler)).T
+
+
+def warp_matrix(calib_euler, intrinsics: np.ndarray, bigmodel_frame: bool = False, dtype=np.float64) -> np.ndarray:
+  """Memoized get_warp_matrix, only derived again when the calibration or the camera changes"""
+  return _warp_matrix(_key(calib_euler), _key(intrinsics), bigmodel_frame, np.dtype(dtype))
+
+
+def ned_from_calib(ned_from_device_euler, calib_euler) -> np.ndarray:
+  # euler angles of the calibrated frame in NED, for one (3,) or N (N, 3) device orientations
+  return euler_from_rot(rot_from_euler(ned_from_device_euler) @ device_from_calib(calib_euler))
+
+
+def rotate_points(rot: np.ndarray, pts) -> np.ndarray:
+  # accepts single pt or array of pts
+  return np.asarray(pts) @ rot.T
+
+
+def rotate_covs(rot: np.ndarray, covs) -> np.ndarray:
+  # accepts single (3, 3) or array of (N, 3, 3) covariances
+  return rot @ np.asarray(covs) @ rot.T
+
+
+def rotate_stds(rot: np.ndarray, stds) -> np.ndarray:
+  # stds of independent axes after rotation, the diagonal of rotate_covs(rot, diag(stds**2))
+  # without building the covariances, accepts single std or array of stds
+  return np.sqrt(np.square(stds) @ np.square(rot).T)
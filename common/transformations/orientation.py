@@ -8,7 +8,15 @@ from openpilot.common.transformations.transformations import (ecef_euler_from_ne
                                                     quat2euler_single,
                                                     quat2rot_single,
                                                     rot2euler_single,
-                                                    rot2quat_single)
+                                                    rot2quat_single,
+                                                    ecef_euler_from_ned_batch,
+                                                    euler2quat_batch,
+                                                    euler2rot_batch,
+                                                    ned_euler_from_ecef_batch,
+                                                    quat2euler_batch,
+                                                    quat2rot_batch,
+                                                    rot2euler_batch,
+                                                    rot2quat_batch)
 
 
 def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]:
@@ -33,14 +41,31 @@ def numpy_wrap(function, input_shape, output_shape) -> Callable[..., np.ndarray]
   return f
 
 
-euler2quat = numpy_wrap(euler2quat_single, (3,), (4,))
-quat2euler = numpy_wrap(quat2euler_single, (4,), (3,))
-quat2rot = numpy_wrap(quat2rot_single, (4,), (3, 3))
-rot2quat = numpy_wrap(rot2quat_single, (3, 3), (4,))
-euler2rot = numpy_wrap(euler2rot_single, (3,), (3, 3))
-rot2euler = numpy_wrap(rot2euler_single, (3, 3), (3,))
-ecef_euler_from_ned = numpy_wrap(ecef_euler_from_ned_single, (3,), (3,))
-ned_euler_from_ecef = numpy_wrap(ned_euler_from_ecef_single, (3,), (3,))
+def batch_wrap(function, batch_function, input_shape, output_shape) -> Callable[..., np.ndarray]:
+  """
+  Like numpy_wrap, but any number of inputs (..., *input_shape) are converted at once by batch_function,
+  which loops in compiled code over a contiguous (N, *input_shape) array
+  """
+  def f(*inps):
+    *args, inp = inps
+    inp = np.asarray(inp)
+    if inp.ndim == len(input_shape):
+      return np.asarray(function(*args, inp)).reshape(output_shape)
+
+    batch_shape = inp.shape[:inp.ndim - len(input_shape)]
+    inp = np.ascontiguousarray(inp, dtype=np.float64).reshape((-1,) + input_shape)
+    return batch_function(*args, inp).reshape(batch_shape + output_shape)
+  return f
+
+
+euler2quat = batch_wrap(euler2quat_single, euler2quat_batch, (3,), (4,))
+quat2euler = batch_wrap(quat2euler_single, quat2euler_batch, (4,), (3,))
+quat2rot = batch_wrap(quat2rot_single, quat2rot_batch, (4,), (3, 3))
+rot2quat = batch_wrap(rot2quat_single, rot2quat_batch, (3, 3), (4,))
+euler2rot = batch_wrap(euler2rot_single, euler2rot_batch, (3,), (3, 3))
+rot2euler = batch_wrap(rot2euler_single, rot2euler_batch, (3, 3), (3,))
+ecef_euler_from_ned = batch_wrap(ecef_euler_from_ned_single, ecef_euler_from_ned_batch, (3,), (3,))
+ned_euler_from_ecef = batch_wrap(ned_euler_from_ecef_single, ned_euler_from_ecef_batch, (3,), (3,))
 
 quats_from_rotations = rot2quat
 quat_from_rot = rot2quat
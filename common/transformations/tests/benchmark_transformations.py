@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import time
+
+import openpilot.common.transformations.coordinates as coord
+import openpilot.common.transformations.orientation as orient
+import openpilot.common.transformations.transformations as transformations
+from openpilot.common.transformations.orientation import numpy_wrap
+
+N_RUNS = 3
+
+
+def make_inputs(n, seed=0):
+  rng = np.random.default_rng(seed)
+  eulers = rng.uniform(-np.pi, np.pi, (n, 3))
+  geodetics = np.column_stack([rng.uniform(-80, 80, n), rng.uniform(-180, 180, n), rng.uniform(-100, 3000, n)])
+  ecefs = coord.geodetic2ecef(geodetics)
+  return {
+    'eulers': eulers,
+    'quats': orient.euler2quat(eulers),
+    'rots': orient.euler2rot(eulers),
+    'geodetics': geodetics,
+    'ecefs': ecefs,
+  }
+
+
+def get_cases(ecef_init):
+  # (name, batched, per element python loop as before, input)
+  lc = coord.LocalCoord.from_ecef(ecef_init)
+  return [
+    ('euler2quat', orient.euler2quat, numpy_wrap(transformations.euler2quat_single, (3,), (4,)), 'eulers'),
+    ('quat2euler', orient.quat2euler, numpy_wrap(transformations.quat2euler_single, (4,), (3,)), 'quats'),
+    ('euler2rot', orient.euler2rot, numpy_wrap(transformations.euler2rot_single, (3,), (3, 3)), 'eulers'),
+    ('rot2euler', orient.rot2euler, numpy_wrap(transformations.rot2euler_single, (3, 3), (3,)), 'rots'),
+    ('quat2rot', orient.quat2rot, numpy_wrap(transformations.quat2rot_single, (4,), (3, 3)), 'quats'),
+    ('rot2quat', orient.rot2quat, numpy_wrap(transformations.rot2quat_single, (3, 3), (4,)), 'rots'),
+    ('ned_euler_from_ecef', lambda x: orient.ned_euler_from_ecef(ecef_init, x),
+     lambda x: numpy_wrap(transformations.ned_euler_from_ecef_single, (3,), (3,))(ecef_init, x), 'eulers'),
+    ('geodetic2ecef', coord.geodetic2ecef, numpy_wrap(transformations.geodetic2ecef_single, (3,), (3,)), 'geodetics'),
+    ('ecef2geodetic', coord.ecef2geodetic, numpy_wrap(transformations.ecef2geodetic_single, (3,), (3,)), 'ecefs'),
+    ('ecef2ned', lc.ecef2ned, lambda x: numpy_wrap(coord.LocalCoord.ecef2ned_single, (3,), (3,))(lc, x), 'ecefs'),
+  ]
+
+
+def throughput(f, x):
+  ets = []
+  for _ in range(N_RUNS):
+    start_t = time.process_time_ns()
+    f(x)
+    ets.append(time.process_time_ns() - start_t)
+  return len(x) / (min(ets) * 1e-9)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Throughput of the batched transformations, against a python loop over the single versions")
+  parser.add_argument("--samples", type=int, default=1_000_000, help="samples per batched call")
+  parser.add_argument("--loop-samples", type=int, default=100_000, help="samples per python loop call, which is slow")
+  args = parser.parse_args()
+
+  inputs = make_inputs(args.samples)
+  for name, batched, loop, inp in get_cases(inputs['ecefs'][0]):
+    x = inputs[inp]
+    np.testing.assert_allclose(batched(x[:1000]), loop(x[:1000]))
+    batch_rate = throughput(batched, x)
+    loop_rate = throughput(loop, x[:args.loop_samples])
+    print(f'{name:>20}: {batch_rate * 1e-6:7.2f} M samples/s batched, {loop_rate * 1e-6:5.2f} M samples/s looped, {batch_rate / loop_rate:5.1f}x')
@@ -0,0 +1,44 @@
+import numpy as np
+
+import openpilot.common.transformations.calibration as calibration
+from openpilot.common.transformations.camera import DEVICE_CAMERAS
+from openpilot.common.transformations.model import get_warp_matrix
+from openpilot.common.transformations.orientation import rot_from_euler, euler_from_rot
+
+calib_eulers = np.array([[0.0, 0.0, 0.0],
+                         [0.01, -0.03, 0.02],
+                         [-0.005, 0.045, -0.06]])
+
+
+class TestCalibration:
+  def test_memoized(self):
+    intrinsics = DEVICE_CAMERAS[("tici", "ar0231")].fcam.intrinsics
+    for calib in calib_eulers:
+      for euler in (calib, calib.astype(np.float32)):
+        # bit identical to the uncached transforms, for the exact angles given
+        np.testing.assert_array_equal(calibration.device_from_calib(euler), rot_from_euler(euler))
+        np.testing.assert_array_equal(calibration.calib_from_device(euler), rot_from_euler(euler).T)
+        np.testing.assert_array_equal(calibration.warp_matrix(euler, intrinsics, True), get_warp_matrix(euler, intrinsics, True))
+        np.testing.assert_array_equal(calibration.warp_matrix(euler, intrinsics, False, np.float32),
+                                      get_warp_matrix(euler, intrinsics, False).astype(np.float32))
+
+      # the same matrix is shared by every caller with the same calibration
+      assert calibration.device_from_calib(calib) is calibration.device_from_calib(list(calib))
+      assert calibration.device_from_calib(calib) is not calibration.device_from_calib(calib + 1e-9)
+      assert calibration.warp_matrix(calib.astype(np.float32), intrinsics, False, np.float32).dtype == np.float32
+      assert not calibration.device_from_calib(calib).flags.writeable
+
+  def test_batch(self):
+    rng = np.random.default_rng(0)
+    rot = rot_from_euler(calib_eulers[2])
+    pts, stds = rng.normal(size=(100, 3)), rng.uniform(0.1, 2., size=(100, 3))
+    covs = np.array([np.diag(std**2) for std in stds])
+
+    np.testing.assert_allclose(calibration.rotate_points(rot, pts), [rot @ pt for pt in pts])
+    np.testing.assert_allclose(calibration.rotate_covs(rot, covs), [rot @ cov @ rot.T for cov in covs])
+    np.testing.assert_allclose(calibration.rotate_stds(rot, stds), [np.sqrt(np.diag(rot @ cov @ rot.T)) for cov in covs])
+    np.testing.assert_allclose(calibration.rotate_stds(rot, stds[0]), np.sqrt(np.diag(rot @ covs[0] @ rot.T)))
+
+    ned_from_device = rng.uniform(-0.5, 0.5, size=(10, 3))
+    expected = [euler_from_rot(rot_from_euler(e) @ rot_from_euler(calib_eulers[2])) for e in ned_from_device]
+    np.testing.assert_allclose(calibration.ned_from_calib(ned_from_device, calib_eulers[2]), expected, atol=1e-6)
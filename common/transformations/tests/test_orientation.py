@@ -59,3 +59,13 @@ class TestOrientation:
       np.testing.assert_allclose(ned_eulers[i], ned_euler_from_ecef(ecef_positions[i], eulers[i]), rtol=1e-7)
       #np.testing.assert_allclose(eulers[i], ecef_euler_from_ned(ecef_positions[i], ned_eulers[i]), rtol=1e-7)
     # np.testing.assert_allclose(ned_eulers, ned_euler_from_ecef(ecef_positions, eulers), rtol=1e-7)
+
+  def test_batch(self):
+    # batched conversions run in compiled code and match the single ones exactly, for any leading dimensions
+    for f, inputs in [(euler2quat, eulers), (quat2euler, quats), (euler2rot, eulers), (rot2euler, euler2rot(eulers)),
+                      (quat2rot, quats), (rot2quat, quat2rot(quats))]:
+      batched = f(np.stack([inputs, inputs[::-1]]))
+      for i, inp in enumerate(inputs):
+        np.testing.assert_array_equal(batched[0, i], f(inp))
+        np.testing.assert_array_equal(batched[1, -1 - i], f(inp))
+    np.testing.assert_array_equal(ned_euler_from_ecef(ecef_positions[0], eulers), [ned_euler_from_ecef(ecef_positions[0], e) for e in eulers])
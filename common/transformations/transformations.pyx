@@ -19,6 +19,7 @@ from openpilot.common.transformations.transformations cimport LocalCoord_c
 
 import numpy as np
 cimport numpy as np
+cimport cython
 
 cdef np.ndarray[double, ndim=2] matrix2numpy(Matrix3 m):
     return np.array([
@@ -53,6 +54,25 @@ cdef Geodetic list2geodetic(geodetic):
     g.alt = geodetic[2]
     return g
 
+cdef inline ECEF make_ecef(double x, double y, double z):
+    cdef ECEF e
+    e.x, e.y, e.z = x, y, z
+    return e
+
+cdef inline NED make_ned(double n_, double e_, double d_):
+    cdef NED n
+    n.n, n.e, n.d = n_, e_, d_
+    return n
+
+cdef inline Geodetic make_geodetic(double lat, double lon, double alt):
+    cdef Geodetic g
+    g.lat, g.lon, g.alt = lat, lon, alt
+    return g
+
+cdef double[:, :, ::1] column_major(rots):
+    # each (3, 3) block laid out like an Eigen::Matrix3d
+    return np.ascontiguousarray(np.swapaxes(rots, 1, 2), dtype=np.double)
+
 def euler2quat_single(euler):
     cdef Vector3 e = Vector3(euler[0], euler[1], euler[2])
     cdef Quaternion q = euler2quat_c(e)
@@ -111,6 +131,137 @@ def ecef2geodetic_single(ecef):
     return [g.lat, g.lon, g.alt]
 
 
+# batch versions of the above, (N, ...) arrays in and out, looping in C without a python call per element
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def euler2quat_batch(const double[:, ::1] eulers):
+    cdef Py_ssize_t i, n = eulers.shape[0]
+    out = np.empty((n, 4))
+    cdef double[:, ::1] o = out
+    cdef Quaternion q
+    for i in range(n):
+        q = euler2quat_c(Vector3(eulers[i, 0], eulers[i, 1], eulers[i, 2]))
+        o[i, 0], o[i, 1], o[i, 2], o[i, 3] = q.w(), q.x(), q.y(), q.z()
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def quat2euler_batch(const double[:, ::1] quats):
+    cdef Py_ssize_t i, n = quats.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef Vector3 e
+    for i in range(n):
+        e = quat2euler_c(Quaternion(quats[i, 0], quats[i, 1], quats[i, 2], quats[i, 3]))
+        o[i, 0], o[i, 1], o[i, 2] = e(0), e(1), e(2)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def quat2rot_batch(const double[:, ::1] quats):
+    cdef Py_ssize_t i, j, k, n = quats.shape[0]
+    out = np.empty((n, 3, 3))
+    cdef double[:, :, ::1] o = out
+    cdef Matrix3 r
+    for i in range(n):
+        r = quat2rot_c(Quaternion(quats[i, 0], quats[i, 1], quats[i, 2], quats[i, 3]))
+        for j in range(3):
+            for k in range(3):
+                o[i, j, k] = r(j, k)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rot2quat_batch(rots):
+    cdef double[:, :, ::1] r = column_major(rots)
+    cdef Py_ssize_t i, n = r.shape[0]
+    out = np.empty((n, 4))
+    cdef double[:, ::1] o = out
+    cdef Quaternion q
+    for i in range(n):
+        q = rot2quat_c(Matrix3(&r[i, 0, 0]))
+        o[i, 0], o[i, 1], o[i, 2], o[i, 3] = q.w(), q.x(), q.y(), q.z()
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def euler2rot_batch(const double[:, ::1] eulers):
+    cdef Py_ssize_t i, j, k, n = eulers.shape[0]
+    out = np.empty((n, 3, 3))
+    cdef double[:, :, ::1] o = out
+    cdef Matrix3 r
+    for i in range(n):
+        r = euler2rot_c(Vector3(eulers[i, 0], eulers[i, 1], eulers[i, 2]))
+        for j in range(3):
+            for k in range(3):
+                o[i, j, k] = r(j, k)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rot2euler_batch(rots):
+    cdef double[:, :, ::1] r = column_major(rots)
+    cdef Py_ssize_t i, n = r.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef Vector3 e
+    for i in range(n):
+        e = rot2euler_c(Matrix3(&r[i, 0, 0]))
+        o[i, 0], o[i, 1], o[i, 2] = e(0), e(1), e(2)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def ecef_euler_from_ned_batch(ecef_init, const double[:, ::1] ned_poses):
+    cdef ECEF init = list2ecef(ecef_init)
+    cdef Py_ssize_t i, n = ned_poses.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef Vector3 e
+    for i in range(n):
+        e = ecef_euler_from_ned_c(init, Vector3(ned_poses[i, 0], ned_poses[i, 1], ned_poses[i, 2]))
+        o[i, 0], o[i, 1], o[i, 2] = e(0), e(1), e(2)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def ned_euler_from_ecef_batch(ecef_init, const double[:, ::1] ecef_poses):
+    cdef ECEF init = list2ecef(ecef_init)
+    cdef Py_ssize_t i, n = ecef_poses.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef Vector3 e
+    for i in range(n):
+        e = ned_euler_from_ecef_c(init, Vector3(ecef_poses[i, 0], ecef_poses[i, 1], ecef_poses[i, 2]))
+        o[i, 0], o[i, 1], o[i, 2] = e(0), e(1), e(2)
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def geodetic2ecef_batch(const double[:, ::1] geodetics):
+    cdef Py_ssize_t i, n = geodetics.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef ECEF e
+    for i in range(n):
+        e = geodetic2ecef_c(make_geodetic(geodetics[i, 0], geodetics[i, 1], geodetics[i, 2]))
+        o[i, 0], o[i, 1], o[i, 2] = e.x, e.y, e.z
+    return out
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def ecef2geodetic_batch(const double[:, ::1] ecefs):
+    cdef Py_ssize_t i, n = ecefs.shape[0]
+    out = np.empty((n, 3))
+    cdef double[:, ::1] o = out
+    cdef Geodetic g
+    for i in range(n):
+        g = ecef2geodetic_c(make_ecef(ecefs[i, 0], ecefs[i, 1], ecefs[i, 2]))
+        o[i, 0], o[i, 1], o[i, 2] = g.lat, g.lon, g.alt
+    return out
+
+
 cdef class LocalCoord:
     cdef LocalCoord_c * lc
 
@@ -169,5 +320,57 @@ cdef class LocalCoord:
         cdef Geodetic g = self.lc.ned2geodetic(n)
         return [g.lat, g.lon, g.alt]
 
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def ecef2ned_batch(self, const double[:, ::1] ecefs):
+        assert self.lc
+        cdef Py_ssize_t i, n = ecefs.shape[0]
+        out = np.empty((n, 3))
+        cdef double[:, ::1] o = out
+        cdef NED ned
+        for i in range(n):
+            ned = self.lc.ecef2ned(make_ecef(ecefs[i, 0], ecefs[i, 1], ecefs[i, 2]))
+            o[i, 0], o[i, 1], o[i, 2] = ned.n, ned.e, ned.d
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def ned2ecef_batch(self, const double[:, ::1] neds):
+        assert self.lc
+        cdef Py_ssize_t i, n = neds.shape[0]
+        out = np.empty((n, 3))
+        cdef double[:, ::1] o = out
+        cdef ECEF e
+        for i in range(n):
+            e = self.lc.ned2ecef(make_ned(neds[i, 0], neds[i, 1], neds[i, 2]))
+            o[i, 0], o[i, 1], o[i, 2] = e.x, e.y, e.z
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def geodetic2ned_batch(self, const double[:, ::1] geodetics):
+        assert self.lc
+        cdef Py_ssize_t i, n = geodetics.shape[0]
+        out = np.empty((n, 3))
+        cdef double[:, ::1] o = out
+        cdef NED ned
+        for i in range(n):
+            ned = self.lc.geodetic2ned(make_geodetic(geodetics[i, 0], geodetics[i, 1], geodetics[i, 2]))
+            o[i, 0], o[i, 1], o[i, 2] = ned.n, ned.e, ned.d
+        return out
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def ned2geodetic_batch(self, const double[:, ::1] neds):
+        assert self.lc
+        cdef Py_ssize_t i, n = neds.shape[0]
+        out = np.empty((n, 3))
+        cdef double[:, ::1] o = out
+        cdef Geodetic g
+        for i in range(n):
+            g = self.lc.ned2geodetic(make_ned(neds[i, 0], neds[i, 1], neds[i, 2]))
+            o[i, 0], o[i, 1], o[i, 2] = g.lat, g.lon, g.alt
+        return out
+
     def __dealloc__(self):
         del self.lc
@@ -4,6 +4,8 @@ import time
 import numpy as np
 
 from casadi import SX, vertcat, sin, cos
+from openpilot.common.realtime import DT_MDL
+from openpilot.selfdrive.controls.lib.mpc_helpers import MpcTelemetry, get_solve_stats, shift_solution
 # WARNING: imports outside of constants will not trigger a rebuild
 from openpilot.selfdrive.modeld.constants import ModelConstants
 
@@ -23,6 +25,7 @@ SPEED_OFFSET = 10.0
 MODEL_NAME = 'lat'
 ACADOS_SOLVER_TYPE = 'SQP_RTI'
 N = 32
+T_IDXS = np.array(ModelConstants.T_IDXS[:N+1])
 
 def gen_lat_model():
   model = AcadosModel()
@@ -122,17 +125,19 @@ def gen_lat_ocp():
 
   # set prediction horizon
   ocp.solver_options.tf = Tf
-  ocp.solver_options.shooting_nodes = np.array(ModelConstants.T_IDXS)[:N+1]
+  ocp.solver_options.shooting_nodes = T_IDXS
 
   ocp.code_export_directory = EXPORT_DIR
   return ocp
 
 
 class LateralMpc:
-  def __init__(self, x0=None):
+  def __init__(self, x0=None, dt=DT_MDL):
     if x0 is None:
       x0 = np.zeros(X_DIM)
+    self.dt = dt
     self.solver = AcadosOcpSolverCython(MODEL_NAME, ACADOS_SOLVER_TYPE, N)
+    self.telemetry = MpcTelemetry()
     self.reset(x0)
 
   def reset(self, x0=None):
@@ -152,6 +157,8 @@ class LateralMpc:
     self.solver.constraints_set(0, "lbx", x0)
     self.solver.constraints_set(0, "ubx", x0)
     self.solver.solve()
+    # the next solve starts from the iterate of the init solve, there is no solution to shift yet
+    self.warm_start_valid = False
     self.solution_status = 0
     self.solve_time = 0.0
     self.cost = 0
@@ -182,6 +189,17 @@ class LateralMpc:
     self.solver.set(N, "p", p_cp[N])
     self.solver.cost_set(N, "yref", self.yref[N][:COST_E_DIM])
 
+    # warm start from the previous solution shifted by dt and moved to the new x0
+    warm_started = self.warm_start_valid
+    if warm_started:
+      x_guess, u_guess = shift_solution(T_IDXS, self.dt, self.x_sol, self.u_sol, x0_cp, [0, 1])
+      for i in range(N+1):
+        self.solver.set(i, 'x', x_guess[i])
+      for i in range(N):
+        self.solver.set(i, 'u', u_guess[i])
+    else:
+      x_guess = np.array([self.solver.get(i, 'x') for i in range(N+1)])
+
     t = time.monotonic()
     self.solution_status = self.solver.solve()
     self.solve_time = time.monotonic() - t
@@ -191,6 +209,8 @@ class LateralMpc:
     for i in range(N):
       self.u_sol[i] = self.solver.get(i, 'u')
     self.cost = self.solver.get_cost()
+    self.warm_start_valid = self.solution_status == 0
+    self.telemetry.record(get_solve_stats(self.solver, self.solution_status, warm_started, x_guess, self.x_sol))
 
 
 if __name__ == "__main__":
@@ -8,6 +8,7 @@ from opendbc.car.toyota.values import ToyotaFlags
 from openpilot.common.conversions import Conversions as CV
 from openpilot.common.realtime import DT_MDL
 from openpilot.common.swaglog import cloudlog
+from openpilot.selfdrive.controls.lib.mpc_helpers import SLOW_SOLVE_TIME, MpcTelemetry, get_solve_stats, shift_solution
 # WARNING: imports outside of constants will not trigger a rebuild
 from openpilot.selfdrive.modeld.constants import index_function
 from openpilot.selfdrive.controls.radard import _LEAD_ACCEL_TAU
@@ -273,12 +274,15 @@ def gen_long_ocp():
 
 
 class LongitudinalMpc:
-  def __init__(self, CP, mode='acc', dt=DT_MDL):
+  def __init__(self, CP, mode='acc', dt=DT_MDL, shift_warm_start=False):
     self.CP = CP
     self.braking_offset = 1
     self.mode = mode
     self.dt = dt
+    # start each solve from the previous solution shifted by dt, instead of the last iterate acados holds
+    self.shift_warm_start = shift_warm_start
     self.solver = AcadosOcpSolverCython(MODEL_NAME, ACADOS_SOLVER_TYPE, N)
+    self.telemetry = MpcTelemetry()
     self.reset()
     self.source = SOURCES[2]
 
@@ -296,6 +300,7 @@ class LongitudinalMpc:
     self.solver.cost_set(N, "yref", self.yref[N][:COST_E_DIM])
     self.x_sol = np.zeros((N+1, X_DIM))
     self.u_sol = np.zeros((N,1))
+    self.warm_start_valid = False
     self.params = np.zeros((N+1, PARAM_DIM))
     for i in range(N+1):
       self.solver.set(i, 'x', np.zeros(X_DIM))
@@ -361,8 +366,10 @@ class LongitudinalMpc:
     self.x0[1] = v
     self.x0[2] = a
     if abs(v_prev - v) > 2.:  # probably only helps if v < v_prev
-      for i in range(N+1):
-        self.solver.set(i, 'x', self.x0)
+      self.warm_start_valid = False
+      if not self.shift_warm_start:
+        for i in range(N+1):
+          self.solver.set(i, 'x', self.x0)
 
   @staticmethod
   def extrapolate_lead(x_lead, v_lead, a_lead, a_lead_tau):
@@ -511,31 +518,46 @@ class LongitudinalMpc:
          (lead_1_obstacle[0] - lead_0_obstacle[0]):
         self.source = 'lead1'
 
+  def initial_guess(self):
+    if self.warm_start_valid:
+      return shift_solution(T_IDXS, self.dt, self.x_sol, self.u_sol, self.x0, [0])
+
+    # after resets and jumps of the current state, roll it out with constant acceleration until standstill
+    v_guess = np.clip(self.x0[1] + self.x0[2] * T_IDXS, 0.0, 1e8)
+    a_guess = np.where(v_guess > 0.0, self.x0[2], 0.0)
+    x_guess = np.column_stack((np.cumsum(T_DIFFS * v_guess), v_guess, a_guess))
+    x_guess[0] = self.x0
+    return x_guess, np.zeros((N, U_DIM))
+
   def run(self):
-    # t0 = time.monotonic()
-    # reset = 0
+    warm_started = self.warm_start_valid
+    if self.shift_warm_start:
+      x_guess, u_guess = self.initial_guess()
+      for i in range(N+1):
+        self.solver.set(i, 'x', x_guess[i])
+      for i in range(N):
+        self.solver.set(i, 'u', u_guess[i])
+    else:
+      x_guess = np.array([self.solver.get(i, 'x') for i in range(N+1)])
     for i in range(N+1):
       self.solver.set(i, 'p', self.params[i])
     self.solver.constraints_set(0, "lbx", self.x0)
     self.solver.constraints_set(0, "ubx", self.x0)
 
     self.solution_status = self.solver.solve()
-    self.solve_time = float(self.solver.get_stats('time_tot')[0])
-    self.time_qp_solution = float(self.solver.get_stats('time_qp')[0])
-    self.time_linearization = float(self.solver.get_stats('time_lin')[0])
-    self.time_integrator = float(self.solver.get_stats('time_sim')[0])
-
-    # qp_iter = self.solver.get_stats('statistics')[-1][-1] # SQP_RTI specific
-    # print(f"long_mpc timings: tot {self.solve_time:.2e}, qp {self.time_qp_solution:.2e}, lin {self.time_linearization:.2e}, \
-    # integrator {self.time_integrator:.2e}, qp_iter {qp_iter}")
-    # res = self.solver.get_residuals()
-    # print(f"long_mpc residuals: {res[0]:.2e}, {res[1]:.2e}, {res[2]:.2e}, {res[3]:.2e}")
-    # self.solver.print_statistics()
 
     for i in range(N+1):
       self.x_sol[i] = self.solver.get(i, 'x')
     for i in range(N):
       self.u_sol[i] = self.solver.get(i, 'u')
+    self.warm_start_valid = True
+
+    stats = get_solve_stats(self.solver, self.solution_status, warm_started, x_guess, self.x_sol)
+    self.telemetry.record(stats)
+    self.solve_time = stats.solve_time
+    self.time_qp_solution = stats.time_qp
+    self.time_linearization = stats.time_lin
+    self.time_integrator = stats.time_sim
 
     self.v_solution = self.x_sol[:,1]
     self.a_solution = self.x_sol[:,2]
@@ -549,9 +571,9 @@ class LongitudinalMpc:
         self.last_cloudlog_t = t
         cloudlog.warning(f"Long mpc reset, solution_status: {self.solution_status}")
       self.reset()
-      # reset = 1
-    # print(f"long_mpc timings: total internal {self.solve_time:.2e}, external: {(time.monotonic() - t0):.2e} qp {self.time_qp_solution:.2e}, \
-    # lin {self.time_linearization:.2e} qp_iter {qp_iter}, reset {reset}")
+    elif self.solve_time > SLOW_SOLVE_TIME and t > self.last_cloudlog_t + 5.0:
+      self.last_cloudlog_t = t
+      cloudlog.event("long_mpc_slow_solve", error=True, **stats.to_dict())
 
 
 if __name__ == "__main__":
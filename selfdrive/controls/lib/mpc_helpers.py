@@ -0,0 +1,70 @@
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+from cereal.messaging.stats import Histogram
+
+SLOW_SOLVE_TIME = 0.02  # s, warn about solves that take a large part of the 20 Hz cycle
+
+
+@dataclass
+class MpcSolveStats:
+  solve_time: float = 0.  # s, total solver time
+  time_qp: float = 0.
+  time_lin: float = 0.
+  time_sim: float = 0.
+  sqp_iter: int = 0
+  qp_iter: int = 0
+  qp_status: int = 0
+  solution_status: int = 0
+  warm_started: bool = False  # started from the previous solution (shifted by dt if enabled), not a reset of the current state
+  warm_start_error: float = 0.  # largest change of a state between the initial guess and the solution
+
+  def to_dict(self) -> dict:
+    return asdict(self)
+
+
+def get_solve_stats(solver, solution_status: int, warm_started: bool, x_guess: np.ndarray, x_sol: np.ndarray) -> MpcSolveStats:
+  # SQP_RTI statistics rows are the iteration, qp status and qp iterations, with a column per SQP iteration
+  statistics = solver.get_stats('statistics')
+  qp_status, qp_iter = (int(statistics[1, -1]), int(statistics[2, -1])) if statistics.shape[1] > 0 else (0, 0)
+  return MpcSolveStats(
+    solve_time=float(solver.get_stats('time_tot')[0]),
+    time_qp=float(solver.get_stats('time_qp')[0]),
+    time_lin=float(solver.get_stats('time_lin')[0]),
+    time_sim=float(solver.get_stats('time_sim')[0]),
+    sqp_iter=int(solver.get_stats('sqp_iter')),
+    qp_iter=qp_iter,
+    qp_status=qp_status,
+    solution_status=int(solution_status),
+    warm_started=warm_started,
+    warm_start_error=float(np.max(np.abs(x_sol - x_guess))),
+  )
+
+
+class MpcTelemetry:
+  """Stats of the last solve and the solve time distribution of an MPC"""
+  def __init__(self):
+    self.stats = MpcSolveStats()
+    self.solve_time = Histogram()
+
+  def record(self, stats: MpcSolveStats) -> None:
+    self.stats = stats
+    self.solve_time.record(stats.solve_time)
+
+  def summary(self) -> dict:
+    return {'last': self.stats.to_dict(), 'solve_time': self.solve_time.summary()}
+
+
+def shift_solution(t_idxs: np.ndarray, dt: float, x_sol: np.ndarray, u_sol: np.ndarray, x0: np.ndarray,
+                   position_idxs: list[int]) -> tuple[np.ndarray, np.ndarray]:
+  """
+  Initial guess for the next solve: the previous solution dt later along t_idxs, holding the last node.
+  Positions are translated so the guess starts at x0, other states only get x0 in the first node.
+  """
+  t = t_idxs + dt
+  x_guess = np.column_stack([np.interp(t, t_idxs, x_sol[:, k]) for k in range(x_sol.shape[1])])
+  u_guess = np.column_stack([np.interp(t[:-1], t_idxs[:-1], u_sol[:, k]) for k in range(u_sol.shape[1])])
+  x_guess[:, position_idxs] += x0[position_idxs] - x_guess[0, position_idxs]
+  x_guess[0] = x0
+  return x_guess, u_guess
@@ -1,16 +1,13 @@
 #!/usr/bin/env python3
-import math
 import numpy as np
 from collections import deque
 from typing import Any
 
 import capnp
 from cereal import messaging, log, car
-from openpilot.common.filter_simple import FirstOrderFilter
 from openpilot.common.params import Params
 from openpilot.common.realtime import DT_MDL, Priority, config_realtime_process
 from openpilot.common.swaglog import cloudlog
-from openpilot.common.simple_kalman import KF1D
 
 
 # Default lead acceleration decay set to 50% at 1s
@@ -48,94 +45,168 @@ class KalmanParams:
     self.K = [[np.interp(dt, dts, K0)], [np.interp(dt, dts, K1)]]
 
 
-class Track:
-  def __init__(self, identifier: int, v_lead: float, kalman_params: KalmanParams):
-    self.identifier = identifier
-    self.cnt = 0
-    self.aLeadTau = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
-    self.K_A = kalman_params.A
-    self.K_C = kalman_params.C
-    self.K_K = kalman_params.K
-    self.kf = KF1D([[v_lead], [0.0]], self.K_A, self.K_C, self.K_K)
-
-  def update(self, d_rel: float, y_rel: float, v_rel: float, v_lead: float, measured: float):
-    # relative values, copy
-    self.dRel = d_rel   # LONG_DIST
-    self.yRel = y_rel   # -LAT_DIST
-    self.vRel = v_rel   # REL_SPEED
-    self.vLead = v_lead
-    self.measured = measured   # measured or estimate
-
-    # computed velocity and accelerations
-    if self.cnt > 0:
-      self.kf.update(self.vLead)
-
-    self.vLeadK = float(self.kf.x[SPEED][0])
-    self.aLeadK = float(self.kf.x[ACCEL][0])
-
-    # Learn if constant acceleration
-    if abs(self.aLeadK) < 0.5:
-      self.aLeadTau.x = _LEAD_ACCEL_TAU
-    else:
-      self.aLeadTau.update(0.0)
-
-    self.cnt += 1
-
-  def get_RadarState(self, model_prob: float = 0.0):
+# columns of the track table
+D_REL, Y_REL, V_REL, MEASURED, V_LEAD, V_LEAD_K, A_LEAD_K, A_LEAD_TAU = range(8)
+
+
+class Tracks:
+  """
+  Struct of arrays of the radar tracks, one row per track in the order the tracks first appeared,
+  with the lead Kalman filter and acceleration decay filter of all tracks updated at once.
+  """
+  def __init__(self, kalman_params: KalmanParams):
+    A, C, K = kalman_params.A, kalman_params.C, kalman_params.K
+    # same gains and operation order as KF1D, so the filtered values are bit identical
+    self.K0, self.K1 = K[0][0], K[1][0]
+    self.A_K_0 = A[0][0] - K[0][0] * C[0]
+    self.A_K_1 = A[0][1] - K[0][0] * C[1]
+    self.A_K_2 = A[1][0] - K[1][0] * C[0]
+    self.A_K_3 = A[1][1] - K[1][0] * C[1]
+    self.tau_alpha = DT_MDL / (0.45 + DT_MDL)  # FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
+
+    self.identifiers: list[int] = []
+    self.slots: dict[int, int] = {}
+    self.data = np.zeros((0, 8))
+
+  def __len__(self) -> int:
+    return len(self.identifiers)
+
+  dRel = property(lambda self: self.data[:, D_REL])  # LONG_DIST
+  yRel = property(lambda self: self.data[:, Y_REL])  # -LAT_DIST
+  vRel = property(lambda self: self.data[:, V_REL])  # REL_SPEED
+  vLead = property(lambda self: self.data[:, V_LEAD])
+  vLeadK = property(lambda self: self.data[:, V_LEAD_K])
+  aLeadK = property(lambda self: self.data[:, A_LEAD_K])
+  aLeadTau = property(lambda self: self.data[:, A_LEAD_TAU])
+
+  def update(self, points: dict[int, tuple[float, float, float, bool]], v_ego: float):
+    # *** remove missing points, keeping the order of the remaining tracks ***
+    if any(i not in points for i in self.identifiers):
+      keep = [i in points for i in self.identifiers]
+      self.data = self.data[keep]
+      self.identifiers = [i for i in self.identifiers if i in points]
+      self.slots = {i: slot for slot, i in enumerate(self.identifiers)}
+
+    # *** create new tracks at the end, their filters start at the first measurement ***
+    n_tracked = len(self.identifiers)
+    for i in points:
+      if i not in self.slots:
+        self.slots[i] = len(self.identifiers)
+        self.identifiers.append(i)
+
+    if len(self.identifiers) == 0:
+      self.data = np.zeros((0, 8))
+      return
+
+    data = np.empty((len(self.identifiers), 8))
+    data[:n_tracked] = self.data
+    data[:, D_REL:MEASURED + 1] = [points[i] for i in self.identifiers]
+    data[:, V_LEAD] = data[:, V_REL] + v_ego
+    if n_tracked < len(self.identifiers):
+      data[n_tracked:, V_LEAD_K:A_LEAD_TAU + 1] = 0.0, 0.0, _LEAD_ACCEL_TAU
+      data[n_tracked:, V_LEAD_K] = data[n_tracked:, V_LEAD]
+
+    # computed velocity and accelerations of the existing tracks
+    x0, x1, meas = self.data[:, V_LEAD_K], self.data[:, A_LEAD_K], data[:n_tracked, V_LEAD]
+    data[:n_tracked, V_LEAD_K] = self.A_K_0 * x0 + self.A_K_1 * x1 + self.K0 * meas
+    data[:n_tracked, A_LEAD_K] = self.A_K_2 * x0 + self.A_K_3 * x1 + self.K1 * meas
+
+    # Learn if constant acceleration, the FirstOrderFilter update towards 0.0 otherwise
+    a_lead_tau = data[:, A_LEAD_TAU]
+    a_lead_tau *= 1. - self.tau_alpha
+    a_lead_tau[np.abs(data[:, A_LEAD_K]) < 0.5] = _LEAD_ACCEL_TAU
+    self.data = data
+
+  def get_RadarState(self, slot: int, model_prob: float = 0.0):
+    track = self.data[slot].tolist()
     return {
-      "dRel": float(self.dRel),
-      "yRel": float(self.yRel),
-      "vRel": float(self.vRel),
-      "vLead": float(self.vLead),
-      "vLeadK": float(self.vLeadK),
-      "aLeadK": float(self.aLeadK),
-      "aLeadTau": float(self.aLeadTau.x),
+      "dRel": track[D_REL],
+      "yRel": track[Y_REL],
+      "vRel": track[V_REL],
+      "vLead": track[V_LEAD],
+      "vLeadK": track[V_LEAD_K],
+      "aLeadK": track[A_LEAD_K],
+      "aLeadTau": track[A_LEAD_TAU],
       "status": True,
       "fcw": self.is_potential_fcw(model_prob),
       "modelProb": model_prob,
       "radar": True,
-      "radarTrackId": self.identifier,
+      "radarTrackId": self.identifiers[slot],
     }
 
-  def potential_low_speed_lead(self, v_ego: float):
+  def closest_low_speed_lead(self, v_ego: float) -> int | None:
     # stop for stuff in front of you and low speed, even without model confirmation
     # Radar points closer than 0.75, are almost always glitches on toyota radars
-    return abs(self.yRel) < 1.0 and (v_ego < V_EGO_STATIONARY) and (0.75 < self.dRel < 25)
+    if v_ego >= V_EGO_STATIONARY or len(self) == 0:
+      return None
+    d_rel = np.where((np.abs(self.yRel) < 1.0) & (0.75 < self.dRel) & (self.dRel < 25), self.dRel, np.inf)
+    slot = int(np.argmin(d_rel))
+    return slot if np.isfinite(d_rel[slot]) else None
 
   def is_potential_fcw(self, model_prob: float):
     return model_prob > .9
 
   def __str__(self):
-    ret = f"x: {self.dRel:4.1f}  y: {self.yRel:4.1f}  v: {self.vRel:4.1f}  a: {self.aLeadK:4.1f}"
-    return ret
-
-
-def laplacian_pdf(x: float, mu: float, b: float):
-  b = max(b, 1e-4)
-  return math.exp(-abs(x-mu)/b)
-
-
-def match_vision_to_track(v_ego: float, lead: capnp._DynamicStructReader, tracks: dict[int, Track]):
-  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
-
-  def prob(c):
-    prob_d = laplacian_pdf(c.dRel, offset_vision_dist, lead.xStd[0])
-    prob_y = laplacian_pdf(c.yRel, -lead.y[0], lead.yStd[0])
-    prob_v = laplacian_pdf(c.vRel + v_ego, lead.v[0], lead.vStd[0])
+    return "\n".join(f"x: {d:4.1f}  y: {y:4.1f}  v: {v:4.1f}  a: {a:4.1f}" for d, y, v, a in self.data[:, [D_REL, Y_REL, V_REL, A_LEAD_K]])
+
+
+def lead_track_costs(v_ego: float, ready: bool, leads: list[capnp._DynamicStructReader], tracks: Tracks,
+                     gate_all: bool = True) -> np.ndarray:
+  """
+  Negative log likelihood of each radar track being each model lead, as a (n_leads, n_tracks) matrix.
+  Pairs that fail the sanity gates, and leads the model isn't confident in, cost inf and can't be matched.
+  Without gate_all only the most likely track of each lead is kept and gated, like the per lead matching did.
+  """
+  costs = np.full((len(leads), len(tracks)), np.inf)
+  confident = [i for i, lead in enumerate(leads) if lead.prob > .5]
+  if not ready or len(tracks) == 0 or len(confident) == 0:
+    return costs
+
+  # laplacian distance, lateral and speed likelihoods, this isn't exactly right, but it's a good heuristic
+  x = tracks.data[:, [D_REL, Y_REL, V_REL]].T
+  x[2] += v_ego
+  mu = np.array([[leads[i].x[0] - RADAR_TO_CAMERA, -leads[i].y[0], leads[i].v[0]] for i in confident]).T[:, :, None]
+  b = np.maximum([[leads[i].xStd[0], leads[i].yStd[0], leads[i].vStd[0]] for i in confident], 1e-4).T[:, :, None]
+  cost_dyv = np.abs(x[:, None, :] - mu) / b
+  cost = np.sum(cost_dyv, axis=0)
 
-    # This isn't exactly right, but it's a good heuristic
-    return prob_d * prob_y * prob_v
-
-  track = max(tracks.values(), key=prob)
-
-  # if no 'sane' match is found return -1
   # stationary radar points can be false positives
-  dist_sane = abs(track.dRel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
-  vel_sane = (abs(track.vRel + v_ego - lead.v[0]) < 10) or (v_ego + track.vRel > 3)
-  if dist_sane and vel_sane:
-    return track
-  else:
-    return None
+  offset_vision_dist, v_vision = mu[0], mu[2]
+  dist_sane = np.abs(x[0] - offset_vision_dist) < np.maximum(offset_vision_dist * .25, 5.0)
+  vel_sane = (np.abs(x[2] - v_vision) < 10) | (x[2] > 3)
+  sane = dist_sane & vel_sane
+  if not gate_all:
+    # the first most likely track, from the same product of likelihoods, so underflows pick the same track
+    prob = np.exp(-cost_dyv[0]) * np.exp(-cost_dyv[1]) * np.exp(-cost_dyv[2])
+    best = np.zeros_like(sane)
+    best[np.arange(len(confident)), np.argmax(prob, axis=1)] = True
+    sane &= best
+  costs[confident] = np.where(sane, cost, np.inf)
+  return costs
+
+
+def assign_independent(costs: np.ndarray) -> list[int | None]:
+  # best track of each lead on its own, the same track can be matched to several leads
+  if costs.shape[1] == 0:
+    return [None] * len(costs)
+  slots = np.argmin(costs, axis=1).tolist()
+  return [slot if np.isfinite(c[slot]) else None for c, slot in zip(costs, slots, strict=True)]
+
+
+def assign_global(costs: np.ndarray) -> list[int | None]:
+  """
+  Matches the leads to distinct tracks in priority order, each lead gets the cheapest track not taken by the
+  leads before it. leadOne keeps its best track, leadTwo only gets the best of the remaining ones.
+  """
+  assignment: list[int | None] = [None] * len(costs)
+  taken = np.zeros(costs.shape[1], dtype=bool)
+  for i, c in enumerate(costs):
+    c = np.where(taken, np.inf, c)
+    if len(c) and np.isfinite(c.min()):
+      slot = int(np.argmin(c))
+      assignment[i] = slot
+      taken[slot] = True
+  return assignment
 
 
 def get_RadarState_from_vision(lead_msg: capnp._DynamicStructReader, v_ego: float, model_v_ego: float):
@@ -156,38 +227,30 @@ def get_RadarState_from_vision(lead_msg: capnp._DynamicStructReader, v_ego: floa
   }
 
 
-def get_lead(v_ego: float, ready: bool, tracks: dict[int, Track], lead_msg: capnp._DynamicStructReader,
-             model_v_ego: float, low_speed_override: bool = True) -> dict[str, Any]:
+def get_lead(v_ego: float, ready: bool, tracks: Tracks, lead_msg: capnp._DynamicStructReader,
+             model_v_ego: float, slot: int | None, low_speed_slot: int | None = None) -> dict[str, Any]:
   # Determine leads, this is where the essential logic happens
-  if len(tracks) > 0 and ready and lead_msg.prob > .5:
-    track = match_vision_to_track(v_ego, lead_msg, tracks)
-  else:
-    track = None
-
   lead_dict = {'status': False}
-  if track is not None:
-    lead_dict = track.get_RadarState(lead_msg.prob)
-  elif (track is None) and ready and (lead_msg.prob > .5):
+  if slot is not None:
+    lead_dict = tracks.get_RadarState(slot, lead_msg.prob)
+  elif ready and (lead_msg.prob > .5):
     lead_dict = get_RadarState_from_vision(lead_msg, v_ego, model_v_ego)
 
-  if low_speed_override:
-    low_speed_tracks = [c for c in tracks.values() if c.potential_low_speed_lead(v_ego)]
-    if len(low_speed_tracks) > 0:
-      closest_track = min(low_speed_tracks, key=lambda c: c.dRel)
-
-      # Only choose new track if it is actually closer than the previous one
-      if (not lead_dict['status']) or (closest_track.dRel < lead_dict['dRel']):
-        lead_dict = closest_track.get_RadarState()
+  # Only choose the low speed lead if it is actually closer than the previous one
+  if low_speed_slot is not None and ((not lead_dict['status']) or (tracks.dRel[low_speed_slot] < lead_dict['dRel'])):
+    lead_dict = tracks.get_RadarState(low_speed_slot)
 
   return lead_dict
 
 
 class RadarD:
-  def __init__(self, delay: float = 0.0):
+  def __init__(self, delay: float = 0.0, global_association: bool = False):
     self.current_time = 0.0
+    # match the leads to distinct tracks together, instead of each lead to its own most likely track
+    self.global_association = global_association
 
-    self.tracks: dict[int, Track] = {}
     self.kalman_params = KalmanParams(DT_MDL)
+    self.tracks = Tracks(self.kalman_params)
 
     self.v_ego = 0.0
     self.v_ego_hist = deque([0.0], maxlen=int(round(delay / DT_MDL))+1)
@@ -207,24 +270,11 @@ class RadarD:
       self.v_ego_hist.append(self.v_ego)
       self.last_v_ego_frame = sm.recv_frame['carState']
 
-    ar_pts = {pt.trackId: [pt.dRel, pt.yRel, pt.vRel, pt.measured] for pt in rr.points}
-
-    # *** remove missing points from meta data ***
-    for ids in list(self.tracks.keys()):
-      if ids not in ar_pts:
-        self.tracks.pop(ids, None)
+    ar_pts = {pt.trackId: (pt.dRel, pt.yRel, pt.vRel, pt.measured) for pt in rr.points}
 
     # *** compute the tracks ***
-    for ids in ar_pts:
-      rpt = ar_pts[ids]
-
-      # align v_ego by a fixed time to align it with the radar measurement
-      v_lead = rpt[2] + self.v_ego_hist[0]
-
-      # create the track if it doesn't exist or it's a new track
-      if ids not in self.tracks:
-        self.tracks[ids] = Track(ids, v_lead, self.kalman_params)
-      self.tracks[ids].update(rpt[0], rpt[1], rpt[2], v_lead, rpt[3])
+    # align v_ego by a fixed time to align it with the radar measurement
+    self.tracks.update(ar_pts, self.v_ego_hist[0])
 
     # *** publish radarState ***
     self.radar_state_valid = sm.all_checks()
@@ -237,10 +287,15 @@ class RadarD:
       model_v_ego = sm['modelV2'].velocity.x[0]
     else:
       model_v_ego = self.v_ego
-    leads_v3 = sm['modelV2'].leadsV3
+    # only leadOne and leadTwo are published
+    leads_v3 = list(sm['modelV2'].leadsV3)[:2]
     if len(leads_v3) > 1:
-      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[0], model_v_ego, low_speed_override=True)
-      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[1], model_v_ego, low_speed_override=False)
+      # associate both published leads with the radar tracks at once
+      costs = lead_track_costs(self.v_ego, self.ready, leads_v3, self.tracks, gate_all=self.global_association)
+      slots = assign_global(costs) if self.global_association else assign_independent(costs)
+      low_speed_slot = self.tracks.closest_low_speed_lead(self.v_ego)
+      self.radar_state.leadOne = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[0], model_v_ego, slots[0], low_speed_slot)
+      self.radar_state.leadTwo = get_lead(self.v_ego, self.ready, self.tracks, leads_v3[1], model_v_ego, slots[1])
 
   def publish(self, pm: messaging.PubMaster):
     assert self.radar_state is not None
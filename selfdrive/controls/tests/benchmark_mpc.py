@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+
+import cereal.messaging as messaging
+from cereal import car
+from openpilot.common.prefix import OpenpilotPrefix
+from openpilot.selfdrive.controls.lib.drive_helpers import CAR_ROTATION_RADIUS
+from openpilot.selfdrive.controls.lib.lateral_mpc_lib.lat_mpc import LateralMpc, T_IDXS as LAT_T_IDXS
+from openpilot.selfdrive.controls.lib.longitudinal_planner import LongitudinalPlanner
+from openpilot.selfdrive.modeld.constants import ModelConstants
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+# scenarios with the longitudinal planner engaged, behind leads and in stop and go
+SCENARIOS = ["HYUNDAI", "TOYOTA", "HONDA", "SUBARU"]
+PLANNER_SERVICES = ['carControl', 'carState', 'controlsState', 'liveParameters', 'radarState', 'modelV2', 'selfdriveState']
+
+
+def run_scenario(lr, shift_warm_start=False):
+  # same inputs and cycles as plannerd, and the lateral MPC tracking the model path
+  CP = next((m.carParams for m in lr if m.which() == 'carParams'), car.CarParams.new_message())
+  sm = messaging.SubMaster(PLANNER_SERVICES, poll='modelV2', addr=None)
+  planner = LongitudinalPlanner(CP)
+  planner.mpc.shift_warm_start = shift_warm_start
+  lat_mpc = LateralMpc()
+  lat_mpc.set_weights(1., .1, 0.0, .05, 800)
+
+  stats = {'long': [], 'lat': []}
+  msgs = []
+  for msg in lr:
+    if msg.which() not in PLANNER_SERVICES:
+      continue
+    msgs.append(msg)
+    if msg.which() != 'modelV2':
+      continue
+
+    sm.update_msgs(msg.logMonoTime * 1e-9, msgs)
+    msgs = []
+    planner.update(sm)
+    stats['long'].append(planner.mpc.telemetry.stats)
+
+    model = sm['modelV2']
+    if len(model.position.y) == ModelConstants.IDX_N:
+      y_pts = np.interp(LAT_T_IDXS, ModelConstants.T_IDXS, model.position.y)
+      heading_pts = np.interp(LAT_T_IDXS, ModelConstants.T_IDXS, model.orientation.z)
+      yaw_rate_pts = np.interp(LAT_T_IDXS, ModelConstants.T_IDXS, model.orientationRate.z)
+      p = np.column_stack([np.full(len(LAT_T_IDXS), max(sm['carState'].vEgo, 0.)), np.full(len(LAT_T_IDXS), CAR_ROTATION_RADIUS)])
+      lat_mpc.run(np.zeros(4), p, y_pts, heading_pts, yaw_rate_pts)
+      stats['lat'].append(lat_mpc.telemetry.stats)
+  return stats
+
+
+def report(name, stats):
+  solve_times = np.array([s.solve_time for s in stats]) * 1e3
+  qp_iters = np.array([s.qp_iter for s in stats])
+  warm_started = [s for s in stats if s.warm_started]
+  failures = sum(s.solution_status != 0 for s in stats)
+  print(f'  {name}: {len(stats)} solves, {np.percentile(solve_times, 50):.3f} p50 ms, {np.percentile(solve_times, 99):.3f} p99 ms, ' +
+        f'{solve_times.max():.3f} max ms, {qp_iters.mean():.1f} mean qp iters, {failures} failed, ' +
+        f'{np.median([s.warm_start_error for s in warm_started]) if warm_started else np.nan:.3f} median warm start error')
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Solve time distribution of the longitudinal and lateral MPCs over logged scenarios")
+  parser.add_argument("--scenarios", nargs='+', default=SCENARIOS, help="process replay segments by car, or routes and segments")
+  parser.add_argument("--shift-warm-start", action="store_true", help="warm start the longitudinal MPC from its shifted solution")
+  args = parser.parse_args()
+
+  process_replay_segments = dict(segments)
+  all_stats = {'long': [], 'lat': []}
+  with OpenpilotPrefix():
+    for scenario in args.scenarios:
+      if scenario in process_replay_segments:
+        r, n = process_replay_segments[scenario].rsplit("--", 1)
+        lr = LogReader(get_url(r, n, "rlog.zst"), sort_by_time=True)
+      else:
+        lr = LogReader(scenario, sort_by_time=True)
+
+      print(scenario)
+      stats = run_scenario(lr, args.shift_warm_start)
+      for name, s in stats.items():
+        if len(s):
+          report(name, s)
+        all_stats[name] += s
+
+  print('all')
+  for name, s in all_stats.items():
+    if len(s):
+      report(name, s)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import time
+
+import cereal.messaging as messaging
+from openpilot.common.realtime import DT_MDL
+from openpilot.selfdrive.controls.radard import RadarD, RADAR_TO_CAMERA
+
+N_FRAMES = 1000
+N_RUNS = 5
+V_EGO = 20.
+
+
+def make_frames(n_tracks, n_frames, seed=0):
+  # dense radar frames with tracks moving, appearing and disappearing, and three model leads on top of tracks
+  rng = np.random.default_rng(seed)
+  d_rel = rng.uniform(5., 150., n_tracks)
+  y_rel = rng.uniform(-8., 8., n_tracks)
+  v_rel = rng.uniform(-10., 5., n_tracks)
+  track_ids = np.arange(n_tracks)
+
+  frames = []
+  for i in range(n_frames):
+    t = int(i * DT_MDL * 1e9)
+    d_rel = np.clip(d_rel + v_rel * DT_MDL + rng.normal(0., 0.1, n_tracks), 1., 200.)
+    dropped = rng.random(n_tracks) < 0.02
+    track_ids[dropped] = track_ids.max() + 1 + np.arange(dropped.sum())
+
+    cs = messaging.new_message('carState')
+    cs.logMonoTime = t
+    cs.carState.vEgo = V_EGO
+
+    model = messaging.new_message('modelV2')
+    model.logMonoTime = t
+    model.modelV2.velocity.x = [V_EGO]
+    for j, lead in enumerate(model.modelV2.init('leadsV3', 3)):
+      lead.prob = 0.9
+      lead.x, lead.xStd = [float(d_rel[j] + RADAR_TO_CAMERA)], [1.]
+      lead.y, lead.yStd = [float(-y_rel[j])], [0.5]
+      lead.v, lead.vStd = [float(V_EGO + v_rel[j])], [1.]
+      lead.a = [0.]
+
+    tracks = messaging.new_message('liveTracks')
+    tracks.logMonoTime = t
+    for pt, track_id, d, y, v in zip(tracks.liveTracks.init('points', n_tracks), track_ids, d_rel, y_rel, v_rel, strict=True):
+      pt.trackId = int(track_id)
+      pt.dRel, pt.yRel, pt.vRel = float(d), float(y), float(v)
+      pt.measured = True
+
+    frames.append([cs.as_reader(), model.as_reader(), tracks.as_reader()])
+  return frames
+
+
+def run(frames):
+  sm = messaging.SubMaster(['modelV2', 'carState', 'liveTracks'], poll='modelV2', addr=None)
+  RD = RadarD(0.1)
+  ets = []
+  for msgs in frames:
+    sm.update_msgs(msgs[0].logMonoTime * 1e-9, msgs)
+    start_t = time.process_time_ns()
+    RD.update(sm, sm['liveTracks'])
+    ets.append(time.process_time_ns() - start_t)
+  return np.mean(ets) * 1e-3
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Per frame cost of RadarD.update on synthetic dense radar frames")
+  parser.add_argument("--tracks", type=int, nargs='+', default=[16, 32, 64], help="number of radar tracks per frame")
+  args = parser.parse_args()
+
+  for n_tracks in args.tracks:
+    frames = make_frames(n_tracks, N_FRAMES)
+    ets = [run(frames) for _ in range(N_RUNS)]
+    print(f'{n_tracks} tracks: {np.mean(ets):.2f} mean us, {max(ets):.2f} max us, {min(ets):.2f} min us, {np.std(ets):.2f} std us per frame')
@@ -0,0 +1,28 @@
+import numpy as np
+
+from openpilot.selfdrive.controls.lib.mpc_helpers import shift_solution
+from openpilot.selfdrive.modeld.constants import index_function
+
+N = 12
+T_IDXS = np.array([index_function(idx, max_val=10.0, max_idx=N) for idx in range(N+1)])
+
+
+class TestShiftSolution:
+  def test_shift(self):
+    dt, v0, a0 = 0.05, 10., 0.5
+    x_sol = np.column_stack([v0 * T_IDXS + a0 * T_IDXS**2 / 2, v0 + a0 * T_IDXS, np.full(N+1, a0)])
+    u_sol = np.arange(N, dtype=float)[:, None]
+    x0 = np.array([0., 11., 0.])
+
+    x_guess, u_guess = shift_solution(T_IDXS, dt, x_sol, u_sol, x0, [0])
+    np.testing.assert_array_equal(x_guess[0], x0)
+
+    # the previous solution dt later, holding the last node
+    np.testing.assert_allclose(x_guess[1:-1, 1], v0 + a0 * (T_IDXS[1:-1] + dt))
+    np.testing.assert_allclose(x_guess[1:, 2], a0)
+    np.testing.assert_array_equal(x_guess[-1, 1], x_sol[-1, 1])
+    np.testing.assert_allclose(u_guess[:, 0], np.interp(T_IDXS[:-1] + dt, T_IDXS[:-1], u_sol[:, 0]))
+
+    # positions are moved to start at x0, other states aren't
+    assert np.all(np.diff(x_guess[:, 0]) > 0)
+    np.testing.assert_allclose(x_guess[1:, 0] - x_guess[0, 0], np.interp(T_IDXS[1:] + dt, T_IDXS, x_sol[:, 0]) - np.interp(dt, T_IDXS, x_sol[:, 0]))
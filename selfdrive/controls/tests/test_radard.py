@@ -0,0 +1,184 @@
+import itertools
+import math
+import numpy as np
+
+from cereal import car, messaging
+from openpilot.common.filter_simple import FirstOrderFilter
+from openpilot.common.realtime import DT_MDL
+from openpilot.common.simple_kalman import KF1D
+from openpilot.selfdrive.controls.radard import _LEAD_ACCEL_TAU, RADAR_TO_CAMERA, KalmanParams, RadarD, Tracks, assign_global, \
+                                               assign_independent, lead_track_costs
+
+
+class Track:
+  # the per track filters radard used before the track table, as a reference
+  def __init__(self, v_lead, kalman_params):
+    self.cnt = 0
+    self.aLeadTau = FirstOrderFilter(_LEAD_ACCEL_TAU, 0.45, DT_MDL)
+    self.kf = KF1D([[v_lead], [0.0]], kalman_params.A, kalman_params.C, kalman_params.K)
+
+  def update(self, d_rel, y_rel, v_rel, v_lead, measured):
+    self.dRel, self.yRel, self.vRel, self.vLead = d_rel, y_rel, v_rel, v_lead
+    if self.cnt > 0:
+      self.kf.update(self.vLead)
+    self.vLeadK = float(self.kf.x[0][0])
+    self.aLeadK = float(self.kf.x[1][0])
+    if abs(self.aLeadK) < 0.5:
+      self.aLeadTau.x = _LEAD_ACCEL_TAU
+    else:
+      self.aLeadTau.update(0.0)
+    self.cnt += 1
+
+
+def match_vision_to_track(v_ego, lead, tracks):
+  # the per lead matching radard used before the cost matrix, as a reference
+  def laplacian_pdf(x, mu, b):
+    return math.exp(-abs(x - mu) / max(b, 1e-4))
+
+  offset_vision_dist = lead.x[0] - RADAR_TO_CAMERA
+  def prob(slot):
+    d_rel, y_rel, v_rel = tracks[slot]
+    return laplacian_pdf(d_rel, offset_vision_dist, lead.xStd[0]) * laplacian_pdf(y_rel, -lead.y[0], lead.yStd[0]) * \
+           laplacian_pdf(v_rel + v_ego, lead.v[0], lead.vStd[0])
+
+  slot = max(range(len(tracks)), key=prob)
+  d_rel, _, v_rel = tracks[slot]
+  dist_sane = abs(d_rel - offset_vision_dist) < max([(offset_vision_dist)*.25, 5.0])
+  vel_sane = (abs(v_rel + v_ego - lead.v[0]) < 10) or (v_ego + v_rel > 3)
+  return slot if dist_sane and vel_sane else None
+
+
+class FakeSubMaster:
+  def __init__(self, v_ego=10.):
+    cs = messaging.new_message('carState')
+    cs.carState.vEgo = v_ego
+    model = messaging.new_message('modelV2')
+    model.modelV2.init('leadsV3', 3)
+    for lead in model.modelV2.leadsV3:
+      lead.prob = 1.
+      lead.x, lead.y, lead.v, lead.a = [20.], [0.], [10.], [0.]
+      lead.xStd, lead.yStd, lead.vStd = [1.], [1.], [1.]
+    self.data = {'carState': cs.carState, 'modelV2': model.modelV2}
+    self.seen = {'modelV2': True}
+    self.logMonoTime = {'modelV2': 1, 'carState': 1}
+    self.recv_frame = {'carState': 1}
+
+  def __getitem__(self, s):
+    return self.data[s]
+
+  def all_checks(self):
+    return True
+
+
+def brute_force_assignment(costs):
+  # best assignment of each lead in priority order, the leads before it are matched first
+  best, best_key = None, None
+  for assignment in itertools.product(*[[None] + list(range(costs.shape[1]))] * costs.shape[0]):
+    matched = [(i, slot) for i, slot in enumerate(assignment) if slot is not None]
+    if len({slot for _, slot in matched}) != len(matched) or any(np.isinf(costs[i, slot]) for i, slot in matched):
+      continue
+    key = [(0, costs[i, slot]) if slot is not None else (1, 0.) for i, slot in enumerate(assignment)]
+    if best_key is None or key < best_key:
+      best, best_key = list(assignment), key
+  return best
+
+
+class TestTracks:
+  def test_empty(self):
+    tracks = Tracks(KalmanParams(DT_MDL))
+    tracks.update({}, 10.)
+    assert len(tracks) == 0 and tracks.data.shape == (0, 8)
+
+    # all tracks gone
+    tracks.update({1: (20., 0., -1., True)}, 10.)
+    tracks.update({}, 10.)
+    assert len(tracks) == 0 and tracks.data.shape == (0, 8)
+    assert tracks.closest_low_speed_lead(1.) is None
+
+    rd = RadarD()
+    rd.update(FakeSubMaster(), car.RadarData.new_message())
+    assert not rd.radar_state.leadOne.radar and not rd.radar_state.leadTwo.radar
+
+  def test_matches_per_track_filters(self):
+    rng = np.random.default_rng(0)
+    kalman_params = KalmanParams(DT_MDL)
+    tracks = Tracks(kalman_params)
+    reference: dict[int, Track] = {}
+    for _ in range(1000):
+      v_ego = rng.uniform(0., 30.)
+      ids = rng.choice(32, size=rng.integers(0, 32), replace=False)
+      points = {int(i): (rng.uniform(0., 150.), rng.uniform(-10., 10.), rng.normal(0., 5.), bool(rng.random() < .5)) for i in ids}
+
+      tracks.update(points, v_ego)
+      reference = {i: reference[i] for i in reference if i in points}
+      for i, pt in points.items():
+        if i not in reference:
+          reference[i] = Track(pt[2] + v_ego, kalman_params)
+        reference[i].update(pt[0], pt[1], pt[2], pt[2] + v_ego, pt[3])
+
+      assert tracks.identifiers == list(reference)
+      for slot, track in enumerate(reference.values()):
+        state = tracks.get_RadarState(slot)
+        assert (state['dRel'], state['yRel'], state['vRel'], state['vLead']) == (track.dRel, track.yRel, track.vRel, track.vLead)
+        assert (state['vLeadK'], state['aLeadK'], state['aLeadTau']) == (track.vLeadK, track.aLeadK, track.aLeadTau.x)
+
+
+class TestAssociation:
+  def test_independent(self):
+    costs = np.array([[1., 0.5, np.inf], [0.2, 0.3, 1.], [np.inf, np.inf, np.inf]])
+    assert assign_independent(costs) == [1, 0, None]
+    assert assign_independent(np.zeros((3, 0))) == [None, None, None]
+
+  def test_no_track_used_twice(self):
+    # both leads prefer track 0, the second lead gets the best remaining track
+    costs = np.array([[0.1, 5.], [0.2, 1.]])
+    assert assign_independent(costs) == [0, 0]
+    assert assign_global(costs) == [0, 1]
+
+    costs = np.array([[0.1, np.inf], [0.2, 10.]])
+    assert assign_global(costs) == [0, 1]
+
+  def test_lead_one_priority(self):
+    # leadOne keeps its only sane track, even if it's a better match for leadTwo
+    assert assign_global(np.array([[5.], [np.inf]])) == [0, None]
+    assert assign_global(np.array([[5.], [1.]])) == [0, None]
+    assert assign_global(np.array([[np.inf], [1.]])) == [None, 0]
+    assert assign_global(np.zeros((2, 0))) == [None, None]
+
+    # only the published leads are associated
+    rd = RadarD(global_association=True)
+    sm = FakeSubMaster()
+    rr = car.RadarData.new_message()
+    rr.points = [{'trackId': 1, 'dRel': 20. - 1.52, 'yRel': 0., 'vRel': 0., 'measured': True}]
+    for _ in range(2):
+      rd.update(sm, rr)
+    assert rd.radar_state.leadOne.radar and rd.radar_state.leadOne.radarTrackId == 1
+    assert not rd.radar_state.leadTwo.radar
+
+  def test_priority_order(self):
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+      costs = rng.exponential(size=(rng.integers(1, 3), rng.integers(0, 7)))
+      costs[rng.random(costs.shape) < 0.4] = np.inf
+      assert assign_global(costs) == brute_force_assignment(costs)
+
+  def test_matches_per_lead_matching(self):
+    # by default each lead gets its own most likely track, gated afterwards, as in the process replay references
+    rng = np.random.default_rng(0)
+    tracks = Tracks(KalmanParams(DT_MDL))
+    for _ in range(1000):
+      v_ego = rng.uniform(0., 30.)
+      points = {i: (rng.uniform(0., 100.), rng.uniform(-5., 5.), rng.normal(0., 5.), True) for i in range(rng.integers(1, 16))}
+      tracks.update(points, v_ego)
+
+      model = messaging.new_message('modelV2').modelV2
+      leads = model.init('leadsV3', 2)
+      for lead in leads:
+        lead.prob = rng.uniform(0.4, 1.)
+        lead.x, lead.y, lead.v = [rng.uniform(0., 100.)], [rng.uniform(-5., 5.)], [rng.uniform(0., 30.)]
+        # small stds make the likelihoods of all tracks underflow
+        lead.xStd, lead.yStd, lead.vStd = ([rng.choice([1e-3, 1.])] for _ in range(3))
+
+      slots = assign_independent(lead_track_costs(v_ego, True, list(leads), tracks, gate_all=False))
+      expected = [match_vision_to_track(v_ego, lead, [points[i][:3] for i in tracks.identifiers]) if lead.prob > .5 else None for lead in leads]
+      assert slots == expected
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+import argparse
+import numpy as np
+import tempfile
+import time
+
+from openpilot.tools.lib.synthetic_hevc import make_hevc_stream
+from openpilot.tools.lib.vidindex import hevc_index, hevc_index_slow
+
+N_RUNS = 5
+
+
+def benchmark(func, fn):
+  ets = []
+  for _ in range(N_RUNS):
+    start_t = time.process_time_ns()
+    func(fn)
+    ets.append((time.process_time_ns() - start_t) * 1e-6)
+  return ets
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Compare hevc_index against the reference implementation")
+  parser.add_argument("--frames", type=int, default=1200, help="number of frames in the synthetic stream (1 min at 20 fps)")
+  parser.add_argument("--slices", type=int, default=1, help="slices per frame")
+  parser.add_argument("--slice-size", type=int, default=30_000, help="average slice size in bytes")
+  parser.add_argument("--file", help="index an existing .hevc file instead of a synthetic stream")
+  args = parser.parse_args()
+
+  with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+    fn = args.file
+    if fn is None:
+      f.write(make_hevc_stream(num_frames=args.frames, slices_per_frame=args.slices, payload_size=args.slice_size))
+      f.flush()
+      fn = f.name
+
+    assert hevc_index(fn) == hevc_index_slow(fn)
+    frame_types, dat_len, _ = hevc_index(fn)
+    print(f'{len(frame_types)} frames, {dat_len / 1e6:.2f} MB, {N_RUNS} runs')
+    for name, func in (("hevc_index_slow", hevc_index_slow), ("hevc_index", hevc_index)):
+      ets = benchmark(func, fn)
+      print(f'{name}: {np.mean(ets):.2f} mean ms, {max(ets):.2f} max ms, {min(ets):.2f} min ms, {np.std(ets):.2f} std ms')
@@ -254,35 +254,47 @@ class Calibrator:
     pm.send('liveCalibration', self.get_msg(valid))
 
 
+class CalibrationdRunner:
+  """State of the calibrationd main loop, stepped once per SubMaster update. Shared with the offline batch runner."""
+  def __init__(self, calibrator: Calibrator):
+    self.calibrator = calibrator
+
+  def step(self, sm: messaging.SubMaster) -> capnp.lib.capnp._DynamicStructBuilder | None:
+    self.calibrator.not_car = sm['carParams'].notCar
+
+    if sm.updated['cameraOdometry']:
+      self.calibrator.handle_v_ego(sm['carState'].vEgo)
+      new_rpy = self.calibrator.handle_cam_odom(sm['cameraOdometry'].trans,
+                                                sm['cameraOdometry'].rot,
+                                                sm['cameraOdometry'].wideFromDeviceEuler,
+                                                sm['cameraOdometry'].transStd,
+                                                sm['cameraOdometry'].roadTransformTrans,
+                                                sm['cameraOdometry'].roadTransformTransStd)
+
+      if DEBUG and new_rpy is not None:
+        print('got new rpy', new_rpy)
+
+    # 4Hz driven by cameraOdometry
+    if sm.frame % 5 == 0:
+      return self.calibrator.get_msg(sm.all_checks())
+    return None
+
+
 def main() -> NoReturn:
   config_realtime_process([0, 1, 2, 3], 5)
 
   pm = messaging.PubMaster(['liveCalibration'])
   sm = messaging.SubMaster(['cameraOdometry', 'carState', 'carParams'], poll='cameraOdometry')
 
-  calibrator = Calibrator(param_put=True)
+  runner = CalibrationdRunner(Calibrator(param_put=True))
 
   while 1:
     timeout = 0 if sm.frame == -1 else 100
     sm.update(timeout)
 
-    calibrator.not_car = sm['carParams'].notCar
-
-    if sm.updated['cameraOdometry']:
-      calibrator.handle_v_ego(sm['carState'].vEgo)
-      new_rpy = calibrator.handle_cam_odom(sm['cameraOdometry'].trans,
-                                           sm['cameraOdometry'].rot,
-                                           sm['cameraOdometry'].wideFromDeviceEuler,
-                                           sm['cameraOdometry'].transStd,
-                                           sm['cameraOdometry'].roadTransformTrans,
-                                           sm['cameraOdometry'].roadTransformTransStd)
-
-      if DEBUG and new_rpy is not None:
-        print('got new rpy', new_rpy)
-
-    # 4Hz driven by cameraOdometry
-    if sm.frame % 5 == 0:
-      calibrator.send_data(pm, sm.all_checks())
+    msg = runner.step(sm)
+    if msg is not None:
+      pm.send('liveCalibration', msg)
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@ import numpy as np
 from typing import Any
 
 from cereal import log
-from openpilot.common.transformations.orientation import rot_from_euler, euler_from_rot
+from openpilot.common.transformations.calibration import calib_from_device, ned_from_calib, rotate_points, rotate_stds
 
 
 def rotate_cov(rot_matrix, cov_in):
@@ -10,23 +10,42 @@ def rotate_cov(rot_matrix, cov_in):
 
 
 def rotate_std(rot_matrix, std_in):
-  return np.sqrt(np.diag(rotate_cov(rot_matrix, np.diag(std_in**2))))
+  return rotate_stds(rot_matrix, std_in)
 
 
 class NPQueue:
+  """
+  Fixed size FIFO of rows with O(1) append. Every row is written twice, maxlen apart, so the rows in order are
+  always a contiguous slice of the buffer and arr is a view, valid until the next append.
+  """
   def __init__(self, maxlen: int, rowsize: int) -> None:
     self.maxlen = maxlen
-    self.arr = np.empty((0, rowsize))
+    self.buf = np.empty((2 * maxlen, rowsize))
+    self.start = 0
+    self.len = 0
 
   def __len__(self) -> int:
-    return len(self.arr)
-
-  def append(self, pt: list[float]) -> None:
-    if len(self.arr) < self.maxlen:
-      self.arr = np.append(self.arr, [pt], axis=0)
+    return self.len
+
+  @property
+  def arr(self) -> np.ndarray:
+    return self.buf[self.start:self.start + self.len]
+
+  def append(self, pt: list[float]) -> np.ndarray | None:
+    # returns the evicted row once full
+    evicted = None
+    if self.len < self.maxlen:
+      idx = self.start + self.len
+      if idx >= self.maxlen:
+        idx -= self.maxlen
+      self.len += 1
     else:
-      self.arr[:-1] = self.arr[1:]
-      self.arr[-1] = pt
+      idx = self.start
+      evicted = self.buf[idx].copy()
+      self.start = idx + 1 if idx + 1 < self.maxlen else 0
+    self.buf[idx] = pt
+    self.buf[idx + self.maxlen] = pt
+    return evicted
 
 
 class PointBuckets:
@@ -111,29 +130,20 @@ class Pose:
 class PoseCalibrator:
   def __init__(self):
     self.calib_valid = False
+    self.calib_rpy = np.zeros(3)
     self.calib_from_device = np.eye(3)
 
-  def _transform_calib_from_device(self, meas: Measurement):
-    new_xyz = self.calib_from_device @ meas.xyz
-    new_xyz_std = rotate_std(self.calib_from_device, meas.xyz_std)
-    return Measurement(new_xyz, new_xyz_std)
-
-  def _ned_from_calib(self, orientation: Measurement):
-    ned_from_device = rot_from_euler(orientation.xyz)
-    ned_from_calib = ned_from_device @ self.calib_from_device.T
-    ned_from_calib_euler_meas = Measurement(euler_from_rot(ned_from_calib), np.full(3, np.nan))
-    return ned_from_calib_euler_meas
-
   def build_calibrated_pose(self, pose: Pose) -> Pose:
-    ned_from_calib_euler = self._ned_from_calib(pose.orientation)
-    angular_velocity_calib = self._transform_calib_from_device(pose.angular_velocity)
-    acceleration_calib = self._transform_calib_from_device(pose.acceleration)
-    velocity_calib = self._transform_calib_from_device(pose.angular_velocity)
+    ned_from_calib_euler = Measurement(ned_from_calib(pose.orientation.xyz, self.calib_rpy), np.full(3, np.nan))
+    # all the device frame measurements rotated at once
+    device = [pose.angular_velocity, pose.acceleration, pose.angular_velocity]
+    xyz = rotate_points(self.calib_from_device, [m.xyz for m in device])
+    xyz_std = rotate_stds(self.calib_from_device, [m.xyz_std for m in device])
+    angular_velocity_calib, acceleration_calib, velocity_calib = (Measurement(x, x_std) for x, x_std in zip(xyz, xyz_std, strict=True))
 
     return Pose(ned_from_calib_euler, velocity_calib, acceleration_calib, angular_velocity_calib)
 
   def feed_live_calib(self, live_calib: log.LiveCalibrationData):
-    calib_rpy = np.array(live_calib.rpyCalib)
-    device_from_calib = rot_from_euler(calib_rpy)
-    self.calib_from_device = device_from_calib.T
+    self.calib_rpy = np.array(live_calib.rpyCalib)
+    self.calib_from_device = calib_from_device(self.calib_rpy)
     self.calib_valid = live_calib.calStatus == log.LiveCalibrationData.Status.calibrated
@@ -9,7 +9,7 @@ from collections import defaultdict
 
 from cereal import log, messaging
 from cereal.services import SERVICE_LIST
-from openpilot.common.transformations.orientation import rot_from_euler
+from openpilot.common.transformations.calibration import device_from_calib
 from openpilot.common.realtime import config_realtime_process
 from openpilot.common.params import Params
 from openpilot.common.swaglog import cloudlog
@@ -153,7 +153,7 @@ class LocationEstimator:
         if calib.min() < -CALIB_RPY_SANITY_CHECK or calib.max() > CALIB_RPY_SANITY_CHECK:
           return HandleLogResult.INPUT_INVALID
 
-        self.device_from_calib = rot_from_euler(calib)
+        self.device_from_calib = device_from_calib(calib)
 
     elif which == "cameraOdometry":
       if not self._validate_timestamp(t):
@@ -254,6 +254,63 @@ def sensor_all_checks(acc_msgs, gyro_msgs, sensor_valid, sensor_recv_time, senso
   return all(sensor_alive.values()) and all(sensor_valid.values())
 
 
+class LocationdRunner:
+  """State of the locationd main loop, stepped once per SubMaster update. Shared with the offline batch runner."""
+  def __init__(self, estimator, simulation=False):
+    self.estimator = estimator
+    self.simulation = simulation
+    self.sensor_alive, self.sensor_valid, self.sensor_recv_time = defaultdict(bool), defaultdict(bool), defaultdict(float)
+
+    self.filter_initialized = False
+    self.critcal_services = ["accelerometer", "gyroscope", "cameraOdometry"]
+    self.observation_input_invalid = defaultdict(int)
+
+    self.input_invalid_limit = {s: round(INPUT_INVALID_LIMIT * (SERVICE_LIST[s].frequency / 20.)) for s in self.critcal_services}
+    self.input_invalid_threshold = {s: self.input_invalid_limit[s] - 0.5 for s in self.critcal_services}
+    self.input_invalid_decay = {s: calculate_invalid_input_decay(self.input_invalid_limit[s], INPUT_INVALID_RECOVERY, SERVICE_LIST[s].frequency)
+                                for s in self.critcal_services}
+
+  def step(self, sm, acc_msgs, gyro_msgs):
+    if self.filter_initialized:
+      msgs = []
+      for msg in acc_msgs + gyro_msgs:
+        t, valid, which, data = msg.logMonoTime, msg.valid, msg.which(), getattr(msg, msg.which())
+        msgs.append((t, valid, which, data))
+      for which, updated in sm.updated.items():
+        if not updated:
+          continue
+        t, valid, data = sm.logMonoTime[which], sm.valid[which], sm[which]
+        msgs.append((t, valid, which, data))
+
+      for log_mono_time, valid, which, msg in sorted(msgs, key=lambda x: x[0]):
+        if valid:
+          t = log_mono_time * 1e-9
+          res = self.estimator.handle_log(t, which, msg)
+          if which not in self.critcal_services:
+            continue
+
+          if res == HandleLogResult.TIMING_INVALID:
+            cloudlog.warning(f"Observation {which} ignored due to failed timing check")
+            self.observation_input_invalid[which] += 1
+          elif res == HandleLogResult.INPUT_INVALID:
+            cloudlog.warning(f"Observation {which} ignored due to failed sanity check")
+            self.observation_input_invalid[which] += 1
+          elif res == HandleLogResult.SUCCESS:
+            self.observation_input_invalid[which] *= self.input_invalid_decay[which]
+    else:
+      self.filter_initialized = sm.all_checks() and sensor_all_checks(acc_msgs, gyro_msgs, self.sensor_valid, self.sensor_recv_time,
+                                                                     self.sensor_alive, self.simulation)
+
+    if not sm.updated["cameraOdometry"]:
+      return None
+
+    critical_service_inputs_valid = all(self.observation_input_invalid[s] < self.input_invalid_threshold[s] for s in self.critcal_services)
+    inputs_valid = sm.all_valid() and critical_service_inputs_valid
+    sensors_valid = sensor_all_checks(acc_msgs, gyro_msgs, self.sensor_valid, self.sensor_recv_time, self.sensor_alive, self.simulation)
+
+    return self.estimator.get_msg(sensors_valid, inputs_valid, self.filter_initialized)
+
+
 def main():
   config_realtime_process([0, 1, 2, 3], 5)
 
@@ -264,20 +321,11 @@ def main():
   sm = messaging.SubMaster(['carState', 'liveCalibration', 'cameraOdometry'], poll='cameraOdometry')
   # separate sensor sockets for efficiency
   sensor_sockets = [messaging.sub_sock(which, timeout=20) for which in ['accelerometer', 'gyroscope']]
-  sensor_alive, sensor_valid, sensor_recv_time = defaultdict(bool), defaultdict(bool), defaultdict(float)
 
   params = Params()
 
   estimator = LocationEstimator(DEBUG)
 
-  filter_initialized = False
-  critcal_services = ["accelerometer", "gyroscope", "cameraOdometry"]
-  observation_input_invalid = defaultdict(int)
-
-  input_invalid_limit = {s: round(INPUT_INVALID_LIMIT * (SERVICE_LIST[s].frequency / 20.)) for s in critcal_services}
-  input_invalid_threshold = {s: input_invalid_limit[s] - 0.5 for s in critcal_services}
-  input_invalid_decay = {s: calculate_invalid_input_decay(input_invalid_limit[s], INPUT_INVALID_RECOVERY, SERVICE_LIST[s].frequency) for s in critcal_services}
-
   initial_pose = params.get("LocationFilterInitialState")
   if initial_pose is not None:
     initial_pose = json.loads(initial_pose)
@@ -285,46 +333,15 @@ def main():
     P_initial = np.diag(np.array(initial_pose["P"], dtype=np.float64))
     estimator.reset(None, x_initial, P_initial)
 
+  runner = LocationdRunner(estimator, SIMULATION)
+
   while True:
     sm.update()
 
     acc_msgs, gyro_msgs = (messaging.drain_sock(sock) for sock in sensor_sockets)
 
-    if filter_initialized:
-      msgs = []
-      for msg in acc_msgs + gyro_msgs:
-        t, valid, which, data = msg.logMonoTime, msg.valid, msg.which(), getattr(msg, msg.which())
-        msgs.append((t, valid, which, data))
-      for which, updated in sm.updated.items():
-        if not updated:
-          continue
-        t, valid, data = sm.logMonoTime[which], sm.valid[which], sm[which]
-        msgs.append((t, valid, which, data))
-
-      for log_mono_time, valid, which, msg in sorted(msgs, key=lambda x: x[0]):
-        if valid:
-          t = log_mono_time * 1e-9
-          res = estimator.handle_log(t, which, msg)
-          if which not in critcal_services:
-            continue
-
-          if res == HandleLogResult.TIMING_INVALID:
-            cloudlog.warning(f"Observation {which} ignored due to failed timing check")
-            observation_input_invalid[which] += 1
-          elif res == HandleLogResult.INPUT_INVALID:
-            cloudlog.warning(f"Observation {which} ignored due to failed sanity check")
-            observation_input_invalid[which] += 1
-          elif res == HandleLogResult.SUCCESS:
-            observation_input_invalid[which] *= input_invalid_decay[which]
-    else:
-      filter_initialized = sm.all_checks() and sensor_all_checks(acc_msgs, gyro_msgs, sensor_valid, sensor_recv_time, sensor_alive, SIMULATION)
-
-    if sm.updated["cameraOdometry"]:
-      critical_service_inputs_valid = all(observation_input_invalid[s] < input_invalid_threshold[s] for s in critcal_services)
-      inputs_valid = sm.all_valid() and critical_service_inputs_valid
-      sensors_valid = sensor_all_checks(acc_msgs, gyro_msgs, sensor_valid, sensor_recv_time, sensor_alive, SIMULATION)
-
-      msg = estimator.get_msg(sensors_valid, inputs_valid, filter_initialized)
+    msg = runner.step(sm, acc_msgs, gyro_msgs)
+    if msg is not None:
       pm.send("livePose", msg)
 
 
@@ -0,0 +1,55 @@
+from collections import deque
+
+import numpy as np
+
+from cereal import car
+from openpilot.selfdrive.locationd.helpers import NPQueue
+from openpilot.selfdrive.locationd.torqued import TorqueEstimator, FIT_POINTS_TOTAL, FRICTION_FACTOR, POINTS_PER_BUCKET, STEER_BUCKET_BOUNDS, \
+                                                  slope2rot
+
+
+def svd_estimate(points):
+  # reference total least squares fit of the points
+  _, _, v = np.linalg.svd(points, full_matrices=False)
+  slope, offset = -v.T[0:2, 2] / v.T[2, 2]
+  _, spread = np.matmul(points[:, [0, 2]], slope2rot(slope)).T
+  return slope, offset, np.std(spread) * FRICTION_FACTOR
+
+
+class TestNPQueue:
+  def test_fifo(self):
+    for maxlen in (1, 3, 10):
+      q, ref = NPQueue(maxlen, 2), deque(maxlen=maxlen)
+      for i in range(5 * maxlen):
+        pt = [i, -i]
+        evicted = q.append(pt)
+        if len(ref) == maxlen:
+          assert np.array_equal(evicted, ref[0])
+        else:
+          assert evicted is None
+        ref.append(pt)
+
+        assert len(q) == len(ref)
+        assert np.array_equal(q.arr, np.array(ref))
+        assert np.shares_memory(q.arr, q.buf)
+
+
+class TestTorqueEstimator:
+  def test_estimate_params(self):
+    CP = car.CarParams.new_message()
+    est = TorqueEstimator(CP)
+    np.random.seed(0)
+
+    # several times the bucket size, so the ring buffers wrap around
+    for i in range(3 * POINTS_PER_BUCKET * len(STEER_BUCKET_BOUNDS)):
+      steer = np.random.uniform(STEER_BUCKET_BOUNDS[0][0], STEER_BUCKET_BOUNDS[-1][1])
+      lateral_acc = 2.5 * steer + 0.1 + 0.3 * np.sign(steer) + np.random.normal(scale=0.2)
+      est.filtered_points.add_point(steer, lateral_acc)
+
+      if i % 5000 == 4999:
+        # fit on a random subsample of the bucket points
+        np.random.seed(i)
+        points = est.filtered_points.get_points(FIT_POINTS_TOTAL)
+        assert len(points) == FIT_POINTS_TOTAL
+        np.random.seed(i)
+        assert est.estimate_params() == svd_estimate(points)
@@ -237,31 +237,49 @@ class TorqueEstimator(ParameterEstimator):
     return msg
 
 
-def main(demo=False):
-  config_realtime_process([0, 1, 2, 3], 5)
+class TorquedRunner:
+  """State of the torqued main loop, stepped once per SubMaster update. Shared with the offline batch runner."""
+  def __init__(self, estimator, params=None):
+    self.estimator = estimator
+    self.params = params  # caches points in LiveTorqueParameters if set
 
-  pm = messaging.PubMaster(['liveTorqueParameters'])
-  sm = messaging.SubMaster(['carControl', 'carOutput', 'carState', 'liveCalibration', 'livePose'], poll='livePose')
-
-  params = Params()
-  estimator = TorqueEstimator(messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams))
-
-  while True:
-    sm.update()
+  def step(self, sm):
     if sm.all_checks():
       for which in sm.updated.keys():
         if sm.updated[which]:
           t = sm.logMonoTime[which] * 1e-9
-          estimator.handle_log(t, which, sm[which])
+          self.estimator.handle_log(t, which, sm[which])
 
     # 4Hz driven by livePose
+    msg = None
     if sm.frame % 5 == 0:
-      pm.send('liveTorqueParameters', estimator.get_msg(valid=sm.all_checks()))
+      msg = self.estimator.get_msg(valid=sm.all_checks())
 
     # Cache points every 60 seconds while onroad
+    # get_msg also steps the parameter filters, so it still runs without params, only the points are skipped
     if sm.frame % 240 == 0:
-      msg = estimator.get_msg(valid=sm.all_checks(), with_points=True)
-      params.put_nonblocking("LiveTorqueParameters", msg.to_bytes())
+      points_msg = self.estimator.get_msg(valid=sm.all_checks(), with_points=self.params is not None)
+      if self.params is not None:
+        self.params.put_nonblocking("LiveTorqueParameters", points_msg.to_bytes())
+
+    return msg
+
+
+def main(demo=False):
+  config_realtime_process([0, 1, 2, 3], 5)
+
+  pm = messaging.PubMaster(['liveTorqueParameters'])
+  sm = messaging.SubMaster(['carControl', 'carOutput', 'carState', 'liveCalibration', 'livePose'], poll='livePose')
+
+  params = Params()
+  estimator = TorqueEstimator(messaging.log_from_bytes(params.get("CarParams", block=True), car.CarParams))
+  runner = TorquedRunner(estimator, params)
+
+  while True:
+    sm.update()
+    msg = runner.step(sm)
+    if msg is not None:
+      pm.send('liveTorqueParameters', msg)
 
 
 if __name__ == "__main__":
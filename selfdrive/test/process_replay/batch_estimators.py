@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import os
+import heapq
+import argparse
+import itertools
+from collections import deque
+from functools import partial
+
+import capnp
+
+import cereal.messaging as messaging
+from cereal import car
+from openpilot.common.params import Params
+from openpilot.common.prefix import OpenpilotPrefix
+from openpilot.selfdrive.locationd.calibrationd import Calibrator, CalibrationdRunner
+from openpilot.selfdrive.locationd.locationd import LocationEstimator, LocationdRunner
+from openpilot.selfdrive.locationd.paramsd import ParamsdRunner, retrieve_initial_vehicle_params
+from openpilot.selfdrive.locationd.torqued import TorqueEstimator, TorquedRunner
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import get_process_config
+from openpilot.tools.lib.logreader import LogIterable, LogReader, save_log
+
+# in dependency order, each one only consumes the outputs of the ones before it
+ESTIMATORS = ["calibrationd", "locationd", "paramsd", "torqued"]
+SUMMARY_FIELDS = {
+  "liveCalibration": ["calStatus", "rpyCalib", "height"],
+  "liveParameters": ["valid", "steerRatio", "stiffnessFactor", "angleOffsetAverageDeg"],
+  "liveTorqueParameters": ["liveValid", "latAccelFactorFiltered", "latAccelOffsetFiltered", "frictionCoefficientFiltered", "totalBucketPoints"],
+}
+
+
+def make_runner(name: str, CP: car.CarParams):
+  # same SubMaster and initial state as the daemon's main(), in a clean params dir like process_replay
+  if name == "calibrationd":
+    sm = messaging.SubMaster(['cameraOdometry', 'carState', 'carParams'], poll='cameraOdometry', addr=None)
+    return sm, CalibrationdRunner(Calibrator(param_put=False))
+  elif name == "locationd":
+    sm = messaging.SubMaster(['carState', 'liveCalibration', 'cameraOdometry'], poll='cameraOdometry', addr=None)
+    return sm, LocationdRunner(LocationEstimator(False), simulation=True)
+  elif name == "paramsd":
+    sm = messaging.SubMaster(['livePose', 'liveCalibration', 'carState'], poll='livePose', addr=None)
+    params, pInitial = retrieve_initial_vehicle_params(Params(), CP, True, False)
+    return sm, ParamsdRunner(CP, params, pInitial)
+  elif name == "torqued":
+    sm = messaging.SubMaster(['carControl', 'carOutput', 'carState', 'liveCalibration', 'livePose'], poll='livePose', addr=None)
+    return sm, TorquedRunner(TorqueEstimator(CP))
+  raise ValueError(f"unknown estimator {name}, expected one of {ESTIMATORS}")
+
+
+class EstimatorProcess:
+  """
+  Steps an estimator's main loop in-process, on the same cycles process_replay would run the real daemon:
+  messages are queued until the process config's should_recv_callback ends a cycle, then the SubMaster is
+  updated with the latest message of each service, as its conflated sockets would receive them.
+  """
+  def __init__(self, name: str, CP: car.CarParams):
+    self.cfg = get_process_config(name)
+    self.sm, self.runner = make_runner(name, CP)
+    self.sm.simulation = self.cfg.simulation
+    # locationd drains the sensor sockets instead of conflating them
+    self.drained = {s: [] for s in self.cfg.unlocked_pubs}
+    self.latest: dict[str, capnp._DynamicStructReader] = {}
+    self.cnt = 0
+
+  @property
+  def has_empty_queue(self) -> bool:
+    return len(self.latest) == 0 and not any(self.drained.values())
+
+  def run_step(self, msg: capnp._DynamicStructReader) -> list[capnp._DynamicStructReader]:
+    end_of_cycle = True
+    if self.cfg.should_recv_callback is not None:
+      end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+    which = msg.which()
+    if which in self.drained:
+      self.drained[which].append(msg)
+    else:
+      self.latest[which] = msg
+
+    if not end_of_cycle:
+      return []
+
+    self.sm.update_msgs(msg.logMonoTime * 1e-9, list(self.latest.values()))
+    if self.drained:
+      out = self.runner.step(self.sm, *self.drained.values())
+    else:
+      out = self.runner.step(self.sm)
+    self.latest = {}
+    self.drained = {s: [] for s in self.drained}
+    self.cnt += 1
+
+    if out is None:
+      return []
+    out.logMonoTime = msg.logMonoTime + int(self.cfg.processing_time * 1e9)
+    return [out.as_reader()]
+
+
+def run_estimators(lr: LogIterable, names: list[str] = ESTIMATORS, CP=None) -> list[capnp._DynamicStructReader]:
+  """
+  In-process equivalent of replay_process(names, lr) for the estimators, without spawning daemons or
+  sending anything over sockets. Estimators run together feed each other, like in process_replay.
+  """
+  all_msgs = sorted(migrate_all(lr, manager_states=True), key=lambda m: m.logMonoTime)
+  if CP is None:
+    CP = next((m.carParams for m in all_msgs if m.which() == "carParams"), None)
+    assert CP is not None, "carParams is required, pass CP for segments without one"
+
+  log_msgs = []
+  with OpenpilotPrefix():
+    processes = [EstimatorProcess(name, CP) for name in names]
+
+    all_pubs = {pub for p in processes for pub in p.cfg.pubs}
+    all_subs = {sub for p in processes for sub in p.cfg.subs}
+    lr_pubs = all_pubs - all_subs
+    pubs_to_processes = {pub: [p for p in processes if pub in p.cfg.pubs] for pub in all_pubs}
+
+    # same merge order as _replay_multi_process: log messages, and outputs republished by logMonoTime
+    external_pub_queue = deque(m for m in all_msgs if m.which() in lr_pubs)
+    internal_pub_heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+    push_order = itertools.count()
+    while len(external_pub_queue) != 0 or (len(internal_pub_heap) != 0 and not all(p.has_empty_queue for p in processes)):
+      if len(internal_pub_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_heap[0][0]):
+        msg = external_pub_queue.popleft()
+      else:
+        msg = heapq.heappop(internal_pub_heap)[2]
+
+      for p in pubs_to_processes[msg.which()]:
+        for m in p.run_step(msg):
+          if m.which() in all_pubs:
+            heapq.heappush(internal_pub_heap, (m.logMonoTime, next(push_order), m))
+          log_msgs.append(m)
+
+  return log_msgs
+
+
+def run_segment(names: list[str], CP_bytes: bytes | None, lr: LogIterable) -> list[bytes]:
+  # runs in a LogReader worker, capnp readers don't pickle
+  CP = messaging.log_from_bytes(CP_bytes, car.CarParams) if CP_bytes is not None else None
+  return [m.as_builder().to_bytes() for m in run_estimators(lr, names, CP)]
+
+
+def summarize(log_msgs: LogIterable) -> dict[str, dict]:
+  last = {}
+  for m in log_msgs:
+    if m.which() in SUMMARY_FIELDS:
+      last[m.which()] = getattr(m, m.which())
+  return {which: {f: getattr(msg, f) for f in SUMMARY_FIELDS[which]} for which, msg in last.items()}
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Run the locationd, paramsd, torqued and calibrationd estimators over segments in parallel",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("route", help="The route or segment range to run over")
+  parser.add_argument("--process", nargs='+', default=ESTIMATORS, choices=ESTIMATORS, help="The estimator(s) to run")
+  parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="Number of segments run in parallel")
+  parser.add_argument("--save", help="Directory to save the outputs of each segment to")
+  args = parser.parse_args()
+
+  lr = LogReader(args.route, sort_by_time=True)
+  CP = lr.first("carParams")
+  CP_bytes = CP.as_builder().to_bytes() if CP is not None else None
+  names = [n for n in ESTIMATORS if n in args.process]
+
+  segment_outputs = lr.imap_segments(args.jobs, partial(run_segment, names, CP_bytes), desc="Segments")
+  for i, (seg, outputs) in enumerate(zip(lr.logreader_identifiers, segment_outputs, strict=True)):
+    log_msgs = [messaging.log_from_bytes(dat) for dat in outputs]
+    print(seg)
+    for which, fields in summarize(log_msgs).items():
+      print(f"  {which}: " + ", ".join(f"{k}={v}" for k, v in fields.items()))
+
+    if args.save is not None:
+      os.makedirs(args.save, exist_ok=True)
+      save_log(os.path.join(args.save, f"{i}_{'_'.join(names)}.zst"), log_msgs)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+from collections import deque
+
+import numpy as np
+
+# set for the replayed processes like process_replay does, the daemons read them at import
+os.environ["REPLAY"] = "1"
+os.environ["SIMULATION"] = "1"
+
+from cereal import car
+from opendbc.car.car_helpers import get_car, interfaces
+from opendbc.safety import ALTERNATIVE_EXPERIENCE
+from openpilot.common.params import Params
+from openpilot.common.prefix import OpenpilotPrefix
+from openpilot.selfdrive.car.card import Car, can_comm_callbacks
+from openpilot.selfdrive.controls.controlsd import Controls
+from openpilot.selfdrive.selfdrived.selfdrived import SelfdriveD
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import PROC_REPLAY_DIR, DummySocket, generate_environ_config, \
+                                                                   generate_params_config, get_process_config
+from openpilot.selfdrive.test.process_replay.test_processes import segments
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+DAEMONS = ["card", "selfdrived", "controlsd"]
+SCENARIOS = ["HYUNDAI", "TOYOTA", "HONDA", "SUBARU"]
+# sockets the daemons read directly instead of through their SubMaster
+RAW_SOCKETS = {"card": {"can": "can_sock"}, "selfdrived": {"carState": "car_state_sock"}}
+BASELINE = os.path.join(PROC_REPLAY_DIR, "control_loop_baseline.json")
+
+# regressions smaller than these are noise, whatever the relative change
+MIN_DELTA_MS = 0.01
+MIN_DELTA_KB = 1.
+
+
+class ReplaySocket:
+  """In-memory stand-in for a SubSocket or PubSocket, conflated sockets only keep the latest message"""
+  def __init__(self, conflate: bool = False):
+    self.queue: deque[bytes] = deque(maxlen=1 if conflate else None)
+
+  def receive(self, non_blocking: bool = False) -> bytes | None:
+    return self.queue.popleft() if len(self.queue) else None
+
+  def send(self, dat: bytes) -> None:
+    self.queue.append(dat)
+
+
+class ReplayPoller:
+  def __init__(self):
+    self.socks: list[ReplaySocket] = []
+
+  def registerSocket(self, sock: ReplaySocket) -> None:
+    self.socks.append(sock)
+
+  def poll(self, timeout: int) -> list[ReplaySocket]:
+    return [sock for sock in self.socks if len(sock.queue)]
+
+
+class GCMonitor:
+  """Times every garbage collection while entered, through gc.callbacks"""
+  def __init__(self):
+    self.pauses: list[tuple[int, int]] = []  # (generation, duration in ns)
+    self.start_t = 0
+
+  def __call__(self, phase: str, info: dict) -> None:
+    if phase == "start":
+      self.start_t = time.perf_counter_ns()
+    else:
+      self.pauses.append((info["generation"], time.perf_counter_ns() - self.start_t))
+
+  def __enter__(self):
+    gc.callbacks.append(self)
+    return self
+
+  def __exit__(self, *args):
+    gc.callbacks.remove(self)
+
+
+def step_card(card: Car) -> list[int]:
+  t0 = time.perf_counter_ns()
+  card.step()
+  return [time.perf_counter_ns() - t0]
+
+
+def step_selfdrived(sd: SelfdriveD) -> list[int]:
+  t0 = time.perf_counter_ns()
+  sd.step()
+  return [time.perf_counter_ns() - t0]
+
+
+def step_controlsd(controls: Controls) -> list[int]:
+  # same calls as Controls.run, timed separately
+  t0 = time.perf_counter_ns()
+  controls.update()
+  t1 = time.perf_counter_ns()
+  CC, lac_log = controls.state_control()
+  t2 = time.perf_counter_ns()
+  controls.publish(CC, lac_log)
+  t3 = time.perf_counter_ns()
+  return [t1 - t0, t2 - t1, t3 - t2]
+
+
+STEPS = {
+  "card": (step_card, ["step"]),
+  "selfdrived": (step_selfdrived, ["step"]),
+  "controlsd": (step_controlsd, ["update", "state_control", "publish"]),
+}
+
+
+def put_params(params_config: dict) -> None:
+  params = Params()
+  for k, v in params_config.items():
+    if isinstance(v, bool):
+      params.put_bool(k, v)
+    else:
+      params.put(k, v)
+
+
+def get_car_interface(can_msgs):
+  # fingerprints like process_replay's get_car_params_callback, and writes CarParams for the daemons
+  params = Params()
+  can, sendcan = DummySocket(), DummySocket()
+  for m in can_msgs[:300]:
+    can.send(m.as_builder().to_bytes())
+
+  cached_params = None
+  cached_params_raw = params.get("CarParamsCache")
+  if cached_params_raw is not None:
+    with car.CarParams.from_bytes(cached_params_raw) as _cached_params:
+      cached_params = _cached_params
+
+  CI = get_car(*can_comm_callbacks(can, sendcan), lambda obd: None, params.get_bool("ExperimentalLongitudinalEnabled"), cached_params=cached_params)
+  if not params.get_bool("DisengageOnAccelerator"):
+    CI.CP.alternativeExperience |= ALTERNATIVE_EXPERIENCE.DISABLE_DISENGAGE_ON_GAS
+  params.put("CarParams", CI.CP.to_bytes())
+  return CI
+
+
+def make_daemon(name: str, can_msgs):
+  CI = get_car_interface(can_msgs)
+  if name == "card":
+    return Car(CI, interfaces[CI.CP.carFingerprint].RadarInterface(CI.CP))
+  elif name == "selfdrived":
+    return SelfdriveD()
+  elif name == "controlsd":
+    return Controls()
+  raise ValueError(f"unknown daemon {name}, expected one of {DAEMONS}")
+
+
+def replace_sockets(name: str, daemon) -> dict[str, ReplaySocket]:
+  """Swaps the daemon's sockets for in-memory ones, returns the socket each service is received on"""
+  inputs = {}
+  sm = daemon.sm
+  sm.poller = ReplayPoller()
+  for s in sm.services:
+    sm.sock[s] = inputs[s] = ReplaySocket(conflate=True)
+    if s not in sm.non_polled_services:
+      sm.poller.registerSocket(sm.sock[s])
+
+  for s in daemon.pm.sock:
+    daemon.pm.sock[s] = ReplaySocket(conflate=True)
+
+  for s, attr in RAW_SOCKETS.get(name, {}).items():
+    inputs[s] = ReplaySocket()
+    setattr(daemon, attr, inputs[s])
+
+  if name == "card":
+    daemon.can_callbacks = can_comm_callbacks(daemon.can_sock, daemon.pm.sock['sendcan'])
+  return inputs
+
+
+def get_cycles(cfg, msgs) -> list[list[tuple[str, bytes]]]:
+  """Groups the logged inputs into the daemon's cycles, using the process config's should_recv_callback like process_replay"""
+  cycles = []
+  cycle = []
+  for msg in msgs:
+    if msg.which() not in cfg.pubs:
+      continue
+
+    cycle.append((msg.which(), msg.as_builder().to_bytes()))
+    if cfg.should_recv_callback is None or cfg.should_recv_callback(msg, cfg, len(cycles)):
+      cycles.append(cycle)
+      cycle = []
+  return cycles
+
+
+def run_daemon(name: str, cycles, params_config: dict, can_msgs, warmup: int, trace_allocations: bool) -> dict[str, np.ndarray]:
+  step, sections = STEPS[name]
+  with OpenpilotPrefix():
+    put_params(params_config)
+    daemon = make_daemon(name, can_msgs)
+    inputs = replace_sockets(name, daemon)
+
+    times, allocated, retained = [], [], []
+    gc.collect()
+    if trace_allocations:
+      tracemalloc.start()
+    with GCMonitor() as gc_monitor:
+      for i, cycle in enumerate(cycles):
+        if i == warmup:
+          gc_monitor.pauses.clear()
+        for s, dat in cycle:
+          inputs[s].send(dat)
+
+        if trace_allocations:
+          tracemalloc.reset_peak()
+          start_mem = tracemalloc.get_traced_memory()[0]
+          step(daemon)
+          mem, peak_mem = tracemalloc.get_traced_memory()
+          allocated.append(peak_mem - start_mem)
+          retained.append(mem - start_mem)
+        else:
+          times.append(step(daemon))
+    if trace_allocations:
+      tracemalloc.stop()
+
+  if trace_allocations:
+    return {'allocated': np.array(allocated[warmup:]), 'retained': np.array(retained[warmup:])}
+  return {'times': np.array(times[warmup:]).reshape(-1, len(sections)),
+          'gc_pauses': np.array(gc_monitor.pauses, dtype=np.int64).reshape(-1, 2)}
+
+
+def summarize_times(name: str, run: dict[str, np.ndarray]) -> dict[str, float]:
+  sections = STEPS[name][1]
+  times_ms = run['times'] * 1e-6
+  if len(sections) > 1:
+    times_ms = np.column_stack([times_ms, times_ms.sum(axis=1)])
+    sections = sections + ["step"]
+
+  metrics = {}
+  for section, t in zip(sections, times_ms.T, strict=True):
+    metrics[f"{section}.mean_ms"] = float(t.mean())
+    metrics[f"{section}.p50_ms"] = float(np.percentile(t, 50))
+    metrics[f"{section}.p99_ms"] = float(np.percentile(t, 99))
+    metrics[f"{section}.max_ms"] = float(t.max())
+
+  gc_pauses_ms = run['gc_pauses'][:, 1] * 1e-6
+  metrics["gc.collections"] = len(gc_pauses_ms)
+  metrics["gc.full_collections"] = int((run['gc_pauses'][:, 0] == 2).sum())
+  metrics["gc.total_ms"] = float(gc_pauses_ms.sum())
+  metrics["gc.max_ms"] = float(gc_pauses_ms.max()) if len(gc_pauses_ms) else 0.
+  return metrics
+
+
+def summarize_allocations(run: dict[str, np.ndarray]) -> dict[str, float]:
+  return {
+    "alloc.mean_kb": float(run['allocated'].mean() / 1024),
+    "alloc.p99_kb": float(np.percentile(run['allocated'], 99) / 1024),
+    "alloc.retained_kb": float(run['retained'].sum() / 1024),
+  }
+
+
+def benchmark_segment(lr, daemons: list[str], runs: int, warmup: int) -> dict[str, dict[str, float]]:
+  """
+  Steps each daemon in-process over the segment's logged inputs, on the cycles process_replay would run it.
+  Timings are the median of each metric over the runs, allocations are traced in a separate run since
+  tracemalloc slows down every allocation.
+  """
+  msgs = sorted(migrate_all(lr, manager_states=True, panda_states=True), key=lambda m: m.logMonoTime)
+  CP = next((m.carParams for m in msgs if m.which() == "carParams"), None)
+  assert CP is not None, "carParams is required to replay the control loop"
+  params_config = generate_params_config(lr=msgs, CP=CP)
+  for k, v in generate_environ_config(CP=CP).items():
+    if k == "PARAMS_ROOT":
+      continue  # the daemons get their own params in each OpenpilotPrefix
+    if len(v) != 0:
+      os.environ[k] = v
+    elif k in os.environ:
+      del os.environ[k]
+
+  can_msgs = [m for m in msgs if m.which() == "can"]
+  results = {}
+  for name in daemons:
+    cfg = get_process_config(name)
+    if cfg.config_callback is not None:
+      with OpenpilotPrefix():
+        put_params(params_config)
+        cfg.config_callback(Params(), cfg, msgs)
+    cycles = get_cycles(cfg, msgs)
+
+    timings = [summarize_times(name, run_daemon(name, cycles, params_config, can_msgs, warmup, False)) for _ in range(runs)]
+    metrics = {k: float(np.median([t[k] for t in timings])) for k in timings[0]}
+    metrics.update(summarize_allocations(run_daemon(name, cycles, params_config, can_msgs, warmup, True)))
+    metrics["steps"] = len(cycles) - warmup
+    results[name] = metrics
+  return results
+
+
+def min_delta(metric: str) -> float:
+  if metric.endswith("_ms"):
+    return MIN_DELTA_MS
+  elif metric.endswith("_kb"):
+    return MIN_DELTA_KB
+  return 1.
+
+
+def compare_to_baseline(baseline: dict, results: dict, tolerance: float) -> list[str]:
+  """Returns the metrics that got worse than the baseline by more than the relative tolerance, max times are too noisy to compare"""
+  regressions = []
+  for scenario, daemons in results.items():
+    for name, metrics in daemons.items():
+      base_metrics = baseline.get(scenario, {}).get(name, {})
+      for metric, value in metrics.items():
+        if metric not in base_metrics or metric == "steps" or "max" in metric:
+          continue
+
+        base = base_metrics[metric]
+        if value - base > max(tolerance * abs(base), min_delta(metric)):
+          change = f"{(value - base) / base:+.1%}" if base != 0 else "new"
+          regressions.append(f"{scenario} {name} {metric}: {base:.3f} -> {value:.3f} ({change})")
+  return regressions
+
+
+def report(name: str, metrics: dict[str, float]) -> None:
+  for section in STEPS[name][1] + (["step"] if len(STEPS[name][1]) > 1 else []):
+    print(f"  {name} {section}: {metrics[f'{section}.mean_ms']:.3f} mean ms, {metrics[f'{section}.p50_ms']:.3f} p50 ms, " +
+          f"{metrics[f'{section}.p99_ms']:.3f} p99 ms, {metrics[f'{section}.max_ms']:.3f} max ms")
+  print(f"  {name}: {int(metrics['steps'])} steps, {metrics['alloc.mean_kb']:.1f} kB allocated per step ({metrics['alloc.p99_kb']:.1f} p99), " +
+        f"{metrics['alloc.retained_kb']:.1f} kB retained, {int(metrics['gc.collections'])} gc pauses, {int(metrics['gc.full_collections'])} full " +
+        f"({metrics['gc.total_ms']:.3f} total ms, {metrics['gc.max_ms']:.3f} max ms)")
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Step times, allocations and gc pauses of the 100 Hz control loop daemons over logged segments, " +
+                                               "compared against a baseline from the same machine",
+                                   formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  parser.add_argument("--scenarios", nargs='+', default=SCENARIOS, help="process replay segments by car, or routes and segments")
+  parser.add_argument("--daemons", nargs='+', default=DAEMONS, choices=DAEMONS, help="daemons to step")
+  parser.add_argument("--runs", type=int, default=3, help="timed runs per daemon and scenario")
+  parser.add_argument("--warmup", type=int, default=100, help="steps left out of the results at the start of each run")
+  parser.add_argument("--baseline", default=BASELINE, help="json file with the results to compare against")
+  parser.add_argument("--tolerance", type=float, default=0.1, help="relative increase of a metric over the baseline reported as a regression")
+  parser.add_argument("--update-baseline", action="store_true", help="write the results to the baseline instead of comparing")
+  args = parser.parse_args()
+
+  process_replay_segments = dict(segments)
+  results = {}
+  for scenario in args.scenarios:
+    if scenario in process_replay_segments:
+      r, n = process_replay_segments[scenario].rsplit("--", 1)
+      lr = LogReader(get_url(r, n, "rlog.zst"))
+    else:
+      lr = LogReader(scenario)
+
+    print(scenario)
+    results[scenario] = benchmark_segment(lr, args.daemons, args.runs, args.warmup)
+    for name, metrics in results[scenario].items():
+      report(name, metrics)
+
+  baseline = {}
+  if os.path.exists(args.baseline):
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+
+  if args.update_baseline:
+    for scenario, daemons in results.items():
+      baseline.setdefault(scenario, {}).update(daemons)
+    with open(args.baseline, "w") as f:
+      json.dump(baseline, f, indent=2)
+    print(f"baseline written to {args.baseline}")
+  elif len(baseline) == 0:
+    print(f"no baseline at {args.baseline}, run with --update-baseline first")
+  else:
+    regressions = compare_to_baseline(baseline, results, args.tolerance)
+    print(f"{len(regressions)} regressions over {args.tolerance:.0%} tolerance")
+    for regression in regressions:
+      print(f"  {regression}")
+    sys.exit(len(regressions) > 0)
@@ -4,7 +4,10 @@ import math
 import capnp
 import numbers
 import dictdiffer
-from collections import Counter
+import multiprocessing
+import numpy as np
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 from openpilot.tools.lib.logreader import LogReader
 
@@ -39,7 +42,171 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+NUMERIC_TYPES = {"int8", "int16", "int32", "int64", "uint8", "uint16", "uint32", "uint64", "float32", "float64"}
+FLOAT_TYPES = {"float32", "float64"}
+
+_field_kinds: dict[int, tuple[list[tuple[str, str]], dict[str, str], bool]] = {}
+
+
+def _field_kind(field) -> str:
+  if field.proto.which() == "group":
+    return "struct"
+  typ = field.proto.slot.type
+  kind = typ.which()
+  if kind == "list":
+    elem = typ.list.elementType.which()
+    if elem in FLOAT_TYPES:
+      return "float_list"
+    if elem in NUMERIC_TYPES:
+      return "int_list"
+    return "struct_list" if elem == "struct" else "list"
+  if kind in FLOAT_TYPES:
+    return "float"
+  return "struct" if kind == "struct" else "value"
+
+
+def _struct_fields(schema) -> tuple[list[tuple[str, str]], dict[str, str], bool]:
+  """Returns how to compare each of the non-union and union fields of a struct, and whether it's a group"""
+  key = schema.node.id
+  if key not in _field_kinds:
+    fields = [(name, _field_kind(schema.fields[name])) for name in schema.non_union_fields]
+    union_fields = {name: _field_kind(schema.fields[name]) for name in schema.union_fields}
+    _field_kinds[key] = (fields, union_fields, schema.node.struct.isGroup)
+  return _field_kinds[key]
+
+
+def _floats_equal(a: float, b: float, tolerance: float) -> bool:
+  if math.isfinite(a) and math.isfinite(b):
+    return abs(a - b) <= max(tolerance, tolerance * max(abs(a), abs(b)))
+  return a == b or (math.isnan(a) and math.isnan(b))
+
+
+def _float_lists_equal(a, b, tolerance: float) -> bool:
+  if len(a) != len(b):
+    return False
+  a = np.fromiter(a, dtype=np.float64, count=len(a))
+  b = np.fromiter(b, dtype=np.float64, count=len(b))
+  finite = np.isfinite(a) & np.isfinite(b)
+  close = np.abs(a - b) <= np.maximum(tolerance, tolerance * np.maximum(np.abs(a), np.abs(b)))
+  same = (a == b) | (np.isnan(a) & np.isnan(b))
+  return bool(np.all(np.where(finite, close, same)))
+
+
+def _values_equal(a, b, kind: str, path: tuple[str, ...], ignore, tolerance: float) -> bool:
+  if kind == "struct":
+    return _structs_equal(a, b, path, ignore, tolerance)
+  if kind == "float":
+    return _floats_equal(a, b, tolerance)
+  if kind == "float_list":
+    return _float_lists_equal(a, b, tolerance)
+  if kind == "int_list":
+    return len(a) == len(b) and list(a) == list(b)
+  if kind in ("struct_list", "list"):
+    if len(a) != len(b):
+      return False
+    for i in range(len(a)):
+      item_path = path + (str(i),)
+      if ignore is not None and item_path in ignore:
+        continue
+      item_kind = "struct" if kind == "struct_list" else _item_kind(a[i])
+      if not _values_equal(a[i], b[i], item_kind, item_path, ignore, tolerance):
+        return False
+    return True
+  return bool(a == b)
+
+
+def _item_kind(item) -> str:
+  if isinstance(item, capnp.lib.capnp._DynamicListReader):
+    return "list"
+  return "float" if isinstance(item, float) else "value"
+
+
+def _structs_equal(a, b, path: tuple[str, ...], ignore, tolerance: float) -> bool:
+  """Walks two struct readers against their schema, comparing the fields that aren't ignored"""
+  fields, union_fields, is_group = _struct_fields(a.schema)
+
+  # only keep looking up paths while there are ignored fields below this one,
+  # the rest of the struct is copied once and compared as bytes first
+  if ignore is not None and path not in ignore.prefixes:
+    ignore = None
+    if not is_group and a.as_builder().to_bytes() == b.as_builder().to_bytes():
+      return True
+  if union_fields:
+    which = a.which()
+    if which != b.which():
+      return False
+    fields = fields + [(which, union_fields[which])]
+
+  for name, kind in fields:
+    field_path = path + (name,)
+    if ignore is not None and field_path in ignore:
+      continue
+    if not _values_equal(getattr(a, name), getattr(b, name), kind, field_path, ignore, tolerance):
+      return False
+  return True
+
+
+class IgnoredFields(set):
+  """Ignored field paths, split into keys, along with all of their parent paths"""
+  def __init__(self, ignore_fields):
+    super().__init__(tuple(key.split(".")) for key in ignore_fields)
+    self.prefixes = {path[:i] for path in self for i in range(len(path))}
+
+
+def _diff_msgs(msg1, msg2, ignore_fields, tolerance):
+  msg1 = remove_ignored_fields(msg1, ignore_fields)
+  msg2 = remove_ignored_fields(msg2, ignore_fields)
+
+  if msg1.to_bytes() == msg2.to_bytes():
+    return []
+
+  msg1_dict = msg1.as_reader().to_dict(verbose=True)
+  msg2_dict = msg2.as_reader().to_dict(verbose=True)
+
+  dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
+
+  # Dictdiffer only supports relative tolerance, we also want to check for absolute
+  # TODO: add this to dictdiffer
+  def outside_tolerance(diff):
+    try:
+      if diff[0] == "change":
+        a, b = diff[2]
+        finite = math.isfinite(a) and math.isfinite(b)
+        if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+          return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    except TypeError:
+      pass
+    return True
+
+  return list(filter(outside_tolerance, dd))
+
+
+def compare_msgs(msg1, msg2, ignore_fields, tolerance, ignore=None):
+  """Returns the dictdiffer style differences between two messages, outside of the tolerance"""
+  if ignore is None:
+    ignore = IgnoredFields(ignore_fields)
+
+  # identical messages stay identical with any fields ignored, readers have no bytes of their own so both are copied
+  if msg1.total_size.word_count == msg2.total_size.word_count and msg1.as_builder().to_bytes() == msg2.as_builder().to_bytes():
+    return []
+  if _structs_equal(msg1, msg2, (), ignore, tolerance):
+    return []
+
+  # only differing messages are diffed in full, so the reported differences are unchanged
+  return _diff_msgs(msg1, msg2, ignore_fields, tolerance)
+
+
+_compare_state = None
+
+
+def _compare_service(which):
+  log1, log2, ignore_fields, tolerance = _compare_state
+  ignore = IgnoredFields(ignore_fields)
+  return [(i, compare_msgs(log1[i], log2[i], ignore_fields, tolerance, ignore))
+          for i in range(len(log1)) if log1[i].which() == which]
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, workers=1):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -56,36 +223,29 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
+  services = defaultdict(int)
   for msg1, msg2 in zip(log1, log2, strict=True):
     if msg1.which() != msg2.which():
       raise Exception("msgs not aligned between logs")
-
-    msg1 = remove_ignored_fields(msg1, ignore_fields)
-    msg2 = remove_ignored_fields(msg2, ignore_fields)
-
-    if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
+    services[msg1.which()] += 1
+
+  if workers > 1 and len(services) > 1:
+    # readers can't be pickled, so the workers are forked with the logs already in memory
+    global _compare_state
+    _compare_state = (log1, log2, ignore_fields, tolerance)
+    try:
+      # biggest services first to keep all workers busy
+      order = sorted(services, key=services.__getitem__, reverse=True)
+      with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        msg_diffs = dict(d for service_diffs in pool.map(_compare_service, order) for d in service_diffs)
+    finally:
+      _compare_state = None
+    return [d for i in range(len(log1)) for d in msg_diffs[i]]
+
+  ignore = IgnoredFields(ignore_fields)
+  diff = []
+  for msg1, msg2 in zip(log1, log2, strict=True):
+    diff.extend(compare_msgs(msg1, msg2, ignore_fields, tolerance, ignore))
   return diff
 
 
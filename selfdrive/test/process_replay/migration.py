@@ -1,10 +1,16 @@
+import os
+import glob
+import heapq
+import inspect
+import hashlib
 from collections import defaultdict
-from collections.abc import Callable
+from collections.abc import Callable, Iterable
 import capnp
 import functools
 import traceback
+import zstandard as zstd
 
-from cereal import messaging, car, log
+from cereal import CEREAL_PATH, messaging, car, log
 from opendbc.car.fingerprints import MIGRATION
 from opendbc.car.toyota.values import EPS_SCALE, ToyotaSafetyFlags
 from opendbc.car.ford.values import CAR as FORD, FordFlags, FordSafetyFlags
@@ -14,12 +20,19 @@ from openpilot.selfdrive.modeld.fill_model_msg import fill_xyz_poly, fill_lane_l
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_encode_index
 from openpilot.selfdrive.controls.lib.longitudinal_planner import get_accel_from_plan
 from openpilot.system.manager.process_config import managed_processes
-from openpilot.tools.lib.logreader import LogIterable
+from openpilot.tools.lib.logreader import LogIterable, LogReader
+from openpilot.tools.lib.url_file import DownloadCache
 
 MessageWithIndex = tuple[int, capnp.lib.capnp._DynamicStructReader]
 MigrationOps = tuple[list[tuple[int, capnp.lib.capnp._DynamicStructReader]], list[capnp.lib.capnp._DynamicStructReader], list[int]]
 MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 
+MIGRATION_CACHE_DIR = os.environ.get("MIGRATION_CACHE", "/tmp/comma_migration_cache")
+# code outside this file the migrations depend on, cached migrated logs are invalidated when it changes
+MIGRATION_HELPERS = [fill_xyz_poly, fill_lane_line_meta, meta_from_encode_index, get_accel_from_plan]
+# least recently used migrated logs are evicted once the cache grows past this size
+MIGRATION_CACHE_SIZE = int(float(os.environ.get("MIGRATION_CACHE_SIZE", 5e9)))
+
 
 ## rules for migration functions
 ## 1. must use the decorator @migration(inputs=[...], product="...") and MigrationFunc signature
@@ -27,7 +40,7 @@ MigrationFunc = Callable[[list[MessageWithIndex]], MigrationOps]
 ## 3. product is the message type created by the migration function, and the function will be skipped if product type already exists in lr
 ## 4. it must return a list of operations to be applied to the logreader (replace, add, delete)
 ## 5. all migration functions must be independent of each other
-def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False):
+def get_migrations(manager_states: bool = False, panda_states: bool = False, camera_states: bool = False) -> list[MigrationFunc]:
   migrations = [
     migrate_sensorEvents,
     migrate_carParams,
@@ -50,8 +63,48 @@ def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: boo
     migrations.extend([migrate_pandaStates, migrate_peripheralState])
   if camera_states:
     migrations.append(migrate_cameraStates)
+  return migrations
 
-  return migrate(lr, migrations)
+
+def migrate_all(lr: LogIterable, manager_states: bool = False, panda_states: bool = False, camera_states: bool = False):
+  return migrate(lr, get_migrations(manager_states, panda_states, camera_states))
+
+
+def migrations_key(migration_funcs: list[MigrationFunc]) -> str:
+  # changes with the set of migrations, with the code of the migrations, migrate and the helpers they use, and with the schema
+  h = hashlib.sha256()
+  for func in [migrate, *MIGRATION_HELPERS, *migration_funcs]:
+    h.update(inspect.getsource(func).encode())
+  for schema in sorted(glob.glob(os.path.join(CEREAL_PATH, "*.capnp"))):
+    with open(schema, "rb") as f:
+      h.update(f.read())
+  return h.hexdigest()[:16]
+
+
+def migrate_all_cached(dat: bytes, cache_dir: str = MIGRATION_CACHE_DIR, evict: bool = True, **kwargs) -> str:
+  """
+  migrate_all of a raw log file, saved in a size bounded LRU cache keyed by the hash of the file and of the migrations applied.
+  Returns the path of the migrated log, which is only migrated again if the file or the migrations change.
+  Workers sharing the cache pass evict=False, so no path handed out is removed while in use, see evict_migration_cache.
+  """
+  migrations = get_migrations(**kwargs)
+  cache = DownloadCache.instance(cache_dir, MIGRATION_CACHE_SIZE)
+  name = f"{hashlib.sha256(dat).hexdigest()[:32]}_{migrations_key(migrations)}.zst"
+  path = cache.get(name)
+  if path is None:
+    migrated = migrate(LogReader.from_bytes(dat), migrations)
+    cache.put(name, zstd.compress(b"".join(msg.as_builder().to_bytes() for msg in migrated), 10), evict=evict)
+    path = cache.path(name)
+  cache.save(force=True)
+  return path
+
+
+def evict_migration_cache(keep: Iterable[str] = (), cache_dir: str = MIGRATION_CACHE_DIR) -> None:
+  """
+  Evicts the least recently used migrated logs past the cache size, except the paths in keep.
+  Run once the workers that called migrate_all_cached with evict=False are done.
+  """
+  DownloadCache.instance(cache_dir, MIGRATION_CACHE_SIZE).evict({os.path.basename(path) for path in keep})
 
 
 def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
@@ -60,28 +113,36 @@ def migrate(lr: LogIterable, migration_funcs: list[MigrationFunc]):
   for i, msg in enumerate(lr):
     grouped[msg.which()].append(i)
 
-  replace_ops, add_ops, del_ops = [], [], []
+  replace_ops, add_ops, del_ops = {}, [], set()
   for migration in migration_funcs:
     assert hasattr(migration, "inputs") and hasattr(migration, "product"), "Migration functions must use @migration decorator"
     if migration.product in grouped: # skip if product already exists
       continue
 
-    sorted_indices = sorted(ii for i in migration.inputs for ii in grouped[i])
-    msg_gen = [(i, lr[i]) for i in sorted_indices]
+    msg_gen = [(i, lr[i]) for i in heapq.merge(*(grouped[i] for i in migration.inputs))]
     r_ops, a_ops, d_ops = migration(msg_gen)
-    replace_ops.extend(r_ops)
+    replace_ops.update(r_ops)
     add_ops.extend(a_ops)
-    del_ops.extend(d_ops)
+    del_ops.update(d_ops)
 
-  for index, msg in replace_ops:
-    lr[index] = msg
-  for index in sorted(del_ops, reverse=True):
-    del lr[index]
-  for msg in add_ops:
-    lr.append(msg)
-  lr = sorted(lr, key=lambda x: x.logMonoTime)
-
-  return lr
+  # single pass over the log applying the ops, then a merge with the added messages, in the same
+  # order a stable sort by logMonoTime would give. only logs out of order need a full sort
+  migrated = []
+  in_order = True
+  prev_t = -1
+  for i, msg in enumerate(lr):
+    if i in del_ops:
+      continue
+    msg = replace_ops.get(i, msg)
+    t = msg.logMonoTime
+    in_order &= t >= prev_t
+    prev_t = t
+    migrated.append((t, msg))
+
+  added = sorted(((msg.logMonoTime, msg) for msg in add_ops), key=lambda x: x[0])
+  if not in_order:
+    return [msg for _, msg in sorted(migrated + added, key=lambda x: x[0])]
+  return [msg for _, msg in heapq.merge(migrated, added, key=lambda x: x[0])]
 
 
 def migration(inputs: list[str], product: str|None=None):
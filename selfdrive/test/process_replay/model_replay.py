@@ -218,7 +218,7 @@ def get_frames():
 
     return {c : NumpyFrameReader(f"{frames_cache}/{TEST_ROUTE}_{v}", 1928, 1208, cache_size) for c,v in zip(cams, videos, strict=True)}
   else:
-    return {c : FrameReader(get_url(TEST_ROUTE, SEGMENT, v), readahead=True) for c,v in zip(cams, videos, strict=True)}
+    return {c : FrameReader(get_url(TEST_ROUTE, SEGMENT, v)) for c,v in zip(cams, videos, strict=True)}
 
 
 if __name__ == "__main__":
@@ -4,11 +4,15 @@ import time
 import copy
 import json
 import heapq
+import queue
 import signal
-from collections import Counter, OrderedDict
+import itertools
+import threading
+from collections import Counter, OrderedDict, deque
 from dataclasses import dataclass, field
 from typing import Any
-from collections.abc import Callable, Iterable
+from collections.abc import Callable, Iterable, Iterator
+import numpy as np
 from tqdm import tqdm
 import capnp
 from openpilot.system.hardware.hw import Paths
@@ -35,6 +39,8 @@ from openpilot.tools.lib.framereader import BaseFrameReader
 NUMPY_TOLERANCE = 1e-7
 PROC_REPLAY_DIR = os.path.dirname(os.path.abspath(__file__))
 FAKEDATA = os.path.join(PROC_REPLAY_DIR, "fakedata/")
+# number of frames decoded ahead of the replay, 0 decodes each frame when it's sent
+FRAME_PREFETCH = int(os.getenv("FRAME_PREFETCH", "40"))
 
 class DummySocket:
   def __init__(self):
@@ -49,6 +55,66 @@ class DummySocket:
   def send(self, data: bytes):
     self.data.append(data)
 
+class FramePrefetcher:
+  """
+  Decodes the frames of the upcoming camera states on a background thread, so the next GOPs
+  are decoded while the process runs on the current frames.
+  """
+  def __init__(self, frs: dict[str, BaseFrameReader], camera_states: list[tuple[str, int]], depth: int = FRAME_PREFETCH):
+    self.frs = frs
+    self.camera_states = camera_states
+    self.pending = deque(camera_states)
+    self.frames: queue.Queue = queue.Queue(maxsize=depth)
+    # frame readers aren't thread safe, only one frame is decoded at a time
+    self.decode_lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self._decode_thread, daemon=True)
+    self.thread.start()
+
+  def _decode(self, which: str, frame_id: int) -> np.ndarray:
+    with self.decode_lock:
+      return self.frs[which].get(frame_id, pix_fmt="nv12")[0]
+
+  def _decode_thread(self):
+    for which, frame_id in self.camera_states:
+      try:
+        item = (self._decode(which, frame_id), None)
+      except Exception as e:
+        item = (None, e)
+
+      while not self.stopped.is_set():
+        try:
+          self.frames.put(item, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      if self.stopped.is_set() or item[1] is not None:
+        return
+
+  def get(self, which: str, frame_id: int) -> np.ndarray:
+    if len(self.pending) == 0 or self.pending[0] != (which, frame_id):
+      # not in the order of the log, decode it here
+      return self._decode(which, frame_id)
+
+    self.pending.popleft()
+    while True:
+      try:
+        img, err = self.frames.get(timeout=0.1)
+        break
+      except queue.Empty:
+        # the thread stopped before this frame, after an error or stop()
+        if not self.thread.is_alive() and self.frames.empty():
+          return self._decode(which, frame_id)
+
+    if err is not None:
+      raise err
+    return img
+
+  def stop(self):
+    self.stopped.set()
+    self.thread.join()
+
+
 class LauncherWithCapture:
   def __init__(self, capture: ProcessOutputCapture, launcher: Callable):
     self.capture = capture
@@ -158,6 +224,7 @@ class ProcessContainer:
     self.sockets: list[messaging.SubSocket] | None = None
     self.rc: ReplayContext | None = None
     self.vipc_server: VisionIpcServer | None = None
+    self.frame_prefetcher: FramePrefetcher | None = None
     self.environ_config: dict[str, Any] | None = None
     self.capture: ProcessOutputCapture | None = None
 
@@ -218,6 +285,10 @@ class ProcessContainer:
     self.vipc_server = vipc_server
     self.cfg.vision_pubs = [meta.camera_state for meta in streams_metas if meta.camera_state in self.cfg.vision_pubs]
 
+    if FRAME_PREFETCH > 0:
+      camera_states = [(m.which(), getattr(m, m.which()).frameId) for m in all_msgs if m.which() in self.cfg.vision_pubs]
+      self.frame_prefetcher = FramePrefetcher(frs, camera_states)
+
   def _start_process(self):
     if self.capture is not None:
       self.process.launcher = LauncherWithCapture(self.capture, self.process.launcher)
@@ -261,6 +332,9 @@ class ProcessContainer:
           time.sleep(0)
 
   def stop(self):
+    if self.frame_prefetcher is not None:
+      self.frame_prefetcher.stop()
+
     with self.prefix:
       self.process.signal(signal.SIGKILL)
       self.process.stop()
@@ -298,8 +372,12 @@ class ProcessContainer:
             camera_state = getattr(m, m.which())
             camera_meta = meta_from_camera_state(m.which())
             assert frs is not None
-            img = frs[m.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
-            self.vipc_server.send(camera_meta.stream, img.flatten().tobytes(),
+            if self.frame_prefetcher is not None:
+              img = self.frame_prefetcher.get(m.which(), camera_state.frameId)
+            else:
+              img = frs[m.which()].get(camera_state.frameId, pix_fmt="nv12")[0]
+            # a flat view of the decoded frame, only copied once into the VisionIPC buffer
+            self.vipc_server.send(camera_meta.stream, np.ascontiguousarray(img).reshape(-1),
                                   camera_state.frameId, camera_state.timestampSof, camera_state.timestampEof)
         self.msg_queue = []
 
@@ -651,18 +729,10 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, migrate: bool = True
 ) -> list[capnp._DynamicStructReader]:
-  if isinstance(cfg, Iterable):
-    cfgs = list(cfg)
-  else:
-    cfgs = [cfg]
-
-  all_msgs = migrate_all(lr,
-                         manager_states=True,
-                         panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
-                         camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  cfgs, all_msgs = _prepare_replay(cfg, lr, migrate)
+  process_logs = list(_replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress))
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -676,10 +746,42 @@ def replay_process(
   return log_msgs
 
 
+def replay_process_iter(
+  cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] = None,
+  fingerprint: str = None, custom_params: dict[str, Any] = None,
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, migrate: bool = True
+) -> Iterator[capnp._DynamicStructReader]:
+  """
+  Same as replay_process, yielding the outputs as the processes publish them instead of collecting the whole route.
+  The processes are stopped once the iterator is exhausted or closed.
+  """
+  cfgs, all_msgs = _prepare_replay(cfg, lr, migrate)
+  yield from _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+
+
+def get_migration_kwargs(cfgs: list[ProcessConfig]) -> dict[str, bool]:
+  # migrations applied to the inputs of the processes, logs passed with migrate=False must have been migrated with these
+  return {
+    "manager_states": True,
+    "panda_states": any("pandaStates" in cfg.pubs for cfg in cfgs),
+    "camera_states": any(len(cfg.vision_pubs) != 0 for cfg in cfgs),
+  }
+
+
+def _prepare_replay(cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, migrate: bool) -> tuple[list[ProcessConfig], LogIterable]:
+  if isinstance(cfg, Iterable):
+    cfgs = list(cfg)
+  else:
+    cfgs = [cfg]
+
+  all_msgs = migrate_all(lr, **get_migration_kwargs(cfgs)) if migrate else list(lr)
+  return cfgs, all_msgs
+
+
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, BaseFrameReader] | None, fingerprint: str | None,
   custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
-) -> list[capnp._DynamicStructReader]:
+) -> Iterator[capnp._DynamicStructReader]:
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
     env_config = generate_environ_config(fingerprint=fingerprint)
@@ -698,7 +800,6 @@ def _replay_multi_process(
     assert all(st in frs for st in required_vision_pubs), f"frs for this process must contain following vision streams: {required_vision_pubs}"
 
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
-  log_msgs = []
   try:
     containers = []
     for cfg in cfgs:
@@ -711,30 +812,26 @@ def _replay_multi_process(
     lr_pubs = all_pubs - all_subs
     pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
 
-    pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
-    # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
-    internal_pub_queue: list[capnp._DynamicStructReader] = []
-    # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
-    internal_pub_index_heap: list[tuple[int, int]] = []
+    # merge of two sorted streams: messages taken from logs, and messages generated by processes which are republished.
+    # generated messages are only kept until they're republished, a push counter keeps equal logMonoTimes in publish order
+    external_pub_queue = deque((msg.which(), msg) for msg in all_msgs if msg.which() in lr_pubs)
+    internal_pub_heap: list[tuple[int, int, str, capnp._DynamicStructReader]] = []
+    push_order = itertools.count()
 
     pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
-    while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
-      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
+    while len(external_pub_queue) != 0 or (len(internal_pub_heap) != 0 and not all(c.has_empty_queue for c in containers)):
+      if len(internal_pub_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0][1].logMonoTime < internal_pub_heap[0][0]):
+        which, msg = external_pub_queue.popleft()
         pbar.update(1)
       else:
-        _, index = heapq.heappop(internal_pub_index_heap)
-        msg = internal_pub_queue[index]
-
-      target_containers = pubs_to_containers[msg.which()]
-      for container in target_containers:
-        output_msgs = container.run_step(msg, frs)
-        for m in output_msgs:
-          if m.which() in all_pubs:
-            internal_pub_queue.append(m)
-            heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
-        log_msgs.extend(output_msgs)
+        _, _, which, msg = heapq.heappop(internal_pub_heap)
+
+      for container in pubs_to_containers[which]:
+        for m in container.run_step(msg, frs):
+          m_which = m.which()
+          if m_which in all_pubs:
+            heapq.heappush(internal_pub_heap, (m.logMonoTime, next(push_order), m_which, m))
+          yield m
   finally:
     for container in containers:
       container.stop()
@@ -743,8 +840,6 @@ def _replay_multi_process(
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
 
-  return log_msgs
-
 
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
   params_dict = {
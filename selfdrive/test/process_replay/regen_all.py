@@ -3,6 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import random
+import time
 import traceback
 from tqdm import tqdm
 
@@ -38,12 +39,18 @@ if __name__ == "__main__":
                       help="Whitelist given cars from the test (e.g. HONDA)")
   parser.add_argument("--blacklist-cars", type=str, nargs="*", default=[],
                       help="Blacklist given cars from the test (e.g. HONDA)")
+  parser.add_argument("--segments", type=str, nargs="*", default=[],
+                      help="Regenerate these segments instead of the process replay source segments (e.g. a route corpus)")
   args = parser.parse_args()
 
-  tested_cars = set(args.whitelist_cars) - set(args.blacklist_cars)
-  tested_cars = {c.upper() for c in tested_cars}
-  tested_segments = [(car, segment) for car, segment in segments if car in tested_cars]
+  if len(args.segments):
+    tested_segments = [(segment, segment) for segment in args.segments]
+  else:
+    tested_cars = set(args.whitelist_cars) - set(args.blacklist_cars)
+    tested_cars = {c.upper() for c in tested_cars}
+    tested_segments = [(car, segment) for car, segment in segments if car in tested_cars]
 
+  start_time = time.monotonic()
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
     p = pool.map(regen_job, tested_segments, [not args.no_upload] * len(tested_segments), [args.jobs > 1] * len(tested_segments))
     msg = "Copy these new segments into test_processes.py:"
@@ -52,3 +59,6 @@ if __name__ == "__main__":
     print()
     print()
     print(msg)
+
+  elapsed = time.monotonic() - start_time
+  print(f"Regenerated {len(tested_segments)} segments in {elapsed / 60:.1f} minutes, {len(tested_segments) / elapsed * 60:.1f} segments/minute")
@@ -0,0 +1,26 @@
+import pytest
+
+from openpilot.selfdrive.test.process_replay.batch_estimators import ESTIMATORS, run_estimators
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay.migration import migrate_all
+from openpilot.selfdrive.test.process_replay.process_replay import get_process_config, replay_process
+from openpilot.tools.lib.logreader import LogReader
+
+TEST_ROUTE = "4019fff6e54cf1c7|00000123--4bc0d95ef6/5"
+
+
+class TestBatchEstimators:
+  @classmethod
+  def setup_class(cls):
+    cls.logs = list(migrate_all(LogReader(TEST_ROUTE)))
+
+  @pytest.mark.parametrize("names", [[name] for name in ESTIMATORS] + [ESTIMATORS])
+  def test_matches_replay(self, names):
+    cfgs = [get_process_config(name) for name in names]
+    replayed = replay_process(cfgs, self.logs, disable_progress=True)
+    batched = run_estimators(self.logs, names)
+
+    assert len(batched) == len(replayed)
+    ignore = [f for cfg in cfgs for f in cfg.ignore]
+    tolerance = max(cfg.tolerance or 0 for cfg in cfgs) or None
+    assert compare_logs(replayed, batched, ignore, tolerance=tolerance) == []
@@ -0,0 +1,41 @@
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+
+
+def make_log(v_ego: float = 10., x: float = 1., mono_time: int = 0) -> list:
+  msgs = []
+  for i in range(10):
+    cs = messaging.new_message('carState', logMonoTime=mono_time + i)
+    cs.carState.vEgo = v_ego
+    cs.carState.gearShifter = 'drive'
+    msgs.append(cs)
+
+    model = messaging.new_message('modelV2', logMonoTime=mono_time + i)
+    model.modelV2.position.x = [x * j for j in range(33)]
+    msgs.append(model)
+  return [m.as_reader() for m in msgs]
+
+
+class TestCompareLogs:
+  def test_identical(self):
+    assert compare_logs(make_log(), make_log()) == []
+
+  def test_ignored_fields(self):
+    assert len(compare_logs(make_log(), make_log(mono_time=1))) == 20
+    assert compare_logs(make_log(), make_log(mono_time=1), ["logMonoTime"]) == []
+    assert compare_logs(make_log(), make_log(v_ego=11.), ["carState.vEgo"]) == []
+
+  def test_tolerance(self):
+    assert compare_logs(make_log(x=1.), make_log(x=1.001), tolerance=0.01) == []
+    assert compare_logs(make_log(v_ego=10.), make_log(v_ego=10.05), tolerance=0.01) == []
+
+    diff = compare_logs(make_log(x=1.), make_log(x=1.1), tolerance=0.01)
+    assert len(diff) == 10 * 32
+    assert {d[0] for d in diff} == {"change"}
+    assert diff[0][1] == ["modelV2", "position", "x", 1]
+
+  def test_parallel(self):
+    log1, log2 = make_log(v_ego=10.), make_log(v_ego=12.)
+    diff = compare_logs(log1, log2, workers=2)
+    assert diff == compare_logs(log1, log2)
+    assert diff == [("change", "carState.vEgo", (10., 12.))] * 10
@@ -0,0 +1,82 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from openpilot.selfdrive.test.process_replay.process_replay import FramePrefetcher
+
+
+class FakeFrameReader:
+  def __init__(self, fail_frame: int | None = None):
+    self.fail_frame = fail_frame
+    self.decoded: list[int] = []
+    self.active = 0
+    self.max_active = 0
+    self.lock = threading.Lock()
+
+  def get(self, frame_id: int, pix_fmt: str):
+    with self.lock:
+      self.active += 1
+      self.max_active = max(self.max_active, self.active)
+    time.sleep(0.001)
+    with self.lock:
+      self.active -= 1
+      self.decoded.append(frame_id)
+
+    if frame_id == self.fail_frame:
+      raise ValueError(f"failed to decode frame {frame_id}")
+    return [np.full(4, frame_id, dtype=np.uint8)]
+
+
+def camera_states(n: int) -> list[tuple[str, int]]:
+  return [("roadCameraState", i) for i in range(n)]
+
+
+class TestFramePrefetcher:
+  def test_in_order(self):
+    fr = FakeFrameReader()
+    prefetcher = FramePrefetcher({"roadCameraState": fr}, camera_states(20), depth=4)
+    for i in range(20):
+      np.testing.assert_equal(prefetcher.get("roadCameraState", i), i)
+    prefetcher.stop()
+    assert fr.decoded == list(range(20))
+
+  def test_out_of_order(self):
+    fr = FakeFrameReader()
+    prefetcher = FramePrefetcher({"roadCameraState": fr}, camera_states(20), depth=4)
+    np.testing.assert_equal(prefetcher.get("roadCameraState", 0), 0)
+    # decoded directly, without taking the prefetched frames
+    np.testing.assert_equal(prefetcher.get("roadCameraState", 10), 10)
+    for i in range(1, 20):
+      np.testing.assert_equal(prefetcher.get("roadCameraState", i), i)
+    prefetcher.stop()
+
+    assert fr.decoded.count(10) == 2
+    assert fr.max_active == 1
+
+  def test_error(self):
+    fr = FakeFrameReader(fail_frame=3)
+    prefetcher = FramePrefetcher({"roadCameraState": fr}, camera_states(10), depth=4)
+    for i in range(3):
+      np.testing.assert_equal(prefetcher.get("roadCameraState", i), i)
+    with pytest.raises(ValueError):
+      prefetcher.get("roadCameraState", 3)
+
+    # the thread exited after the error, later frames are decoded directly
+    np.testing.assert_equal(prefetcher.get("roadCameraState", 4), 4)
+    prefetcher.stop()
+
+  def test_stop_full_queue(self):
+    fr = FakeFrameReader()
+    prefetcher = FramePrefetcher({"roadCameraState": fr}, camera_states(20), depth=2)
+    while not prefetcher.frames.full():
+      time.sleep(0.001)
+
+    prefetcher.stop()
+    assert not prefetcher.thread.is_alive()
+    assert len(fr.decoded) <= 3
+
+    # frames still in the queue are returned, the rest are decoded directly
+    for i in range(5):
+      np.testing.assert_equal(prefetcher.get("roadCameraState", i), i)
@@ -0,0 +1,76 @@
+import os
+
+from cereal import messaging
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay import migration as migration_module
+from openpilot.selfdrive.test.process_replay.migration import evict_migration_cache, migrate, migrate_all, migrate_all_cached, \
+                                                              migration
+from openpilot.tools.lib.logreader import LogReader
+
+
+def make_log(n: int = 100) -> bytes:
+  msgs = []
+  for i in range(n):
+    msgs.append(messaging.new_message('controlsState', logMonoTime=i * 10_000_000))
+    msgs.append(messaging.new_message('carControl', logMonoTime=i * 10_000_000 + 1))
+  return b"".join(m.to_bytes() for m in msgs)
+
+
+@migration(inputs=["controlsState"], product="selfdriveState")
+def add_selfdriveState(msgs):
+  return [], [messaging.new_message('selfdriveState', logMonoTime=msg.logMonoTime).as_reader() for _, msg in msgs], []
+
+
+@migration(inputs=["carControl"])
+def replace_and_delete_carControl(msgs):
+  replaced = []
+  for index, msg in msgs[::2]:
+    new_msg = msg.as_builder()
+    new_msg.carControl.enabled = True
+    replaced.append((index, new_msg.as_reader()))
+  return replaced, [], [index for index, _ in msgs[1::2]]
+
+
+class TestMigration:
+  def test_ops(self):
+    lr = list(LogReader.from_bytes(make_log()))
+    for logs in (lr, lr[::-1]):
+      migrated = migrate(logs, [add_selfdriveState, replace_and_delete_carControl])
+      assert [m.logMonoTime for m in migrated] == sorted(m.logMonoTime for m in migrated)
+      assert len(migrated) == len(lr) + len(lr) // 2 - len(lr) // 4
+
+      # added messages go after the logged messages at the same time
+      assert [m.which() for m in migrated[:2]] == ["controlsState", "selfdriveState"]
+      assert all(m.carControl.enabled for m in migrated if m.which() == "carControl")
+
+  def test_cached(self, tmp_path):
+    dat = make_log()
+    path = migrate_all_cached(dat, cache_dir=str(tmp_path), manager_states=True)
+    migrated = list(LogReader(path))
+    assert compare_logs(migrate_all(LogReader.from_bytes(dat), manager_states=True), migrated) == []
+    assert {m.which() for m in migrated} >= {"selfdriveState", "carOutput"}
+
+    # reused for the same log and migrations only
+    mtime = os.path.getmtime(path)
+    assert migrate_all_cached(dat, cache_dir=str(tmp_path), manager_states=True) == path
+    assert os.path.getmtime(path) == mtime
+    assert migrate_all_cached(dat, cache_dir=str(tmp_path), panda_states=True) != path
+    assert migrate_all_cached(make_log(50), cache_dir=str(tmp_path), manager_states=True) != path
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".zst")]) == 3
+
+  def test_cache_bounded(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(migration_module, "MIGRATION_CACHE_SIZE", 1)
+    old_path = migrate_all_cached(make_log(10), cache_dir=str(tmp_path))
+    new_path = migrate_all_cached(make_log(20), cache_dir=str(tmp_path))
+    assert not os.path.exists(old_path)
+    assert os.path.exists(new_path)
+
+  def test_cache_evicted_after_run(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(migration_module, "MIGRATION_CACHE_SIZE", 1)
+    paths = [migrate_all_cached(make_log(n), cache_dir=str(tmp_path), evict=False) for n in (10, 20, 30)]
+    assert all(os.path.exists(path) for path in paths)
+
+    # only the logs still in use are kept
+    evict_migration_cache(paths[1:], cache_dir=str(tmp_path))
+    assert not os.path.exists(paths[0])
+    assert all(os.path.exists(path) for path in paths[1:])
@@ -3,6 +3,7 @@ import argparse
 import concurrent.futures
 import os
 import sys
+import time
 from collections import defaultdict
 from tqdm import tqdm
 from typing import Any
@@ -11,8 +12,9 @@ from opendbc.car.car_helpers import interface_names
 from openpilot.common.git import get_commit
 from openpilot.tools.lib.openpilotci import get_url, upload_file
 from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs, format_diff
+from openpilot.selfdrive.test.process_replay.migration import evict_migration_cache, migrate_all_cached
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, PROC_REPLAY_DIR, FAKEDATA, replay_process, \
-                                                                   check_most_messages_valid
+                                                                   check_most_messages_valid, get_migration_kwargs
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.logreader import LogReader, save_log
 
@@ -70,11 +72,11 @@ EXCLUDED_PROCS = {"modeld", "dmonitoringmodeld"}
 
 
 def run_test_process(data):
-  segment, cfg, args, cur_log_fn, ref_log_path, lr_dat = data
+  segment, cfg, args, cur_log_fn, ref_log_path, migrated_log_path = data
   res = None
   if not args.upload_only:
-    lr = LogReader.from_bytes(lr_dat)
-    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs)
+    lr = list(LogReader(migrated_log_path))
+    res, log_msgs = test_process(cfg, lr, segment, ref_log_path, cur_log_fn, args.ignore_fields, args.ignore_msgs, migrate=False)
     # save logs so we can upload when updating refs
     save_log(cur_log_fn, log_msgs)
 
@@ -86,13 +88,21 @@ def run_test_process(data):
   return (segment, cfg.proc_name, res)
 
 
-def get_log_data(segment):
+def migration_set(cfg):
+  return tuple(sorted(get_migration_kwargs([cfg]).items()))
+
+
+def migrate_segment(data):
+  # downloaded once, and migrated once for each set of migrations the tested processes need
+  segment, migration_sets = data
   r, n = segment.rsplit("--", 1)
   with FileReader(get_url(r, n, "rlog.zst")) as f:
-    return (segment, f.read())
+    dat = f.read()
+  # evicted from the main process once all segments are migrated, the other workers may still need the oldest logs
+  return segment, {m: migrate_all_cached(dat, evict=False, **dict(m)) for m in migration_sets}
 
 
-def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None):
+def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=None, ignore_msgs=None, migrate=True):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -101,7 +111,7 @@ def test_process(cfg, lr, segment, ref_log_path, new_log_path, ignore_fields=Non
   ref_log_msgs = list(LogReader(ref_log_path))
 
   try:
-    log_msgs = replay_process(cfg, lr, disable_progress=True)
+    log_msgs = replay_process(cfg, lr, disable_progress=True, migrate=migrate)
   except Exception as e:
     raise Exception("failed on segment: " + segment) from e
 
@@ -177,40 +187,49 @@ if __name__ == "__main__":
     untested = (set(interface_names) - set(excluded_interfaces)) - {c.lower() for c in tested_cars}
     assert len(untested) == 0, f"Cars missing routes: {str(untested)}"
 
-  log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
-  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    if not args.upload_only:
-      download_segments = [seg for car, seg in segments if car in tested_cars]
-      log_data: dict[str, LogReader] = {}
-      p1 = pool.map(get_log_data, download_segments)
-      for segment, lr in tqdm(p1, desc="Getting Logs", total=len(download_segments)):
-        log_data[segment] = lr
+  tested_cfgs = []
+  for car_brand, segment in segments:
+    if car_brand not in tested_cars:
+      continue
 
-    pool_args: Any = []
-    for car_brand, segment in segments:
-      if car_brand not in tested_cars:
+    for cfg in CONFIGS:
+      if cfg.proc_name not in tested_procs:
         continue
 
-      for cfg in CONFIGS:
-        if cfg.proc_name not in tested_procs:
-          continue
+      # to speed things up, we only test all segments on card
+      if cfg.proc_name != 'card' and car_brand not in ('HYUNDAI', 'TOYOTA', 'HONDA', 'SUBARU', 'FORD'):
+        continue
+      tested_cfgs.append((segment, cfg))
 
-        # to speed things up, we only test all segments on card
-        if cfg.proc_name != 'card' and car_brand not in ('HYUNDAI', 'TOYOTA', 'HONDA', 'SUBARU', 'FORD'):
-          continue
+  start_time = time.monotonic()
+  log_paths: defaultdict[str, dict[str, dict[str, str]]] = defaultdict(lambda: defaultdict(dict))
+  with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+    # segments are sharded across the pool to be migrated, tests then read the migrated logs from the cache
+    migrated_logs: dict[str, dict[tuple, str]] = {}
+    if not args.upload_only:
+      segment_migrations: defaultdict[str, set[tuple]] = defaultdict(set)
+      for segment, cfg in tested_cfgs:
+        segment_migrations[segment].add(migration_set(cfg))
 
-        cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
-        if args.update_refs:  # reference logs will not exist if routes were just regenerated
-          ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
-        else:
-          ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
-          ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
+      p1 = pool.map(migrate_segment, segment_migrations.items())
+      for segment, paths in tqdm(p1, desc="Migrating Logs", total=len(segment_migrations)):
+        migrated_logs[segment] = paths
+      evict_migration_cache([path for paths in migrated_logs.values() for path in paths.values()])
 
-        dat = None if args.upload_only else log_data[segment]
-        pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, dat))
+    pool_args: Any = []
+    for segment, cfg in tested_cfgs:
+      cur_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{cur_commit}.zst")
+      if args.update_refs:  # reference logs will not exist if routes were just regenerated
+        ref_log_path = get_url(*segment.rsplit("--", 1,), "rlog.zst")
+      else:
+        ref_log_fn = os.path.join(FAKEDATA, f"{segment}_{cfg.proc_name}_{ref_commit}.zst")
+        ref_log_path = ref_log_fn if os.path.exists(ref_log_fn) else BASE_URL + os.path.basename(ref_log_fn)
+
+      migrated_log_path = None if args.upload_only else migrated_logs[segment][migration_set(cfg)]
+      pool_args.append((segment, cfg, args, cur_log_fn, ref_log_path, migrated_log_path))
 
-        log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
-        log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
+      log_paths[segment][cfg.proc_name]['ref'] = ref_log_path
+      log_paths[segment][cfg.proc_name]['new'] = cur_log_fn
 
     results: Any = defaultdict(dict)
     p2 = pool.map(run_test_process, pool_args)
@@ -218,6 +237,9 @@ if __name__ == "__main__":
       if not args.upload_only:
         results[segment][proc] = result
 
+  elapsed = time.monotonic() - start_time
+  print(f"Tested {len(log_paths)} segments in {elapsed / 60:.1f} minutes, {len(log_paths) / elapsed * 60:.1f} segments/minute")
+
   diff_short, diff_long, failed = format_diff(results, log_paths, ref_commit)
   if not upload:
     with open(os.path.join(PROC_REPLAY_DIR, "diff.txt"), "w") as f:
@@ -37,6 +37,15 @@ def file_exists(fn):
   return os.path.exists(fn)
 
 
+def file_stamp(fn):
+  # used to invalidate derived caches, remote files are immutable but local ones may be rewritten in place
+  fn = resolve_name(fn)
+  if fn.startswith(("http://", "https://")):
+    return None
+  st = os.stat(fn)
+  return st.st_size, st.st_mtime_ns
+
+
 def FileReader(fn, debug=False):
   fn = resolve_name(fn)
   if fn.startswith(("http://", "https://")):
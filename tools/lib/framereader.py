@@ -1,9 +1,13 @@
+import io
 import json
 import os
 import pickle
+import queue
 import struct
 import subprocess
 import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
 from enum import IntEnum
 from functools import wraps
 
@@ -16,12 +20,17 @@ from openpilot.tools.lib.exceptions import DataUnreadableError
 from openpilot.tools.lib.vidindex import hevc_index
 from openpilot.common.file_helpers import atomic_write_in_dir
 
-from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.tools.lib.filereader import FileReader, file_stamp, resolve_name
+from openpilot.tools.lib.url_file import DownloadCache, hash_256
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+FRAME_CACHE_BYTES = int(os.getenv("FRAME_CACHE_BYTES", 1024 * 1024 * 1024))
+SHARED_FRAME_CACHE_DIR = os.path.join(DEFAULT_CACHE_DIR, "frames")
+SHARED_FRAME_CACHE_BYTES = int(float(os.getenv("SHARED_FRAME_CACHE_BYTES", 20e9)))
+
 
 class GOPReader:
   def get_gop(self, num):
@@ -197,6 +206,161 @@ def decompress_video_data(rawdat, vid_fmt, w, h, pix_fmt):
   return ret
 
 
+def av_frame_to_ndarray(frame, w, h, pix_fmt):
+  # same layout as the rawvideo output of decompress_video_data, without the padding at the end of each line
+  if pix_fmt in ("nv12", "yuv420p"):
+    row_bytes = [w, w] if pix_fmt == "nv12" else [w, w // 2, w // 2]
+    shape = (h*w*3//2,)
+  elif pix_fmt == "rgb24":
+    row_bytes, shape = [w * 3], (h, w, 3)
+  elif pix_fmt == "yuv444p":
+    row_bytes, shape = [w, w, w], (3, h, w)
+  else:
+    raise NotImplementedError
+
+  if frame.format.name != pix_fmt:
+    # bicubic like the ffmpeg cli, so chroma upsampling gives the same frames as decompress_video_data
+    frame = frame.reformat(format=pix_fmt, interpolation="BICUBIC")
+
+  ret = np.empty(int(np.prod(shape)), dtype=np.uint8)
+  pos = 0
+  for plane, row in zip(frame.planes, row_bytes, strict=True):
+    dat = np.frombuffer(plane, dtype=np.uint8).reshape(plane.height, plane.line_size)[:, :row]
+    ret[pos:pos + dat.size].reshape(dat.shape)[:] = dat
+    pos += dat.size
+  assert pos == ret.size, (pos, ret.size)
+  return ret.reshape(shape)
+
+
+class AVDecoder:
+  """In-process decoder that is reused for every GOP, saving the ffmpeg start up and decoder init per GOP"""
+  def __init__(self, vid_fmt, threads=0):
+    import av
+    self.ctx = av.CodecContext.create(vid_fmt, "r")
+    self.ctx.options = {"flags2": "+showall"}
+    self.ctx.thread_type = "AUTO"
+    self.ctx.thread_count = threads
+
+  def decode(self, rawdat, w, h, pix_fmt):
+    try:
+      frames = []
+      for packet in self.ctx.parse(rawdat) + self.ctx.parse(None):
+        frames += self.ctx.decode(packet)
+      frames += self.ctx.decode(None)
+    finally:
+      # drop the decoder state so the next GOP starts clean
+      self.ctx.flush_buffers()
+    return [av_frame_to_ndarray(f, w, h, pix_fmt) for f in frames]
+
+
+class DecoderPool:
+  """
+  A fixed number of long lived decoders, GOPs can be decoded in parallel from the pool's threads.
+  Falls back to an ffmpeg subprocess per GOP when PyAV isn't available.
+  """
+  def __init__(self, vid_fmt, size):
+    self.vid_fmt = vid_fmt
+    self.size = size
+    self.executor = ThreadPoolExecutor(max_workers=size)
+
+    threads = int(os.getenv("FFMPEG_THREADS", str(max(1, (os.cpu_count() or 1) // size))))
+    self.decoders: queue.Queue | None = queue.Queue()
+    try:
+      for _ in range(size):
+        self.decoders.put(AVDecoder(vid_fmt, threads))
+    except ImportError:
+      self.decoders = None
+
+  def decode(self, rawdat, w, h, pix_fmt):
+    if self.decoders is None:
+      return decompress_video_data(rawdat, self.vid_fmt, w, h, pix_fmt)
+
+    decoder = self.decoders.get()
+    try:
+      return decoder.decode(rawdat, w, h, pix_fmt)
+    finally:
+      self.decoders.put(decoder)
+
+  def close(self):
+    self.executor.shutdown(wait=True)
+
+
+class FrameCache:
+  """LRU cache of decoded frames, bounded by the total size of the frames in bytes"""
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.nbytes = 0
+    self.frames: OrderedDict = OrderedDict()
+    self.lock = threading.Lock()
+
+  def __len__(self):
+    return len(self.frames)
+
+  def __contains__(self, key):
+    return key in self.frames
+
+  def __getitem__(self, key):
+    frame = self.get(key)
+    if frame is None:
+      raise KeyError(key)
+    return frame
+
+  def __setitem__(self, key, frame):
+    with self.lock:
+      old = self.frames.pop(key, None)
+      if old is not None:
+        self.nbytes -= old.nbytes
+      self.frames[key] = frame
+      self.nbytes += frame.nbytes
+
+      # always keep the newest frame, even if it's over budget on its own
+      while self.nbytes > self.max_bytes and len(self.frames) > 1:
+        _, old = self.frames.popitem(last=False)
+        self.nbytes -= old.nbytes
+
+  def get(self, key, default=None):
+    with self.lock:
+      frame = self.frames.get(key)
+      if frame is None:
+        return default
+      self.frames.move_to_end(key)
+      return frame
+
+
+class SharedFrameCache:
+  """
+  Decoded GOPs shared between processes, stored as .npy files in a size bounded LRU directory.
+  Frames are read back as views of a read-only memory map, so every process reading the same
+  (file, frame, pix_fmt) shares the page cache instead of decoding and holding its own copy.
+  """
+  def __init__(self, fn, cache_dir=SHARED_FRAME_CACHE_DIR, max_bytes=SHARED_FRAME_CACHE_BYTES):
+    # local files may be rewritten in place, so their size and mtime are part of the key
+    self.key = hash_256(f"{resolve_name(fn)}:{file_stamp(fn)}")
+    self.cache = DownloadCache.instance(cache_dir, max_bytes)
+
+  def _name(self, frame_b, pix_fmt):
+    return f"{self.key}_{pix_fmt}_{frame_b}.npy"
+
+  def get_gop(self, frame_b, pix_fmt):
+    name = self._name(frame_b, pix_fmt)
+    path = self.cache.get(name)
+    if path is None:
+      return None
+
+    try:
+      return np.load(path, mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+      # evicted by another process
+      self.cache.discard(name)
+      return None
+
+  def put_gop(self, frame_b, pix_fmt, frames):
+    buf = io.BytesIO()
+    np.save(buf, np.stack(frames) if isinstance(frames, list) else frames)
+    self.cache.put(self._name(frame_b, pix_fmt), buf.getvalue())
+    self.cache.save()
+
+
 class BaseFrameReader:
   # properties: frame_type, frame_count, w, h
 
@@ -213,14 +377,16 @@ class BaseFrameReader:
     raise NotImplementedError
 
 
-def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None):
+def FrameReader(fn, cache_dir=DEFAULT_CACHE_DIR, readahead=False, readbehind=False, index_data=None, decoders=0, cache_bytes=None,
+                shared_cache=False):
   frame_type = fingerprint_video(fn)
   if frame_type == FrameType.raw:
     return RawFrameReader(fn)
   elif frame_type in (FrameType.h265_stream,):
     if not index_data:
       index_data = get_video_index(fn, frame_type, cache_dir)
-    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind)
+    return StreamFrameReader(fn, frame_type, index_data, readahead=readahead, readbehind=readbehind,
+                             decoders=decoders, cache_bytes=cache_bytes, shared_cache=shared_cache)
   else:
     raise NotImplementedError(frame_type)
 
@@ -426,23 +592,41 @@ class StreamGOPReader(GOPReader):
 class GOPFrameReader(BaseFrameReader):
   #FrameReader with caching and readahead for formats that are group-of-picture based
 
-  def __init__(self, readahead=False, readbehind=False):
+  def __init__(self, readahead=False, readbehind=False, decoders=0, cache_bytes=None, shared_cache=False):
     self.open_ = True
 
     self.readahead = readahead
     self.readbehind = readbehind
-    self.frame_cache = LRU(64)
 
-    if self.readahead:
+    # decoders > 0 keeps that many decoders alive and decodes GOPs in parallel,
+    # instead of starting an ffmpeg process for every GOP
+    self.decoder_pool = DecoderPool(self.vid_fmt, decoders) if decoders > 0 else None
+    self.decoding: dict[tuple, Future] = {}
+    self.decoding_lock = threading.Lock()
+
+    if cache_bytes is None and self.decoder_pool is not None:
+      cache_bytes = FRAME_CACHE_BYTES
+    self.frame_cache = FrameCache(cache_bytes) if cache_bytes is not None else LRU(64)
+
+    # decoded GOPs are also shared with other processes reading the same file
+    if shared_cache:
+      self.shared_cache = shared_cache if isinstance(shared_cache, SharedFrameCache) else SharedFrameCache(self.fn)
+    else:
+      self.shared_cache = None
+
+    if self.readahead and self.decoder_pool is None:
       self.cache_lock = threading.RLock()
+    else:
+      # the decoder pool dedups concurrent decodes of the same GOP itself, see _decode_gop_once
+      self.cache_lock = DoNothingContextManager()
+
+    if self.readahead:
       self.readahead_last = None
       self.readahead_len = 30
       self.readahead_c = threading.Condition()
       self.readahead_thread = threading.Thread(target=self._readahead_thread)
       self.readahead_thread.daemon = True
       self.readahead_thread.start()
-    else:
-      self.cache_lock = DoNothingContextManager()
 
   def close(self):
     if not self.open_:
@@ -455,6 +639,9 @@ class GOPFrameReader(BaseFrameReader):
       self.readahead_c.release()
       self.readahead_thread.join()
 
+    if self.decoder_pool is not None:
+      self.decoder_pool.close()
+
   def _readahead_thread(self):
     while True:
       self.readahead_c.acquire()
@@ -476,26 +663,92 @@ class GOPFrameReader(BaseFrameReader):
         for k in range(num, min(self.frame_count, num + self.readahead_len)):
           self._get_one(k, pix_fmt)
 
-  def _get_one(self, num, pix_fmt):
-    assert num < self.frame_count
-
-    if (num, pix_fmt) in self.frame_cache:
-      return self.frame_cache[(num, pix_fmt)]
-
-    with self.cache_lock:
-      if (num, pix_fmt) in self.frame_cache:
-        return self.frame_cache[(num, pix_fmt)]
+  def _decode_gop(self, num, pix_fmt):
+    ret = None
+    if self.shared_cache is not None:
+      frame_b = self._lookup_gop(num)[0]
+      ret = self.shared_cache.get_gop(frame_b, pix_fmt)
 
+    if ret is None:
       frame_b, num_frames, skip_frames, rawdat = self.get_gop(num)
 
-      ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
+      if self.decoder_pool is not None:
+        ret = self.decoder_pool.decode(rawdat, self.w, self.h, pix_fmt)
+      else:
+        ret = decompress_video_data(rawdat, self.vid_fmt, self.w, self.h, pix_fmt)
       ret = ret[skip_frames:]
-      assert ret.shape[0] == num_frames
+      assert len(ret) == num_frames
+
+      if self.shared_cache is not None:
+        self.shared_cache.put_gop(frame_b, pix_fmt, ret)
 
-      for i in range(ret.shape[0]):
-        self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
+    for i in range(len(ret)):
+      self.frame_cache[(frame_b+i, pix_fmt)] = ret[i]
 
-      return self.frame_cache[(num, pix_fmt)]
+    return frame_b, ret
+
+  def _decode_gop_once(self, num, pix_fmt):
+    # concurrent requests for the same GOP wait for a single decode
+    key = (self._lookup_gop(num)[0], pix_fmt)
+    with self.decoding_lock:
+      fut = self.decoding.get(key)
+      owner = fut is None
+      if owner:
+        fut = self.decoding[key] = Future()
+
+    if not owner:
+      return fut.result()
+
+    try:
+      ret = self._decode_gop(num, pix_fmt)
+      fut.set_result(ret)
+      return ret
+    except BaseException as e:
+      fut.set_exception(e)
+      raise
+    finally:
+      with self.decoding_lock:
+        del self.decoding[key]
+
+  def _get_one(self, num, pix_fmt):
+    assert num < self.frame_count
+
+    frame = self.frame_cache.get((num, pix_fmt))
+    if frame is not None:
+      return frame
+
+    if self.decoder_pool is not None:
+      frame_b, frames = self._decode_gop_once(num, pix_fmt)
+      return frames[num - frame_b]
+
+    with self.cache_lock:
+      frame = self.frame_cache.get((num, pix_fmt))
+      if frame is not None:
+        return frame
+
+      frame_b, frames = self._decode_gop(num, pix_fmt)
+      return frames[num - frame_b]
+
+  def _get_range(self, num, count, pix_fmt):
+    # with a decoder pool, all the GOPs overlapping the range are decoded in parallel
+    gops = []
+    k = num
+    while k < num + count:
+      frame_e = self._lookup_gop(k)[1]
+      gops.append((k, min(frame_e, num + count)))
+      k = frame_e
+
+    def get_frames(gop):
+      b, e = gop
+      frames = [self.frame_cache.get((i, pix_fmt)) for i in range(b, e)]
+      if any(f is None for f in frames):
+        frame_b, decoded = self._decode_gop_once(b, pix_fmt)
+        frames = list(decoded[b - frame_b:e - frame_b])
+      return frames
+
+    if len(gops) == 1:
+      return get_frames(gops[0])
+    return [f for frames in self.decoder_pool.executor.map(get_frames, gops) for f in frames]
 
   def get(self, num, count=1, pix_fmt="yuv420p"):
     assert self.frame_count is not None
@@ -506,7 +759,10 @@ class GOPFrameReader(BaseFrameReader):
     if pix_fmt not in ("nv12", "yuv420p", "rgb24", "yuv444p"):
       raise ValueError(f"Unsupported pixel format {pix_fmt!r}")
 
-    ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
+    if self.decoder_pool is not None:
+      ret = self._get_range(num, count, pix_fmt)
+    else:
+      ret = [self._get_one(num + i, pix_fmt) for i in range(count)]
 
     if self.readahead:
       self.readahead_last = (num+count, pix_fmt)
@@ -518,9 +774,9 @@ class GOPFrameReader(BaseFrameReader):
 
 
 class StreamFrameReader(StreamGOPReader, GOPFrameReader):
-  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False):
+  def __init__(self, fn, frame_type, index_data, readahead=False, readbehind=False, decoders=0, cache_bytes=None, shared_cache=False):
     StreamGOPReader.__init__(self, fn, frame_type, index_data)
-    GOPFrameReader.__init__(self, readahead, readbehind)
+    GOPFrameReader.__init__(self, readahead, readbehind, decoders, cache_bytes, shared_cache)
 
 
 def GOPFrameIterator(gop_reader, pix_fmt):
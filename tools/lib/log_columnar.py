@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Columnar on-disk cache of log time series. Each segment is stored as a directory with one
+sub-directory (table) per service and one .npy file per column, so columns can be memory-mapped
+without reparsing the capnp log. Variable length list columns are stored as values + offsets.
+"""
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
+from openpilot.tools.lib.log_time_series import RaggedArray
+
+COLUMNAR_VERSION = 2
+MANIFEST = "manifest.json"
+
+
+def columnar_cache_path(fn: str, cache_dir: str | None = None) -> str:
+  return cache_path_for_file_path(fn, cache_dir or DEFAULT_CACHE_DIR) + ".columnar"
+
+
+def _column_file(name: str) -> str:
+  return name.replace("/", ".")
+
+
+def _save_array(path: str, arr: np.ndarray) -> None:
+  # text and enum columns become fixed width unicode so they can be memory-mapped too
+  if arr.dtype == object and all(isinstance(v, str) for v in arr.flat):
+    arr = arr.astype(str) if len(arr) else np.empty(0, dtype='<U1')
+  np.save(path, arr, allow_pickle=arr.dtype == object)
+
+
+def _load_array(path: str, mmap: bool) -> np.ndarray:
+  try:
+    return np.load(path, mmap_mode='r' if mmap else None)
+  except ValueError:
+    # object columns (Data fields) can't be memory-mapped
+    return np.load(path, allow_pickle=True)
+
+
+def export_time_series(ts: dict, path: str, stamp=None) -> None:
+  """Writes the output of msgs_to_columns to a columnar directory at path, atomically"""
+  parent = os.path.dirname(path)
+  os.makedirs(parent, exist_ok=True)
+  tmp_path = tempfile.mkdtemp(dir=parent)
+  try:
+    manifest = {'version': COLUMNAR_VERSION, 'stamp': stamp, 'services': {}}
+    for typ, group in ts.items():
+      os.mkdir(os.path.join(tmp_path, typ))
+      columns = manifest['services'][typ] = {}
+      for name, column in group.items():
+        fn = os.path.join(tmp_path, typ, _column_file(name))
+        if isinstance(column, RaggedArray):
+          _save_array(fn + ".values.npy", column.values)
+          _save_array(fn + ".offsets.npy", column.offsets)
+          columns[name] = 'ragged'
+        else:
+          _save_array(fn + ".npy", column)
+          columns[name] = 'array'
+
+    with open(os.path.join(tmp_path, MANIFEST), "w") as f:
+      json.dump(manifest, f)
+
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.rename(tmp_path, path)
+  except Exception:
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    raise
+
+
+def read_manifest(path: str) -> dict | None:
+  try:
+    with open(os.path.join(path, MANIFEST)) as f:
+      manifest = json.load(f)
+  except FileNotFoundError:
+    return None
+  return manifest if manifest.get('version') == COLUMNAR_VERSION else None
+
+
+def has_columnar_cache(path: str, stamp=None) -> bool:
+  manifest = read_manifest(path)
+  return manifest is not None and manifest['stamp'] == (list(stamp) if stamp is not None else None)
+
+
+def _selected(path: str, fields: list[str] | None) -> bool:
+  return fields is None or any(f == path or path.startswith(f + "/") for f in fields)
+
+
+def load_time_series(path: str, fields: list[str] | None = None, mmap: bool = True) -> dict:
+  """Loads a columnar directory in the msgs_to_columns layout, only reading whitelisted columns"""
+  manifest = read_manifest(path)
+  assert manifest is not None, f"no columnar cache at {path}"
+
+  ts = {}
+  services = None if fields is None else {f.split("/")[0] for f in fields}
+  for typ, columns in manifest['services'].items():
+    if services is not None and typ not in services:
+      continue
+
+    group = ts[typ] = {}
+    for name, kind in columns.items():
+      if name not in ("t", "_valid") and not _selected(typ + "/" + name, fields):
+        continue
+
+      fn = os.path.join(path, typ, _column_file(name))
+      if kind == 'ragged':
+        group[name] = RaggedArray(_load_array(fn + ".values.npy", mmap), _load_array(fn + ".offsets.npy", mmap))
+      else:
+        group[name] = _load_array(fn + ".npy", mmap)
+  return ts
+
+
+if __name__ == "__main__":
+  import argparse
+  from openpilot.tools.lib.logreader import LogReader
+
+  parser = argparse.ArgumentParser(description="Export logs to the columnar cache")
+  parser.add_argument("route", help="route, segment range or log file")
+  args = parser.parse_args()
+
+  lr = LogReader(args.route)
+  for i in range(len(lr.logreader_identifiers)):
+    print(lr.logreader_identifiers[i], lr.export_columnar(i))
@@ -1,5 +1,341 @@
+import capnp
 import numpy as np
 
+from cereal import log as capnp_log
+
+
+# integer fields widen to int64 so differences of counters and timestamps don't wrap
+CAPNP_DTYPES = {
+  'bool': np.bool_,
+  'int8': np.int64, 'int16': np.int64, 'int32': np.int64, 'int64': np.int64,
+  'uint8': np.int64, 'uint16': np.int64, 'uint32': np.int64, 'uint64': np.uint64,
+  'float32': np.float32, 'float64': np.float64,
+  'text': object, 'data': object, 'enum': object,
+}
+INITIAL_CAPACITY = 64
+
+
+class Column:
+  """Preallocated NumPy column that grows geometrically"""
+  def __init__(self, dtype):
+    self.data = np.empty(INITIAL_CAPACITY, dtype=dtype)
+    self.n = 0
+
+  def _reserve(self, n):
+    if n > len(self.data):
+      data = np.empty(max(n, 2 * len(self.data)), dtype=self.data.dtype)
+      data[:self.n] = self.data[:self.n]
+      self.data = data
+
+  def append(self, v):
+    if self.n == len(self.data):
+      self._reserve(self.n + 1)
+    self.data[self.n] = v
+    self.n += 1
+
+  def extend(self, vs):
+    n = len(vs)
+    self._reserve(self.n + n)
+    if self.data.dtype == object:
+      for i, v in enumerate(vs):
+        self.data[self.n + i] = v
+    else:
+      self.data[self.n:self.n + n] = np.fromiter(vs, dtype=self.data.dtype, count=n)
+    self.n += n
+
+  def finish(self):
+    return self.data[:self.n]
+
+
+class RaggedArray:
+  """Variable length rows stored as a flat values array and row offsets, row i is values[offsets[i]:offsets[i+1]]"""
+  def __init__(self, values, offsets):
+    self.values = values
+    self.offsets = offsets
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __getitem__(self, i):
+    if isinstance(i, (int, np.integer)):
+      i = range(len(self))[i]
+      return self.values[self.offsets[i]:self.offsets[i + 1]]
+    return self.take(np.arange(len(self))[i])
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+  def lengths(self):
+    return np.diff(self.offsets)
+
+  def take(self, idxs):
+    idxs = np.asarray(idxs)
+    lengths = self.lengths()[idxs]
+    offsets = np.zeros(len(idxs) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    rows = [self.values[self.offsets[i]:self.offsets[i + 1]] for i in idxs]
+    values = np.concatenate(rows) if len(rows) else self.values[:0]
+    return RaggedArray(values, offsets)
+
+
+def as_ragged(column):
+  if isinstance(column, RaggedArray):
+    return column
+  width = column.shape[1] if column.ndim > 1 else 1
+  return RaggedArray(column.reshape(-1), np.arange(len(column) + 1, dtype=np.int64) * width)
+
+
+def concat_columns(columns):
+  if len(columns) == 1:
+    return columns[0]
+  if all(isinstance(c, np.ndarray) for c in columns) and len({c.shape[1:] for c in columns}) == 1:
+    return np.concatenate(columns)
+
+  parts = [as_ragged(c) for c in columns]
+  offsets = [np.zeros(1, dtype=np.int64)]
+  total = 0
+  for p in parts:
+    offsets.append(p.offsets[1:] - p.offsets[0] + total)
+    total += p.offsets[-1] - p.offsets[0]
+  values = np.concatenate([p.values[p.offsets[0]:p.offsets[-1]] for p in parts])
+  return finish_list_column(values, np.concatenate(offsets))
+
+
+def concat_time_series(series):
+  """Concatenates the time series of consecutive segments, services missing from a segment are skipped"""
+  ret = {}
+  for typ in dict.fromkeys(typ for ts in series for typ in ts):
+    groups = [ts[typ] for ts in series if typ in ts]
+    names = dict.fromkeys(name for group in groups for name in group)
+    ret[typ] = {name: concat_columns([group[name] for group in groups if name in group]) for name in names}
+  return ret
+
+
+def finish_list_column(values, offsets):
+  # equal length lists are returned as a 2D view, like the old behavior for homogeneous lists
+  lengths = np.diff(offsets)
+  if len(lengths) and np.all(lengths == lengths[0]):
+    return values.reshape(len(lengths), lengths[0])
+  return RaggedArray(values, offsets)
+
+
+def _selected(path, fields):
+  # a field is extracted if it or one of its parents/children is whitelisted
+  return fields is None or any(f == path or f.startswith(path + "/") or path.startswith(f + "/") for f in fields)
+
+
+class ScalarExtractor:
+  def __init__(self, name, typ):
+    self.name = name
+    self.is_enum = typ == 'enum'
+    self.column = Column(CAPNP_DTYPES[typ])
+
+  def fill(self, reader):
+    v = reader._get(self.name)
+    self.column.append(str(v) if self.is_enum else v)
+
+  def fill_default(self):
+    self.column.append('' if self.column.data.dtype == object else 0)
+
+  def columns(self, prefix, offsets=None):
+    values = self.column.finish()
+    return {prefix: values if offsets is None else finish_list_column(values, offsets)}
+
+
+class ListExtractor:
+  def __init__(self, name, typ):
+    self.name = name
+    self.is_enum = typ == 'enum'
+    self.values = Column(CAPNP_DTYPES[typ])
+    self.offsets = Column(np.int64)
+    self.offsets.append(0)
+
+  def fill(self, reader):
+    lst = reader._get(self.name)
+    self.values.extend([str(v) for v in lst] if self.is_enum else lst)
+    self.offsets.append(self.values.n)
+
+  def fill_default(self):
+    self.offsets.append(self.values.n)
+
+  def columns(self, prefix, offsets=None):
+    return {prefix: finish_list_column(self.values.finish(), self.offsets.finish())}
+
+
+def potentially_ragged_array(arr, dtype=None, **kwargs):
+  try:
+    return np.array(arr, dtype=dtype, **kwargs)
+  except ValueError:
+    return np.array(arr, dtype=object, **kwargs)
+
+
+def to_python(v):
+  if isinstance(v, capnp.lib.capnp._DynamicListReader):
+    return [to_python(x) for x in v]
+  elif isinstance(v, capnp.lib.capnp._DynamicStructReader):
+    return v.to_dict(verbose=True)
+  elif isinstance(v, capnp.lib.capnp._DynamicEnum):
+    return str(v)
+  return v
+
+
+class ObjectExtractor:
+  """
+  Lists that don't flatten into columns (lists of lists, lists inside lists of structs) are read per message,
+  each value is an array like the old to_dict based extraction returned
+  """
+  def __init__(self, name):
+    self.name = name
+    self.column = Column(object)
+
+  def fill(self, reader):
+    self.column.append(potentially_ragged_array(to_python(reader._get(self.name))))
+
+  def fill_default(self):
+    self.column.append(np.array([]))
+
+  def columns(self, prefix, offsets=None):
+    values = self.column.finish()
+    return {prefix: values if offsets is None else finish_list_column(values, offsets)}
+
+
+class StructExtractor:
+  def __init__(self, name, schema, path, fields, allow_lists=True):
+    self.name = name
+    self.children = {}
+    self.union_fields = set(schema.union_fields)
+    for field_name, field in schema.fields.items():
+      child_path = path + "/" + field_name
+      if not _selected(child_path, fields):
+        continue
+      child = build_extractor(field_name, field, child_path, fields, allow_lists)
+      if child is not None:
+        self.children[field_name] = child
+
+  def fill(self, reader):
+    if self.name is not None:
+      reader = reader._get(self.name)
+
+    which = reader.which() if len(self.union_fields) else None
+    for field_name, child in self.children.items():
+      # inactive union members can't be read, they get default values
+      if field_name in self.union_fields and field_name != which:
+        child.fill_default()
+      else:
+        child.fill(reader)
+
+  def fill_default(self):
+    for child in self.children.values():
+      child.fill_default()
+
+  def columns(self, prefix, offsets=None):
+    ret = {}
+    for field_name, child in self.children.items():
+      ret.update(child.columns(field_name if prefix is None else prefix + "/" + field_name, offsets))
+    return ret
+
+
+class StructListExtractor:
+  """Lists of structs are flattened into one list column per scalar leaf field, sharing the same offsets"""
+  def __init__(self, name, schema, path, fields):
+    self.name = name
+    self.element = StructExtractor(None, schema, path, fields, allow_lists=False)
+    self.offsets = Column(np.int64)
+    self.offsets.append(0)
+    self.n = 0
+
+  def fill(self, reader):
+    lst = reader._get(self.name)
+    for el in lst:
+      self.element.fill(el)
+    self.n += len(lst)
+    self.offsets.append(self.n)
+
+  def fill_default(self):
+    self.offsets.append(self.n)
+
+  def columns(self, prefix, offsets=None):
+    return self.element.columns(prefix, self.offsets.finish())
+
+
+def build_extractor(name, field, path, fields, allow_lists=True):
+  proto = field.proto
+  if proto.which() == 'group':
+    return StructExtractor(name, field.schema, path, fields, allow_lists)
+
+  typ = proto.slot.type.which()
+  if typ in CAPNP_DTYPES:
+    return ScalarExtractor(name, typ)
+  elif typ == 'struct':
+    return StructExtractor(name, field.schema, path, fields, allow_lists)
+  elif typ == 'list':
+    element_type = proto.slot.type.list.elementType.which()
+    if allow_lists and element_type in CAPNP_DTYPES:
+      return ListExtractor(name, element_type)
+    elif allow_lists and element_type == 'struct':
+      return StructListExtractor(name, field.schema.elementType, path, fields)
+    return ObjectExtractor(name)
+
+  # AnyPointer and interface fields have no values to extract
+  return None
+
+
+class ServiceExtractor:
+  def __init__(self, service, fields):
+    self.service = service
+    self.t = Column(np.float64)
+    self.valid = Column(np.bool_)
+    self.extractor = build_extractor(service, capnp_log.Event.schema.fields[service], service, fields)
+
+  def fill(self, msg):
+    self.t.append(msg.logMonoTime / 1.0e9)
+    self.valid.append(msg.valid)
+    self.extractor.fill(msg)
+
+  def columns(self):
+    group = {"t": self.t.finish(), "_valid": self.valid.finish()}
+    if isinstance(self.extractor, (StructExtractor, StructListExtractor)):
+      group.update(self.extractor.columns(None))
+    else:
+      group.update(self.extractor.columns(self.service))
+
+    # sort values by time
+    order = np.argsort(group["t"], kind="stable")
+    if np.any(order != np.arange(len(order))):
+      for name, values in group.items():
+        group[name] = values.take(order) if isinstance(values, RaggedArray) else values[order]
+    return group
+
+
+def msgs_to_columns(msgs, fields: list[str] | None = None):
+  """
+    Convert an iterable of canonical capnp messages into a dictionary of columns per service, read with the schema.
+    Each group has a value with key "t" which consists of monotonically increasing timestamps in seconds.
+
+    fields optionally whitelists services or "service/field/path" entries to extract, everything
+    else is skipped without being read. Fixed length lists become 2D arrays, variable length ones
+    a RaggedArray of values and offsets. Unlike msgs_to_time_series, lists of structs are split into
+    a list column per leaf field ("can/address"), enums and text are object arrays, inactive union
+    fields get default values and every service with struct fields is extracted, qcomGnss and ubloxGnss included.
+  """
+  services = None if fields is None else {f.split("/")[0] for f in fields}
+  extractors: dict[str, ServiceExtractor | None] = {}
+  for msg in msgs:
+    typ = msg.which()
+    if services is not None and typ not in services:
+      continue
+
+    if typ not in extractors:
+      extractor = ServiceExtractor(typ, fields)
+      extractors[typ] = extractor if extractor.extractor is not None else None
+
+    extractor = extractors[typ]
+    if extractor is not None:
+      extractor.fill(msg)
+
+  return {typ: extractor.columns() for typ, extractor in extractors.items() if extractor is not None}
+
 
 def flatten_type_dict(d, sep="/", prefix=None):
   res = {}
@@ -45,13 +381,6 @@ def append_dict(path, t, d, values):
     group[k].append(v)
 
 
-def potentially_ragged_array(arr, dtype=None, **kwargs):
-  # TODO: is there a better way to detect inhomogeneous shapes?
-  try:
-    return np.array(arr, dtype=dtype, **kwargs)
-  except ValueError:
-    return np.array(arr, dtype=object, **kwargs)
-
 def msgs_to_time_series(msgs):
   """
     Convert an iterable of canonical capnp messages into a dictionary of time series.
@@ -79,6 +408,6 @@ def msgs_to_time_series(msgs):
 if __name__ == "__main__":
   import sys
   from openpilot.tools.lib.logreader import LogReader
-  m = msgs_to_time_series(LogReader(sys.argv[1]))
+  m = msgs_to_columns(LogReader(sys.argv[1]), ['driverCameraState'])
   print(m['driverCameraState']['t'])
   print(np.diff(m['driverCameraState']['timestampSof']))
@@ -1,11 +1,17 @@
 #!/usr/bin/env python3
 import bz2
-from functools import cache, partial
+from functools import cache, partial, reduce
 import multiprocessing
+import multiprocessing.pool
 import capnp
+import collections
 import enum
+import heapq
+import io
 import os
 import pathlib
+import pickle
+import struct
 import sys
 import tqdm
 import urllib.parse
@@ -13,20 +19,30 @@ import warnings
 import zstandard as zstd
 
 from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.tools.lib.cache import cache_path_for_file_path, DEFAULT_CACHE_DIR
 from openpilot.tools.lib.comma_car_segments import get_url as get_comma_segments_url
 from openpilot.tools.lib.openpilotci import get_url
-from openpilot.tools.lib.filereader import FileReader, file_exists, internal_source_available
+from openpilot.tools.lib.filereader import FileReader, file_exists, file_stamp, internal_source_available
 from openpilot.tools.lib.route import Route, SegmentRange
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_columnar import columnar_cache_path, export_time_series, has_columnar_cache, load_time_series
+from openpilot.tools.lib.log_time_series import concat_time_series, msgs_to_columns, msgs_to_time_series
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'
+
+# streaming mode: compressed bytes read per step, and events held back to re-sort by logMonoTime
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_REORDER_WINDOW = 4096
+
 
 def save_log(dest, log_msgs, compress=True):
   dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
@@ -48,27 +64,111 @@ def decompress_stream(data: bytes):
 
   return decompressed_data
 
+def decompress_stream_chunks(f, ext: str | None = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+  """Incrementally decompress a bz2, zstd or uncompressed file object, chunk_size compressed bytes at a time"""
+  dat = f.read(chunk_size)
+  if ext == ".bz2" or dat.startswith(b'BZh9'):
+    new_decompressor = bz2.BZ2Decompressor
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    new_decompressor = zstd.ZstdDecompressor().decompressobj
+  else:
+    new_decompressor = None
+
+  decompressor = new_decompressor() if new_decompressor is not None else None
+  while dat:
+    if decompressor is None:
+      yield dat
+      dat = b""
+    else:
+      out = decompressor.decompress(dat)
+      if out:
+        yield out
+      # files may be made up of multiple concatenated streams/frames
+      if decompressor.eof:
+        dat, decompressor = decompressor.unused_data, new_decompressor()
+      else:
+        dat = b""
+
+    if not dat:
+      dat = f.read(chunk_size)
+
+def complete_message_ends(buf: bytes | bytearray) -> list[int]:
+  """Returns the offset just past each complete capnp message at the start of buf"""
+  # https://capnproto.org/encoding.html#serialization-over-a-stream
+  ends = []
+  pos = 0
+  while pos + 4 <= len(buf):
+    num_segments = struct.unpack_from('<I', buf, pos)[0] + 1
+    header_size = 4 + 4 * num_segments
+    header_size += header_size % 8
+    if pos + header_size > len(buf):
+      break
+
+    end = pos + header_size + 8 * sum(struct.unpack_from(f'<{num_segments}I', buf, pos + 4))
+    if end > len(buf):
+      break
+    ends.append(end)
+    pos = end
+  return ends
+
+def iter_message_batches(f, ext: str | None = None, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[tuple[bytes, list[int]]]:
+  """Yields runs of complete capnp messages from a (compressed) log file object, along with each message's end offset"""
+  buf = bytearray()
+  for chunk in decompress_stream_chunks(f, ext, chunk_size):
+    buf += chunk
+    ends = complete_message_ends(buf)
+    if not ends:
+      continue
+
+    dat = bytes(buf[:ends[-1]])
+    del buf[:ends[-1]]
+    yield dat, ends
+
+  if len(buf):
+    warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+def log_file_ext(fn: str) -> str:
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ('', '.bz2', '.zst'):
+    # old rlogs weren't compressed
+    raise ValueError(f"unknown extension {ext}")
+  return ext
+
+def decompress_log_data(dat: bytes, ext: str | None = None) -> bytes:
+  if ext == ".bz2" or dat.startswith(b'BZh9'):
+    return bz2.decompress(dat)
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+    return decompress_stream(dat)
+  return dat
+
+def read_log_data(fn: str) -> bytes:
+  """Downloads and decompresses a log file, both release the GIL so this can run in a background thread"""
+  ext = log_file_ext(fn)
+  with FileReader(fn) as f:
+    return decompress_log_data(f.read(), ext)
+
 class _LogFileReader:
-  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None):
+  def __init__(self, fn, canonicalize=True, only_union_types=False, sort_by_time=False, dat=None,
+               streaming=False, chunk_size=STREAM_CHUNK_SIZE, reorder_window=STREAM_REORDER_WINDOW):
     self.data_version = None
     self._only_union_types = only_union_types
+    self._sort_by_time = sort_by_time
 
     ext = None
     if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
-        # old rlogs weren't compressed
-        raise ValueError(f"unknown extension {ext}")
-
-      with FileReader(fn) as f:
-        dat = f.read()
-
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = decompress_stream(dat)
-
+      ext = log_file_ext(fn)
+
+    # in streaming mode nothing is read until iteration, and events are parsed
+    # as the file is decompressed instead of being held in memory
+    self._streaming = streaming
+    if streaming:
+      self._fn, self._ext, self._dat = fn, ext, dat
+      self._chunk_size = chunk_size
+      self._reorder_window = reorder_window
+      return
+
+    dat = read_log_data(fn) if not dat else decompress_log_data(dat)
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
     self._ents = []
@@ -81,8 +181,33 @@ class _LogFileReader:
     if sort_by_time:
       self._ents.sort(key=lambda x: x.logMonoTime)
 
+  def _stream_events(self) -> Iterator[capnp._DynamicStructReader]:
+    with (io.BytesIO(self._dat) if self._dat else FileReader(self._fn)) as f:
+      try:
+        for dat, _ in iter_message_batches(f, self._ext, self._chunk_size):
+          yield from capnp_log.Event.read_multiple_bytes(dat)
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  def _stream_sorted_events(self) -> Iterator[capnp._DynamicStructReader]:
+    # bounded reorder buffer, exact as long as no event is more than reorder_window events out of place
+    heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+    for i, ent in enumerate(self._stream_events()):
+      if len(heap) < self._reorder_window:
+        heapq.heappush(heap, (ent.logMonoTime, i, ent))
+      else:
+        yield heapq.heappushpop(heap, (ent.logMonoTime, i, ent))[2]
+
+    while heap:
+      yield heapq.heappop(heap)[2]
+
+  def _events(self) -> Iterator[capnp._DynamicStructReader]:
+    if not self._streaming:
+      return iter(self._ents)
+    return self._stream_sorted_events() if self._sort_by_time else self._stream_events()
+
   def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
-    for ent in self._ents:
+    for ent in self._events():
       if self._only_union_types:
         try:
           ent.which()
@@ -93,6 +218,102 @@ class _LogFileReader:
         yield ent
 
 
+def _run_on_log_file(func, fn, **kwargs):
+  return func(_LogFileReader(fn, **kwargs))
+
+
+def _run_indexed(func, item):
+  i, arg = item
+  return i, func(arg)
+
+
+LOG_INDEX_VERSION = 1
+
+
+def log_index_path(fn: str, cache_dir: str | None = None) -> str:
+  return cache_path_for_file_path(fn, cache_dir or DEFAULT_CACHE_DIR) + ".msgindex"
+
+
+def build_log_index(fn: str, keep: str | None = None) -> tuple[dict, list[capnp._DynamicStructReader]]:
+  """
+  Builds a per union type index of decompressed (start, end) byte offsets and the logMonoTime range of a log file.
+  The events of type keep are returned too, so they don't need a second pass over the file.
+  """
+  types: dict[str, dict] = {}
+  kept = []
+  pos = 0
+  with FileReader(fn) as f:
+    try:
+      for dat, ends in iter_message_batches(f, log_file_ext(fn)):
+        start = 0
+        for ent, end in zip(capnp_log.Event.read_multiple_bytes(dat), ends, strict=True):
+          try:
+            which = ent.which()
+          except capnp.KjException:
+            which = None
+
+          if which is not None:
+            entry = types.setdefault(which, {'offsets': [], 'mono_range': (ent.logMonoTime, ent.logMonoTime)})
+            entry['offsets'].append((pos + start, pos + end))
+            entry['mono_range'] = (min(entry['mono_range'][0], ent.logMonoTime), max(entry['mono_range'][1], ent.logMonoTime))
+            if which == keep:
+              kept.append(ent)
+          start = end
+        pos += len(dat)
+    except capnp.KjException:
+      warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+
+  return {'version': LOG_INDEX_VERSION, 'stamp': file_stamp(fn), 'size': pos, 'types': types}, kept
+
+
+def load_log_index(fn: str, cache_dir: str | None = None) -> dict | None:
+  index_path = log_index_path(fn, cache_dir)
+  if os.path.exists(index_path):
+    with open(index_path, "rb") as index_file:
+      index = pickle.load(index_file)
+    if index.get('version') == LOG_INDEX_VERSION and index['stamp'] == file_stamp(fn):
+      return index
+  return None
+
+
+def save_log_index(fn: str, index: dict, cache_dir: str | None = None) -> None:
+  with atomic_write_in_dir(log_index_path(fn, cache_dir), mode="wb", overwrite=True) as index_file:
+    pickle.dump(index, index_file, -1)
+
+
+def get_log_index(fn: str, cache_dir: str | None = None) -> dict:
+  index = load_log_index(fn, cache_dir)
+  if index is None:
+    index, _ = build_log_index(fn)
+    save_log_index(fn, index, cache_dir)
+  return index
+
+
+def read_indexed_events(fn: str, offsets: list[tuple[int, int]]) -> Iterator[capnp._DynamicStructReader]:
+  """Parses only the events at the given decompressed offsets, decompressing no further than the last one"""
+  if not len(offsets):
+    return
+
+  buf = bytearray()
+  buf_pos = 0  # decompressed offset of buf[0]
+  k = 0
+  with FileReader(fn) as f:
+    for chunk in decompress_stream_chunks(f, log_file_ext(fn)):
+      buf += chunk
+      while k < len(offsets) and offsets[k][1] <= buf_pos + len(buf):
+        start, end = offsets[k]
+        yield from capnp_log.Event.read_multiple_bytes(bytes(buf[start - buf_pos:end - buf_pos]))
+        k += 1
+
+      if k == len(offsets):
+        return
+
+      # only keep what's needed for the next event
+      drop = min(offsets[k][0] - buf_pos, len(buf))
+      del buf[:drop]
+      buf_pos += drop
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -275,7 +496,8 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               source: Source = auto_source, sort_by_time=False, only_union_types=False):
+               source: Source = auto_source, sort_by_time=False, only_union_types=False, streaming=False,
+               use_index=False, prefetch=0):
     self.default_mode = default_mode
     self.source = source
     self.identifier = identifier
@@ -284,29 +506,124 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.streaming = streaming
+    # filter and first use a cached per-segment message type index to skip unrelated events of local files
+    self.use_index = use_index
+    # number of segments downloaded and decompressed ahead of iteration in background threads
+    self.prefetch = prefetch
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    self._prefetch_pool: ThreadPoolExecutor | None = None
+    self._pool: multiprocessing.pool.Pool | None = None
+    self._pool_size = 0
     self.reset()
 
+  def __getstate__(self):
+    # pools can't be pickled, workers get their own
+    state = self.__dict__.copy()
+    state['_prefetch_pool'] = state['_pool'] = None
+    state['_pool_size'] = 0
+    return state
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def __del__(self):
+    self.close()
+
+  def close(self):
+    if self._prefetch_pool is not None:
+      self._prefetch_pool.shutdown(wait=False, cancel_futures=True)
+      self._prefetch_pool = None
+    if self._pool is not None:
+      self._pool.terminate()
+      self._pool = None
+
+  def _new_lr(self, i, dat=None):
+    return _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types,
+                          streaming=self.streaming, dat=dat)
+
   def _get_lr(self, i):
     if i not in self.__lrs:
-      self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
+      self.__lrs[i] = self._new_lr(i)
     return self.__lrs[i]
 
+  def _iter_prefetched(self) -> Iterator[_LogFileReader]:
+    if self._prefetch_pool is None:
+      self._prefetch_pool = ThreadPoolExecutor(max_workers=self.prefetch, thread_name_prefix="logreader")
+
+    # in order, with at most prefetch segments in flight besides the one being consumed
+    num_segs = len(self.logreader_identifiers)
+    pending: collections.deque[tuple[int, Future | None]] = collections.deque()
+    for i in range(num_segs):
+      while len(pending) <= self.prefetch and i + len(pending) < num_segs:
+        j = i + len(pending)
+        fut = self._prefetch_pool.submit(read_log_data, self.logreader_identifiers[j]) if j not in self.__lrs else None
+        pending.append((j, fut))
+
+      j, fut = pending.popleft()
+      if fut is not None:
+        # parse in this thread, only download and decompression overlap with the consumer
+        self.__lrs[j] = self._new_lr(j, dat=fut.result())
+      yield self.__lrs[j]
+
   def __iter__(self):
+    if self.prefetch > 0 and not self.streaming:
+      for lr in self._iter_prefetched():
+        yield from lr
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
-  def _run_on_segment(self, func, i):
-    return func(self._get_lr(i))
-
-  def run_across_segments(self, num_processes, func, desc=None):
-    with multiprocessing.Pool(num_processes) as pool:
-      ret = []
-      num_segs = len(self.logreader_identifiers)
-      for p in tqdm.tqdm(pool.imap(partial(self._run_on_segment, func), range(num_segs)), total=num_segs, desc=desc):
-        ret.extend(p)
-      return ret
+  def _get_pool(self, num_processes):
+    # reused across calls instead of forking a new pool every time
+    if self._pool is None or self._pool_size != num_processes:
+      if self._pool is not None:
+        self._pool.terminate()
+      self._pool = multiprocessing.Pool(num_processes)
+      self._pool_size = num_processes
+    return self._pool
+
+  def _segment_job(self, func):
+    # only the segment identifier and reader options are shipped to workers, never this LogReader
+    return partial(_run_on_log_file, func, sort_by_time=self.sort_by_time, only_union_types=self.only_union_types, streaming=self.streaming)
+
+  def imap_segments(self, num_processes, func, ordered=True, desc=None) -> Iterator:
+    """Yields func(segment) for every segment as workers finish, in segment order if ordered is set"""
+    pool = self._get_pool(num_processes)
+    num_segs = len(self.logreader_identifiers)
+    results = pool.imap_unordered(partial(_run_indexed, self._segment_job(func)), enumerate(self.logreader_identifiers))
+
+    finished = {}
+    next_i = 0
+    for i, result in tqdm.tqdm(results, total=num_segs, desc=desc):
+      if not ordered:
+        yield result
+        continue
+
+      finished[i] = result
+      while next_i in finished:
+        yield finished.pop(next_i)
+        next_i += 1
+
+  def run_across_segments(self, num_processes, func, desc=None, reducer=None, initial=None, ordered=True):
+    """
+      Runs func on every segment in a pool of num_processes workers. By default the results are
+      concatenated into a list, pass reducer(accumulated, segment_result) to aggregate them instead
+      without holding every result in memory.
+    """
+    results = self.imap_segments(num_processes, func, ordered=ordered, desc=desc)
+    if reducer is not None:
+      return reduce(reducer, results) if initial is None else reduce(reducer, results, initial)
+
+    ret = []
+    for p in results:
+      ret.extend(p)
+    return ret
 
   def reset(self):
     self.logreader_identifiers = []
@@ -317,16 +634,61 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def _filter_segment(self, i, msg_type: str) -> LogIterable:
+    fn = self.logreader_identifiers[i]
+    # remote files would be downloaded again by every filter, their parsed segments are kept instead
+    if not self.use_index or i in self.__lrs or file_stamp(fn) is None:
+      return filter(lambda m: m.which() == msg_type, self._get_lr(i))
+
+    index = load_log_index(fn)
+    if index is None:
+      # the events are found in the same pass that builds the index
+      index, ents = build_log_index(fn, msg_type)
+      save_log_index(fn, index)
+    else:
+      entry = index['types'].get(msg_type)
+      ents = read_indexed_events(fn, entry['offsets']) if entry is not None else iter(())
+
+    return sorted(ents, key=lambda x: x.logMonoTime) if self.sort_by_time else ents
+
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    return (getattr(m, msg_type) for i in range(len(self.logreader_identifiers)) for m in self._filter_segment(i, msg_type))
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
 
+  def export_columnar(self, i) -> str:
+    fn = self.logreader_identifiers[i]
+    path = columnar_cache_path(fn)
+    if not has_columnar_cache(path, file_stamp(fn)):
+      export_time_series(msgs_to_columns(self._get_lr(i)), path, file_stamp(fn))
+    return path
+
+  def _segment_time_series(self, i, fields: list[str] | None = None, export: bool = False):
+    fn = self.logreader_identifiers[i]
+    if export:
+      return load_time_series(self.export_columnar(i), fields)
+
+    path = columnar_cache_path(fn)
+    if has_columnar_cache(path, file_stamp(fn)):
+      return load_time_series(path, fields)
+    return msgs_to_columns(self._get_lr(i), fields)
+
   @property
   def time_series(self):
     return msgs_to_time_series(self)
 
+  def time_series_fields(self, fields: list[str] | None = None):
+    """Columns of every service in the msgs_to_columns layout, optionally only the whitelisted fields"""
+    # segments already exported to the columnar cache are memory-mapped instead of parsed
+    return concat_time_series([self._segment_time_series(i, fields) for i in range(len(self.logreader_identifiers))])
+
+  def table(self, service: str, fields: list[str] | None = None) -> dict:
+    """Columns of a single service, exporting segments to the columnar cache on first use"""
+    fields = [service] if fields is None else [f"{service}/{f}" for f in fields]
+    ts = concat_time_series([self._segment_time_series(i, fields, export=True) for i in range(len(self.logreader_identifiers))])
+    return ts.get(service, {})
+
 if __name__ == "__main__":
   import codecs
 
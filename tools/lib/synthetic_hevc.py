@@ -0,0 +1,42 @@
+import random
+
+from openpilot.tools.lib.vidindex import HevcNalUnitType
+
+# synthetic H.265 streams, for testing and benchmarking the indexer without real video
+
+
+def nal_unit(nal_unit_type: HevcNalUnitType, payload: bytes, long_start_code: bool = False) -> bytes:
+  start_code = b"\x00\x00\x00\x01" if long_start_code else b"\x00\x00\x01"
+  return start_code + bytes([nal_unit_type << 1, 0x01]) + payload
+
+
+def random_payload(rng: random.Random, size: int) -> bytes:
+  # payload bytes are never 0, so there are no start codes or emulation prevention bytes inside NAL units
+  return rng.randbytes(size).replace(b"\x00", b"\x01")
+
+
+def slice_header(nal_unit_type: HevcNalUnitType, slice_type: int, first_slice: bool, rng: random.Random, payload_size: int) -> bytes:
+  ue = {0: "1", 1: "010", 2: "011"}
+  bits = ("1" if first_slice else "0")
+  if HevcNalUnitType.BLA_W_LP <= nal_unit_type <= HevcNalUnitType.RSV_IRAP_VCL23:
+    bits += "0"
+  bits += "1" + ue[slice_type]  # slice_pic_parameter_set_id = 0, slice_type
+  bits += "1" * (-len(bits) % 8)
+  return int(bits, 2).to_bytes(len(bits) // 8, "big") + random_payload(rng, rng.randint(0, 2 * payload_size))
+
+
+def make_hevc_stream(num_frames: int = 60, gop_size: int = 20, slices_per_frame: int = 2, payload_size: int = 32, seed: int = 0) -> bytes:
+  """Synthetic H.265 byte stream with parameter sets, AUDs and multi-slice I/P frames"""
+  rng = random.Random(seed)
+  dat = [b"\x00"]
+  for frame in range(num_frames):
+    dat.append(nal_unit(HevcNalUnitType.AUD_NUT, b"\x50", long_start_code=frame > 0))
+    if frame % gop_size == 0:
+      for ps in (HevcNalUnitType.VPS_NUT, HevcNalUnitType.SPS_NUT, HevcNalUnitType.PPS_NUT):
+        dat.append(nal_unit(ps, random_payload(rng, 24)))
+      nal_unit_type, slice_type = HevcNalUnitType.IDR_W_RADL, 2
+    else:
+      nal_unit_type, slice_type = HevcNalUnitType.TRAIL_R, 1
+    for s in range(slices_per_frame):
+      dat.append(nal_unit(nal_unit_type, slice_header(nal_unit_type, slice_type, s == 0, rng, payload_size)))
+  return b"".join(dat)
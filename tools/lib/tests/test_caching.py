@@ -6,7 +6,7 @@ import pytest
 
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
-from openpilot.tools.lib.url_file import URLFile
+from openpilot.tools.lib.url_file import DownloadCache, URLFile
 
 
 class CachingTestRequestHandler(http.server.BaseHTTPRequestHandler):
@@ -128,3 +128,142 @@ class TestFileDownload:
     CachingTestRequestHandler.FILE_EXISTS = True
     length = URLFile(file_url).get_length()
     assert length == 4
+
+
+class RangeRequestHandler(http.server.BaseHTTPRequestHandler):
+  DATA = bytes(i % 251 for i in range(10_500))
+
+  def do_GET(self):
+    data = self.DATA
+    if "Range" in self.headers:
+      start, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+      data = data[start:end + 1]
+      self.send_response(206)
+    else:
+      self.send_response(200)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", str(len(self.DATA)))
+    self.end_headers()
+
+
+class ShortRangeRequestHandler(RangeRequestHandler):
+  # the file got shorter than its HEAD says
+  def do_GET(self):
+    start, end = (int(x) for x in self.headers["Range"].removeprefix("bytes=").split("-"))
+    data = self.DATA[:5500][start:end + 1]
+    self.send_response(206)
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+
+class MissingRequestHandler(RangeRequestHandler):
+  def do_GET(self):
+    self.send_response(404)
+    self.end_headers()
+
+  do_HEAD = do_GET
+
+
+class TestDownloadCache:
+  @pytest.mark.parametrize("concurrency", [1, 4])
+  def test_chunked_read(self, mocker, monkeypatch, tmp_path, concurrency):
+    mocker.patch("openpilot.tools.lib.url_file.CHUNK_SIZE", 1000)
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    with http_server_context(handler=RangeRequestHandler) as (host, port):
+      url = f"http://{host}:{port}/test.bin"
+      for start, length in [(0, None), (0, 1), (999, 2), (1500, 3000), (10_000, 1000), (2000, 0)]:
+        for _ in range(2):  # cold, then from cache
+          f = URLFile(url, cache=True, concurrency=concurrency)
+          f.seek(start)
+          end = len(RangeRequestHandler.DATA) if length is None else start + length
+          assert f.read(length) == RangeRequestHandler.DATA[start:end]
+
+  def test_missing_or_short_file(self, mocker, monkeypatch, tmp_path):
+    mocker.patch("openpilot.tools.lib.url_file.CHUNK_SIZE", 1000)
+    monkeypatch.setenv("COMMA_CACHE", str(tmp_path))
+    with http_server_context(handler=MissingRequestHandler) as (host, port):
+      f = URLFile(f"http://{host}:{port}/missing.bin", cache=True)
+      assert f.read(100) == b""
+      assert DownloadCache.instance().get(f._chunk_name(0)) is None
+
+    with http_server_context(handler=ShortRangeRequestHandler) as (host, port):
+      f = URLFile(f"http://{host}:{port}/short.bin", cache=True, concurrency=4)
+      f.seek(4000)
+      assert f.read(3000) == RangeRequestHandler.DATA[4000:5500]
+      assert f._pos == 5500
+
+      # only the complete chunks are cached
+      assert DownloadCache.instance().get(f._chunk_name(4)) is not None
+      assert DownloadCache.instance().get(f._chunk_name(5)) is None
+      assert DownloadCache.instance().get(f._chunk_name(6)) is None
+
+  def test_lru_eviction(self, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size=30)
+    for name in ("a", "b", "c"):
+      cache.put(name, b"x" * 10)
+    assert cache.get("a") is not None  # a is now the most recently used
+
+    cache.put("d", b"x" * 10)
+    assert list(cache.entries) == ["c", "a", "d"]
+    assert not os.path.exists(tmp_path / "b")
+    assert cache.total_size == 30
+
+    # access order survives a reload through the index file
+    cache.get("c")
+    cache.save(force=True)
+    assert list(DownloadCache(str(tmp_path), max_size=30).entries) == ["a", "d", "c"]
+
+  def test_load_trusts_index(self, mocker, tmp_path):
+    cache = DownloadCache(str(tmp_path), max_size=30)
+    for name in ("a", "b"):
+      cache.put(name, b"x" * 10)
+    cache.save(force=True)
+
+    # sizes come from the index, the files aren't looked at
+    scandir = mocker.patch("openpilot.tools.lib.url_file.os.scandir", wraps=os.scandir)
+    cache = DownloadCache(str(tmp_path), max_size=30)
+    assert list(cache.entries.items()) == [("a", 10), ("b", 10)] and cache.total_size == 20
+    cache.put("c", b"x" * 10)
+    assert scandir.call_count == 0
+
+    # without an index the files are scanned on the first put, before evicting
+    os.remove(tmp_path / DownloadCache.INDEX_FILE)
+    cache = DownloadCache(str(tmp_path), max_size=30)
+    assert cache.total_size == 0 and scandir.call_count == 0
+    cache.put("d", b"x" * 10)
+    assert scandir.call_count == 1
+    assert list(cache.entries)[-1] == "d" and cache.total_size == 30
+
+  def test_instance_max_size(self, tmp_path):
+    cache = DownloadCache.instance(str(tmp_path), max_size=30)
+    for name in ("a", "b", "c"):
+      cache.put(name, b"x" * 10)
+
+    assert DownloadCache.instance(str(tmp_path), max_size=20) is cache
+    assert cache.max_size == 20 and list(cache.entries) == ["b", "c"]
+    assert not os.path.exists(tmp_path / "a")
+
+  def test_shared_directory(self, tmp_path):
+    # workers sharing the directory, each with its own instance, only the main process evicts
+    workers = [DownloadCache(str(tmp_path), max_size=30) for _ in range(2)]
+    for i in range(2):
+      for j, worker in enumerate(workers):
+        worker.put(f"{j}_{i}", b"x" * 10, evict=False)
+    for worker in workers:
+      worker.save(force=True)
+
+    # neither worker overwrote the entries of the other in the index
+    assert sorted(DownloadCache(str(tmp_path), max_size=30).entries) == ["0_0", "0_1", "1_0", "1_1"]
+    assert all(os.path.exists(tmp_path / name) for name in ("0_0", "0_1", "1_0", "1_1"))
+
+    main = DownloadCache(str(tmp_path), max_size=30)
+    main.evict(keep={"0_0"})
+    assert list(main.entries) == ["0_0", "1_0", "1_1"]
+    assert not os.path.exists(tmp_path / "0_1")
+    assert list(DownloadCache(str(tmp_path), max_size=30).entries) == ["0_0", "1_0", "1_1"]
@@ -0,0 +1,171 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pytest
+
+from openpilot.tools.lib.framereader import AVDecoder, DecoderPool, FrameCache, FrameType, SharedFrameCache, StreamFrameReader, \
+                                            decompress_video_data
+from openpilot.tools.lib.url_file import DownloadCache
+from openpilot.tools.lib.vidindex import hevc_index
+
+W, H = 320, 240
+GOP_SIZE = 20
+NUM_FRAMES = 70
+
+
+@pytest.fixture(scope="module")
+def hevc_file():
+  av = pytest.importorskip("av")
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fn = os.path.join(tmpdir, "fcamera.hevc")
+    with av.open(fn, "w", format="hevc") as container:
+      stream = container.add_stream("libx265", rate=20)
+      stream.width, stream.height, stream.pix_fmt = W, H, "yuv420p"
+      stream.options = {"x265-params": f"keyint={GOP_SIZE}:min-keyint={GOP_SIZE}:bframes=0:scenecut=0:log-level=error"}
+      for i in range(NUM_FRAMES):
+        img = np.zeros((H, W, 3), dtype=np.uint8)
+        img[:, :, 0] = i * 3
+        img[i:i + 40, 20:60] = 255
+        for packet in stream.encode(av.VideoFrame.from_ndarray(img, format="rgb24")):
+          container.mux(packet)
+      for packet in stream.encode():
+        container.mux(packet)
+    yield fn
+
+
+def frame_reader(fn, **kwargs):
+  frame_types, dat_len, prefix = hevc_index(fn)
+  index_data = {
+    'index': np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32),
+    'global_prefix': prefix,
+    'probe': {'streams': [{'width': W, 'height': H}]},
+  }
+  return StreamFrameReader(fn, FrameType.h265_stream, index_data, **kwargs)
+
+
+class TestFrameCache:
+  def test_byte_budget(self):
+    cache = FrameCache(3 * 100)
+    for i in range(5):
+      cache[i] = np.zeros(100, dtype=np.uint8)
+    assert len(cache) == 3
+    assert cache.nbytes == 300
+    assert 0 not in cache and 4 in cache
+
+  def test_lru_order(self):
+    cache = FrameCache(2 * 100)
+    cache[0] = np.zeros(100, dtype=np.uint8)
+    cache[1] = np.zeros(100, dtype=np.uint8)
+    assert cache.get(0) is not None
+    cache[2] = np.zeros(100, dtype=np.uint8)
+    assert 0 in cache and 1 not in cache
+
+  def test_oversized_frame(self):
+    cache = FrameCache(10)
+    cache[0] = np.zeros(100, dtype=np.uint8)
+    assert cache[0].nbytes == 100
+    with pytest.raises(KeyError):
+      cache[1]
+
+
+class TestDecoderPool:
+  @pytest.mark.parametrize("pix_fmt", ["yuv420p", "nv12", "rgb24", "yuv444p"])
+  def test_get_range(self, hevc_file, pix_fmt):
+    with frame_reader(hevc_file, decoders=1) as fr:
+      assert fr.frame_count == NUM_FRAMES
+      expected = [fr.get(i, pix_fmt=pix_fmt)[0] for i in range(NUM_FRAMES)]
+
+    with frame_reader(hevc_file, decoders=3) as fr:
+      frames = fr.get(5, NUM_FRAMES - 5, pix_fmt=pix_fmt)
+      assert len(frames) == NUM_FRAMES - 5
+      for i, frame in enumerate(frames):
+        assert np.array_equal(frame, expected[i + 5])
+
+  @pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not installed")
+  @pytest.mark.parametrize("pix_fmt", ["yuv420p", "nv12", "rgb24", "yuv444p"])
+  def test_matches_ffmpeg(self, hevc_file, pix_fmt):
+    pool = DecoderPool("hevc", 2)
+    try:
+      with frame_reader(hevc_file) as fr:
+        for num in range(0, NUM_FRAMES, GOP_SIZE):
+          _, num_frames, skip_frames, rawdat = fr.get_gop(num)
+          expected = decompress_video_data(rawdat, "hevc", W, H, pix_fmt)[skip_frames:]
+          assert len(expected) == num_frames
+
+          for frames in (AVDecoder("hevc").decode(rawdat, W, H, pix_fmt), pool.decode(rawdat, W, H, pix_fmt)):
+            frames = frames[skip_frames:]
+            assert len(frames) == num_frames
+            for a, b in zip(frames, expected, strict=True):
+              assert a.shape == b.shape
+              assert np.array_equal(a, b)
+    finally:
+      pool.close()
+
+  def test_layout(self, hevc_file):
+    with frame_reader(hevc_file, decoders=1) as fr:
+      assert fr.get(0, pix_fmt="yuv420p")[0].shape == (H * W * 3 // 2,)
+      assert fr.get(0, pix_fmt="nv12")[0].shape == (H * W * 3 // 2,)
+      assert fr.get(0, pix_fmt="rgb24")[0].shape == (H, W, 3)
+      assert fr.get(0, pix_fmt="yuv444p")[0].shape == (3, H, W)
+
+      yuv, nv12 = fr.get(30, pix_fmt="yuv420p")[0], fr.get(30, pix_fmt="nv12")[0]
+      assert np.array_equal(yuv[:H * W], nv12[:H * W])
+      assert np.array_equal(yuv[H * W:H * W * 5 // 4], nv12[H * W::2])
+
+  def test_small_cache(self, hevc_file):
+    with frame_reader(hevc_file, decoders=2) as fr:
+      expected = fr.get(0, NUM_FRAMES)
+
+    frame_size = H * W * 3 // 2
+    with frame_reader(hevc_file, decoders=2, cache_bytes=5 * frame_size) as fr:
+      frames = fr.get(0, NUM_FRAMES)
+      assert fr.frame_cache.nbytes <= 5 * frame_size
+      for a, b in zip(frames, expected, strict=True):
+        assert np.array_equal(a, b)
+
+  def test_readahead(self, hevc_file):
+    with frame_reader(hevc_file, decoders=2) as fr:
+      expected = fr.get(0, NUM_FRAMES)
+
+    with frame_reader(hevc_file, decoders=2, readahead=True) as fr:
+      for i in range(0, NUM_FRAMES, 7):
+        assert np.array_equal(fr.get(i)[0], expected[i])
+
+
+class TestSharedFrameCache:
+  @pytest.fixture(autouse=True)
+  def reset_caches(self):
+    yield
+    DownloadCache._caches = {}
+
+  def test_shared_between_readers(self, hevc_file, tmp_path, mocker):
+    with frame_reader(hevc_file, decoders=2, shared_cache=SharedFrameCache(hevc_file, str(tmp_path))) as fr:
+      expected = fr.get(0, NUM_FRAMES)
+    assert len([f for f in os.listdir(tmp_path) if f.endswith(".npy")]) == (NUM_FRAMES + GOP_SIZE - 1) // GOP_SIZE
+
+    # a new reader, e.g. in another process, reads the frames back without decoding
+    DownloadCache._caches = {}
+    with frame_reader(hevc_file, decoders=2, shared_cache=SharedFrameCache(hevc_file, str(tmp_path))) as fr:
+      decode = mocker.spy(fr.decoder_pool, "decode")
+      frames = fr.get(0, NUM_FRAMES)
+      assert decode.call_count == 0
+      for a, b in zip(frames, expected, strict=True):
+        assert isinstance(a.base, np.memmap)
+        assert not a.flags.writeable
+        assert np.array_equal(a, b)
+
+  def test_eviction(self, hevc_file, tmp_path):
+    gop_bytes = GOP_SIZE * H * W * 3 // 2
+    cache = SharedFrameCache(hevc_file, str(tmp_path), max_bytes=int(gop_bytes * 1.5))
+    with frame_reader(hevc_file, decoders=1, shared_cache=cache) as fr:
+      fr.get(0, NUM_FRAMES)
+    assert cache.get_gop(0, "yuv420p") is None
+    assert cache.get_gop(60, "yuv420p") is not None
+    assert cache.cache.total_size <= gop_bytes * 1.5
+
+  def test_file_changed(self, hevc_file, tmp_path):
+    key = SharedFrameCache(hevc_file, str(tmp_path)).key
+    os.utime(hevc_file, ns=(0, 0))
+    assert SharedFrameCache(hevc_file, str(tmp_path)).key != key
@@ -0,0 +1,79 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.log_columnar import export_time_series, has_columnar_cache, load_time_series
+from openpilot.tools.lib.log_time_series import RaggedArray, msgs_to_columns
+from openpilot.tools.lib.logreader import LogReader
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  # message indexes and columnar exports are written to a temporary cache, not the user's
+  monkeypatch.setattr("openpilot.tools.lib.logreader.DEFAULT_CACHE_DIR", str(tmp_path))
+  monkeypatch.setattr("openpilot.tools.lib.log_columnar.DEFAULT_CACHE_DIR", str(tmp_path))
+  return tmp_path
+
+
+def make_log():
+  msgs = []
+  for i in range(50):
+    msg = capnp_log.Event.new_message(logMonoTime=int(i * 1e7), valid=True)
+    if i % 2:
+      msg.init('carState').vEgo = i
+      msg.carState.gearShifter = 'drive'
+    else:
+      msg.init('can', i % 3 + 1)
+      for j, can in enumerate(msg.can):
+        can.address = i + j
+        can.dat = bytes([j])
+    msgs.append(msg)
+  return b"".join(m.to_bytes() for m in msgs)
+
+
+def assert_series_equal(a, b):
+  assert a.keys() == b.keys()
+  for typ in a:
+    assert a[typ].keys() == b[typ].keys()
+    for name in a[typ]:
+      if isinstance(a[typ][name], RaggedArray):
+        np.testing.assert_equal(list(a[typ][name]), list(b[typ][name]))
+      else:
+        np.testing.assert_equal(a[typ][name], b[typ][name])
+
+
+class TestLogColumnar:
+  def test_round_trip(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      ts = msgs_to_columns(capnp_log.Event.read_multiple_bytes(make_log()))
+      path = os.path.join(tmp, "segment.columnar")
+      assert not has_columnar_cache(path)
+      export_time_series(ts, path)
+      assert has_columnar_cache(path)
+
+      assert_series_equal(load_time_series(path), ts)
+      assert isinstance(load_time_series(path)['carState']['vEgo'], np.memmap)
+
+      ts = load_time_series(path, ['carState/vEgo'])
+      assert set(ts.keys()) == {'carState'}
+      assert set(ts['carState'].keys()) == {'t', '_valid', 'vEgo'}
+
+  def test_logreader_table(self):
+    with tempfile.NamedTemporaryFile() as rlog:
+      with open(rlog.name, "wb") as f:
+        f.write(make_log())
+
+      lr = LogReader([rlog.name, rlog.name])
+      expected = lr.time_series_fields()
+      assert len(expected['carState']['t']) == 50
+
+      table = lr.table('carState')
+      assert_series_equal({'carState': table}, {'carState': expected['carState']})
+      assert list(lr.table('can', ['address']).keys()) == ['t', '_valid', 'address']
+
+      # exported segments are now loaded from the cache
+      assert_series_equal(lr.time_series_fields(), expected)
+      # the default time series keeps the to_dict layout
+      assert 'can' not in lr.time_series and 'gearShifter' in lr.time_series['carState']
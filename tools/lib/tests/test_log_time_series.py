@@ -0,0 +1,80 @@
+import numpy as np
+
+from cereal import log as capnp_log
+from openpilot.tools.lib.log_time_series import RaggedArray, msgs_to_columns, msgs_to_time_series
+
+
+def make_msgs():
+  msgs = []
+  for i in range(20):
+    msg = capnp_log.Event.new_message(logMonoTime=int((20 - i) * 1e7), valid=True)
+    if i % 2:
+      msg.init('carState').vEgo = i
+      msg.carState.cruiseState.speed = 2 * i
+    else:
+      msg.init('can', i % 4 + 1)
+      for j, can in enumerate(msg.can):
+        can.address = i + j
+        can.dat = bytes([j])
+    msgs.append(msg.as_reader())
+  return msgs
+
+
+class TestLogTimeSeries:
+  def test_layout(self):
+    ts = msgs_to_columns(make_msgs())
+    assert set(ts.keys()) == {'carState', 'can'}
+
+    car_state = ts['carState']
+    assert np.all(np.diff(car_state['t']) > 0)
+    assert car_state['vEgo'].dtype == np.float32
+    np.testing.assert_equal(car_state['vEgo'], [19, 17, 15, 13, 11, 9, 7, 5, 3, 1])
+    np.testing.assert_equal(car_state['cruiseState/speed'], 2 * car_state['vEgo'])
+    assert np.all(car_state['_valid'])
+
+  def test_ragged_lists(self):
+    can = msgs_to_columns(make_msgs())['can']
+    assert isinstance(can['address'], RaggedArray)
+    assert len(can['address']) == len(can['t']) == 10
+    np.testing.assert_equal(can['address'].lengths(), [3, 1, 3, 1, 3, 1, 3, 1, 3, 1])
+    np.testing.assert_equal(can['address'][0], [18, 19, 20])
+    assert list(can['dat'][0]) == [b'\x00', b'\x01', b'\x02']
+
+  def test_nested_lists(self):
+    msgs = []
+    for i in range(3):
+      msg = capnp_log.Event.new_message(logMonoTime=i, valid=True)
+      lane_lines = msg.init('modelV2').init('laneLines', 2)
+      for j, lane_line in enumerate(lane_lines):
+        lane_line.x = [i, j, 1.]
+      msgs.append(msg.as_reader())
+
+    # lists inside lists of structs are kept as an array per element
+    x = msgs_to_columns(msgs)['modelV2']['laneLines/x']
+    assert x.shape == (3, 2)
+    np.testing.assert_equal(x[1, 0], [1., 0., 1.])
+    np.testing.assert_equal(x[2, 1], [2., 1., 1.])
+
+  def test_field_selection(self):
+    ts = msgs_to_columns(make_msgs(), ['carState/cruiseState/speed'])
+    assert set(ts.keys()) == {'carState'}
+    assert set(ts['carState'].keys()) == {'t', '_valid', 'cruiseState/speed'}
+
+  def test_to_dict_layout(self):
+    msgs = make_msgs()
+    for i in range(3):
+      msg = capnp_log.Event.new_message(logMonoTime=i, valid=True)
+      msg.init('modelV2').init('laneLines', 2)[1].x = [1., 2.]
+      msgs.append(msg.as_reader())
+      msg = capnp_log.Event.new_message(logMonoTime=i, valid=True)
+      msg.init('ubloxGnss')
+      msgs.append(msg.as_reader())
+
+    # lists of structs stay one entry per message, enums are strings, lists and gnss services are skipped
+    ts = msgs_to_time_series(msgs)
+    assert set(ts.keys()) == {'carState', 'modelV2'}
+    assert 'laneLines/x' not in ts['modelV2'] and ts['modelV2']['laneLines'].shape == (3, 2)
+    assert ts['modelV2']['laneLines'][0, 1]['x'] == [1., 2.]
+    assert ts['carState']['vEgo'].dtype == np.float64
+    assert ts['carState']['gearShifter'].dtype.kind == 'U'
+    np.testing.assert_equal(ts['carState']['vEgo'], msgs_to_columns(msgs)['carState']['vEgo'])
@@ -1,3 +1,4 @@
+import bz2
 import capnp
 import contextlib
 import io
@@ -6,11 +7,13 @@ import tempfile
 import os
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
 from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogIterable, LogReader, comma_api_source, parse_indirect, ReadMode, InternalUnavailableException
+from openpilot.tools.lib.logreader import LogIterable, LogReader, _LogFileReader, log_index_path, comma_api_source, parse_indirect, ReadMode, \
+                                          InternalUnavailableException, read_indexed_events
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
 
@@ -20,10 +23,26 @@ TEST_ROUTE = "344c5c15b34f2d8a/2024-01-03--09-37-12"
 QLOG_FILE = "https://commadataci.blob.core.windows.net/openpilotci/0375fdf7b1ce594d/2019-06-13--08-32-25/3/qlog.bz2"
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  # message indexes and columnar exports are written to a temporary cache, not the user's
+  monkeypatch.setattr("openpilot.tools.lib.logreader.DEFAULT_CACHE_DIR", str(tmp_path))
+  monkeypatch.setattr("openpilot.tools.lib.log_columnar.DEFAULT_CACHE_DIR", str(tmp_path))
+  return tmp_path
+
+
 def noop(segment: LogIterable):
   return segment
 
 
+def mono_times(segment: LogIterable):
+  return [m.logMonoTime for m in segment]
+
+
+def add(a, b):
+  return a + b
+
+
 @contextlib.contextmanager
 def setup_source_scenario(mocker, is_internal=False):
   internal_source_mock = mocker.patch("openpilot.tools.lib.logreader.internal_source")
@@ -254,3 +273,85 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+  @pytest.mark.parametrize("compress", [None, bz2.compress, zstd.compress])
+  def test_streaming(self, compress):
+    with tempfile.NamedTemporaryFile() as rlog:
+      mono_times = [1000 * i + (500 if i % 3 == 0 else 0) for i in range(200)]
+      dat = b"".join(capnp_log.Event.new_message(logMonoTime=t).to_bytes() for t in mono_times)
+      with open(rlog.name, "wb") as f:
+        f.write(compress(dat) if compress is not None else dat)
+
+      for sort_by_time in (False, True):
+        msgs = list(LogReader(rlog.name, sort_by_time=sort_by_time))
+        streamed = list(_LogFileReader(rlog.name, sort_by_time=sort_by_time, streaming=True, chunk_size=64, reorder_window=8))
+        assert [m.logMonoTime for m in streamed] == [m.logMonoTime for m in msgs]
+
+      msgs = list(LogReader(rlog.name, streaming=True))
+      assert [m.logMonoTime for m in msgs] == mono_times
+
+  def test_message_index(self, mocker, cache_dir):
+    with tempfile.NamedTemporaryFile(suffix=".zst") as rlog:
+      msgs = []
+      for i in range(500):
+        msg = capnp_log.Event.new_message(logMonoTime=i)
+        if i % 100 == 50:
+          msg.init("carParams").carFingerprint = str(i)
+        else:
+          msg.init("carState")
+        msgs.append(msg)
+      with open(rlog.name, "wb") as f:
+        f.write(zstd.compress(b"".join(m.to_bytes() for m in msgs)))
+
+      # the index is opt-in
+      expected = [m.carFingerprint for m in LogReader(rlog.name).filter("carParams")]
+      assert expected == ["50", "150", "250", "350", "450"]
+      assert not os.path.exists(log_index_path(rlog.name))
+
+      # built in the same pass that finds the events
+      read_mock = mocker.patch("openpilot.tools.lib.logreader.read_indexed_events", wraps=read_indexed_events)
+      lr = LogReader(rlog.name, use_index=True)
+      assert [m.carFingerprint for m in lr.filter("carParams")] == expected
+      assert os.path.exists(log_index_path(rlog.name))
+      assert log_index_path(rlog.name).startswith(str(cache_dir))
+      assert read_mock.call_count == 0
+
+      # served from the index without parsing the whole segment
+      init_mock = mocker.patch("openpilot.tools.lib.logreader._LogFileReader")
+      lr = LogReader(rlog.name, use_index=True)
+      assert lr.first("carParams").carFingerprint == "50"
+      assert [m.carFingerprint for m in lr.filter("carParams")] == expected
+      assert lr.first("gpsLocation") is None
+      assert init_mock.call_count == 0
+
+  def test_prefetch(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      fns = []
+      for seg in range(5):
+        fn = os.path.join(tmp, f"rlog{seg}.zst")
+        with open(fn, "wb") as f:
+          f.write(zstd.compress(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 100 + i).to_bytes() for i in range(100))))
+        fns.append(fn)
+
+      expected = [m.logMonoTime for m in LogReader(fns)]
+      assert expected == list(range(500))
+      for prefetch in (1, 2, 10):
+        with LogReader(fns, prefetch=prefetch) as lr:
+          assert [m.logMonoTime for m in lr] == expected
+          # second pass is served from the already parsed segments
+          assert [m.logMonoTime for m in lr] == expected
+
+  def test_run_across_segments_reducer(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      fns = []
+      for seg in range(4):
+        fn = os.path.join(tmp, f"rlog{seg}")
+        with open(fn, "wb") as f:
+          f.write(b"".join(capnp_log.Event.new_message(logMonoTime=seg * 10 + i).to_bytes() for i in range(10)))
+        fns.append(fn)
+
+      with LogReader(fns) as lr:
+        assert list(lr.imap_segments(2, mono_times)) == [list(range(seg * 10, seg * 10 + 10)) for seg in range(4)]
+        assert sorted(lr.imap_segments(2, mono_times, ordered=False)) == list(lr.imap_segments(2, mono_times))
+        assert lr.run_across_segments(2, len, reducer=add) == 40
+        assert lr.run_across_segments(2, mono_times, reducer=add, initial=[]) == list(range(40))
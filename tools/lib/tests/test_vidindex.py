@@ -0,0 +1,52 @@
+import os
+import tempfile
+import pytest
+
+from openpilot.tools.lib.synthetic_hevc import make_hevc_stream, nal_unit
+from openpilot.tools.lib.vidindex import HevcNalUnitType, VideoFileInvalid, hevc_index, hevc_index_slow
+
+
+class TestVidIndex:
+  @pytest.mark.parametrize("slices_per_frame", [1, 3])
+  def test_matches_reference(self, slices_per_frame):
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(make_hevc_stream(slices_per_frame=slices_per_frame))
+      f.flush()
+
+      frame_types, dat_len, prefix = hevc_index(f.name)
+      assert (frame_types, dat_len, prefix) == hevc_index_slow(f.name)
+      assert len(frame_types) == 60
+      assert [ft for ft, _ in frame_types[:2]] == [2, 1]
+      assert len(prefix) == 3 * 3 * (5 + 24)
+
+  @pytest.mark.parametrize("chunk_words", [1, 7, 64])
+  def test_scan_chunks(self, mocker, chunk_words):
+    mocker.patch("openpilot.tools.lib.vidindex.SCAN_CHUNK_WORDS", chunk_words)
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(make_hevc_stream(num_frames=20, slices_per_frame=3, payload_size=8))
+      f.flush()
+      assert hevc_index(f.name) == hevc_index_slow(f.name)
+
+  @pytest.mark.parametrize("corrupt", ["truncated_header", "bad_slice_type", "no_start_code"])
+  def test_corrupt(self, corrupt):
+    dat = make_hevc_stream(num_frames=10)
+    if corrupt == "truncated_header":
+      dat += b"\x00\x00\x01\x02"
+    elif corrupt == "bad_slice_type":
+      dat += nal_unit(HevcNalUnitType.TRAIL_R, bytes([0b11001001]) + b"\xff")  # slice_type = 3
+    else:
+      dat = b"\x00\xff" + dat[1:]
+
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      f.write(dat)
+      f.flush()
+
+      with pytest.raises(VideoFileInvalid):
+        hevc_index(f.name)
+      assert hevc_index(f.name, allow_corrupt=True) == hevc_index_slow(f.name, allow_corrupt=True)
+
+  def test_empty(self):
+    with tempfile.NamedTemporaryFile(suffix=".hevc") as f:
+      assert os.path.getsize(f.name) == 0
+      with pytest.raises(VideoFileInvalid):
+        hevc_index(f.name)
@@ -1,7 +1,14 @@
+import atexit
+import fcntl
+import json
 import logging
 import os
 import socket
+import threading
 import time
+from collections import OrderedDict
+from collections.abc import Collection
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import sha256
 from urllib3 import PoolManager, Retry
 from urllib3.response import BaseHTTPResponse
@@ -12,6 +19,10 @@ from openpilot.system.hardware.hw import Paths
 #  Cache chunk size
 K = 1000
 CHUNK_SIZE = 1000 * K
+# missing chunks of a single read are fetched with this many concurrent range requests
+DOWNLOAD_CONCURRENCY = int(os.environ.get("FILEREADER_CONCURRENCY", "8"))
+# least recently used chunks are evicted once the download cache grows past this size
+CACHE_SIZE_LIMIT = int(float(os.environ.get("FILEREADER_CACHE_SIZE", 20e9)))
 
 logging.getLogger("urllib3").setLevel(logging.WARNING)
 
@@ -23,12 +34,189 @@ class URLFileException(Exception):
   pass
 
 
+class DownloadCache:
+  """
+  Size bounded LRU cache of downloaded chunks in a directory. The access order and sizes are kept in memory
+  and persisted to an index file, so neither loading nor hits need to touch the files until a chunk is read.
+  Processes sharing the directory merge their changes into the index under a file lock when saving.
+  """
+  INDEX_FILE = "index.json"
+  LOCK_FILE = "index.lock"
+  SAVE_INTERVAL = 1.0
+  _caches: dict[str, 'DownloadCache'] = {}
+
+  @staticmethod
+  def instance(root: str|None = None, max_size: int = CACHE_SIZE_LIMIT) -> 'DownloadCache':
+    root = root or Paths.download_cache_root()
+    cache = DownloadCache._caches.get(root)
+    if cache is None:
+      cache = DownloadCache._caches[root] = DownloadCache(root, max_size)
+    elif cache.max_size != max_size:
+      # the last requested size applies to everyone sharing the directory
+      cache.max_size = max_size
+      cache._evict()
+    return cache
+
+  def __init__(self, root: str, max_size: int = CACHE_SIZE_LIMIT):
+    self.root = root
+    self.max_size = max_size
+    self.lock = threading.Lock()
+    self.entries: OrderedDict[str, int] = OrderedDict()  # name -> size, least recently used first
+    self.total_size = 0
+    self._touched: OrderedDict[str, int] = OrderedDict()  # entries used since the last save, merged into the index
+    self._removed: set[str] = set()
+    self._scanned = False
+    self._dirty = False
+    self._last_save = 0.0
+    self._load()
+
+  def _load(self) -> None:
+    # the index is trusted, the directory is only scanned when there is no usable index
+    os.makedirs(self.root, exist_ok=True)
+    entries = self._read_index()
+    if entries is None:
+      return
+
+    self.entries = OrderedDict(entries)
+    self.total_size = sum(self.entries.values())
+    self._scanned = True
+
+  def _read_index(self) -> list[tuple[str, int]]|None:
+    try:
+      with open(self.path(self.INDEX_FILE)) as f:
+        return [(str(name), int(size)) for name, size in json.load(f)]
+    except (FileNotFoundError, ValueError, TypeError):
+      return None
+
+  def _scan(self) -> None:
+    # files written by other processes and missing from the index are considered the oldest
+    files = [e for e in os.scandir(self.root) if e.is_file() and e.name not in (self.INDEX_FILE, self.LOCK_FILE) and not e.name.startswith("tmp")]
+    files.sort(key=lambda e: e.stat().st_mtime)
+    sizes = [(e.name, e.stat().st_size) for e in files]
+    with self.lock:
+      known = self.entries
+      self.entries = OrderedDict((name, size) for name, size in sizes if name not in known)
+      self.entries.update(known)
+      self.total_size = sum(self.entries.values())
+      self._scanned = True
+      self._dirty = True
+
+  def path(self, name: str) -> str:
+    return os.path.join(self.root, name)
+
+  def get(self, name: str) -> str|None:
+    with self.lock:
+      if name in self.entries:
+        self.entries.move_to_end(name)
+        self._touched[name] = self.entries[name]
+        self._touched.move_to_end(name)
+        self._dirty = True
+        return self.path(name)
+
+    # may have been added by another process since the index was loaded
+    path = self.path(name)
+    if os.path.exists(path):
+      self._add(name, os.path.getsize(path))
+      return path
+    return None
+
+  def discard(self, name: str) -> None:
+    with self.lock:
+      if name in self.entries:
+        self.total_size -= self.entries.pop(name)
+        self._touched.pop(name, None)
+        self._removed.add(name)
+        self._dirty = True
+
+  def put(self, name: str, data: bytes|str, evict: bool = True) -> None:
+    with atomic_write_in_dir(self.path(name), mode="wb" if isinstance(data, bytes) else "w", overwrite=True) as f:
+      f.write(data)
+    self._add(name, len(data), evict)
+
+  def _add(self, name: str, size: int, evict: bool = True) -> None:
+    with self.lock:
+      self.total_size += size - self.entries.get(name, 0)
+      self.entries[name] = size
+      self.entries.move_to_end(name)
+      self._touched[name] = size
+      self._touched.move_to_end(name)
+      self._removed.discard(name)
+      self._dirty = True
+    if evict:
+      self._evict()
+
+  def evict(self, keep: Collection[str] = ()) -> None:
+    """
+    Evicts the least recently used entries past max_size, including those added by other processes, except the names in keep.
+    Lets a single process evict for workers that put with evict=False, once the paths they handed out are no longer in use.
+    """
+    self._save()
+    self._evict(keep)
+    self._save()
+
+  def _evict(self, keep: Collection[str] = ()) -> None:
+    if not self._scanned:
+      self._scan()
+
+    evicted = []
+    with self.lock:
+      for name in list(self.entries):
+        if self.total_size <= self.max_size or len(self.entries) <= 1:
+          break
+        if name not in keep:
+          self.total_size -= self.entries.pop(name)
+          self._touched.pop(name, None)
+          self._removed.add(name)
+          evicted.append(name)
+      self._dirty = self._dirty or len(evicted) > 0
+
+    for old_name in evicted:
+      try:
+        os.remove(self.path(old_name))
+      except FileNotFoundError:
+        pass
+
+  def save(self, force: bool = False) -> None:
+    if not self._dirty or (not force and time.monotonic() - self._last_save < self.SAVE_INTERVAL):
+      return
+    self._save()
+
+  def _save(self) -> None:
+    # other processes may have changed the index since it was loaded, entries used here since the last save are the most recent
+    self._last_save = time.monotonic()
+    try:
+      with open(self.path(self.LOCK_FILE), "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        saved = self._read_index()
+        if saved is None and not self._scanned:
+          self._scan()  # the first index has to include the files already in the directory
+        with self.lock:
+          if saved is not None:
+            self.entries = OrderedDict((name, size) for name, size in saved if name not in self._removed and name not in self._touched)
+            self.entries.update(self._touched)
+            self.total_size = sum(self.entries.values())
+          entries = list(self.entries.items())
+          self._touched, self._removed = OrderedDict(), set()
+          self._dirty = False
+
+        with atomic_write_in_dir(self.path(self.INDEX_FILE), mode="w", overwrite=True) as f:
+          json.dump(entries, f)
+    except FileNotFoundError:
+      pass  # cache dir was removed
+
+  @staticmethod
+  def save_all() -> None:
+    for cache in DownloadCache._caches.values():
+      cache.save(force=True)
+
+
 class URLFile:
   _pool_manager: PoolManager|None = None
 
   @staticmethod
   def reset() -> None:
     URLFile._pool_manager = None
+    DownloadCache._caches = {}
 
   @staticmethod
   def pool_manager() -> PoolManager:
@@ -38,8 +226,9 @@ class URLFile:
       URLFile._pool_manager = PoolManager(num_pools=10, maxsize=100, socket_options=socket_options, retries=retries)
     return URLFile._pool_manager
 
-  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None):
+  def __init__(self, url: str, timeout: int=10, debug: bool=False, cache: bool|None=None, concurrency: int=DOWNLOAD_CONCURRENCY):
     self._url = url
+    self._concurrency = max(1, concurrency)
     self._timeout = Timeout(connect=timeout, read=timeout)
     self._pos = 0
     self._length: int|None = None
@@ -72,50 +261,96 @@ class URLFile:
     if self._length is not None:
       return self._length
 
-    file_length_path = os.path.join(Paths.download_cache_root(), hash_256(self._url) + "_length")
-    if not self._force_download and os.path.exists(file_length_path):
-      with open(file_length_path) as file_length:
-        content = file_length.read()
-        self._length = int(content)
-        return self._length
+    file_length_name = hash_256(self._url) + "_length"
+    file_length_path = DownloadCache.instance().get(file_length_name) if not self._force_download else None
+    if file_length_path is not None:
+      try:
+        with open(file_length_path) as file_length:
+          self._length = int(file_length.read())
+          return self._length
+      except (FileNotFoundError, ValueError):
+        DownloadCache.instance().discard(file_length_name)
 
     self._length = self.get_length_online()
     if not self._force_download and self._length != -1:
-      with atomic_write_in_dir(file_length_path, mode="w", overwrite=True) as file_length:
-        file_length.write(str(self._length))
+      DownloadCache.instance().put(file_length_name, str(self._length))
+      DownloadCache.instance().save()
     return self._length
 
+  def _chunk_name(self, chunk: int) -> str:
+    return hash_256(self._url) + "_" + str(float(chunk))
+
+  def _download_chunk(self, chunk: int) -> bytes:
+    start = chunk * CHUNK_SIZE
+    end = min(start + CHUNK_SIZE, self.get_length()) - 1
+    if start > end:
+      return b""
+    return self._fetch({'Range': f"bytes={start}-{end}"}, download_range=True)
+
   def read(self, ll: int|None=None) -> bytes:
     if self._force_download:
       return self.read_aux(ll=ll)
 
+    length = self.get_length()
     file_begin = self._pos
-    file_end = self._pos + ll if ll is not None else self.get_length()
+    file_end = self._pos + ll if ll is not None else length
     assert file_end != -1, f"Remote file is empty or doesn't exist: {self._url}"
-    #  We have to align with chunks we store. Position is the begginiing of the latest chunk that starts before or at our file
-    position = (file_begin // CHUNK_SIZE) * CHUNK_SIZE
-    response = b""
-    while True:
-      self._pos = position
-      chunk_number = self._pos / CHUNK_SIZE
-      file_name = hash_256(self._url) + "_" + str(chunk_number)
-      full_path = os.path.join(Paths.download_cache_root(), str(file_name))
-      data = None
-      #  If we don't have a file, download it
-      if not os.path.exists(full_path):
-        data = self.read_aux(ll=CHUNK_SIZE)
-        with atomic_write_in_dir(full_path, mode="wb", overwrite=True) as new_cached_file:
-          new_cached_file.write(data)
-      else:
-        with open(full_path, "rb") as cached_file:
-          data = cached_file.read()
-
-      response += data[max(0, file_begin - position): min(CHUNK_SIZE, file_end - position)]
-
-      position += CHUNK_SIZE
-      if position >= file_end:
-        self._pos = file_end
-        return response
+    if length == -1:
+      return b""
+    file_end = max(file_begin, min(file_end, length))
+
+    # chunks are copied straight into the output buffer, reading from the cache where possible
+    buf = bytearray(file_end - file_begin)
+    mv = memoryview(buf)
+    cache = DownloadCache.instance()
+    chunks = range(file_begin // CHUNK_SIZE, (file_end + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    chunk_lengths: dict[int, int] = {}
+
+    def copy_chunk(chunk: int, data) -> None:
+      chunk_begin = chunk * CHUNK_SIZE
+      chunk_lengths[chunk] = len(data)
+      lo, hi = max(file_begin, chunk_begin), min(file_end, chunk_begin + len(data))
+      if hi > lo:
+        mv[lo - file_begin:hi - file_begin] = memoryview(data)[lo - chunk_begin:hi - chunk_begin]
+
+    missing = []
+    for chunk in chunks:
+      path = cache.get(self._chunk_name(chunk))
+      try:
+        if path is not None:
+          with open(path, "rb") as cached_file:
+            copy_chunk(chunk, cached_file.read())
+          continue
+      except FileNotFoundError:
+        cache.discard(self._chunk_name(chunk))  # evicted by another process
+      missing.append(chunk)
+
+    def download(chunk: int) -> None:
+      data = self._download_chunk(chunk)
+      # only complete chunks are cached
+      if len(data) > 0 and len(data) == min(CHUNK_SIZE, length - chunk * CHUNK_SIZE):
+        cache.put(self._chunk_name(chunk), data)
+      copy_chunk(chunk, data)
+
+    if len(missing) == 1 or self._concurrency == 1:
+      for chunk in missing:
+        download(chunk)
+    elif len(missing) > 1:
+      with ThreadPoolExecutor(max_workers=min(self._concurrency, len(missing))) as executor:
+        list(executor.map(download, missing))
+
+    cache.save()
+
+    # only return what was actually read, up to the first short chunk
+    end = file_begin
+    for chunk in chunks:
+      chunk_end = chunk * CHUNK_SIZE + chunk_lengths[chunk]
+      end = max(end, min(file_end, chunk_end))
+      if chunk_end < min(file_end, (chunk + 1) * CHUNK_SIZE):
+        break
+
+    self._pos = end
+    return bytes(mv[:end - file_begin])
 
   def read_aux(self, ll: int|None=None) -> bytes:
     download_range = False
@@ -130,6 +365,11 @@ class URLFile:
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
 
+    ret = self._fetch(headers, download_range)
+    self._pos += len(ret)
+    return ret
+
+  def _fetch(self, headers: dict[str, str], download_range: bool) -> bytes:
     if self._debug:
       t1 = time.time()
 
@@ -148,8 +388,6 @@ class URLFile:
       raise URLFileException(f"Error, requested range but got unexpected response {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
     if (not download_range) and response_code != 200:  # OK
       raise URLFileException(f"Error {response_code} {headers} ({self._url}): {repr(ret)[:500]}")
-
-    self._pos += len(ret)
     return ret
 
   def seek(self, pos:int) -> None:
@@ -161,3 +399,4 @@ class URLFile:
 
 
 os.register_at_fork(after_in_child=URLFile.reset)
+atexit.register(DownloadCache.save_all)
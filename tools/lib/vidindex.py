@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 import argparse
+import contextlib
+import mmap
 import os
 import struct
 from enum import IntEnum
 
-from openpilot.tools.lib.filereader import FileReader
+import numpy as np
+
+from openpilot.tools.lib.filereader import FileReader, resolve_name
 
 DEBUG = int(os.getenv("DEBUG", "0"))
 
@@ -17,6 +21,8 @@ DEBUG = int(os.getenv("DEBUG", "0"))
 NAL_UNIT_START_CODE = b"\x00\x00\x01"
 NAL_UNIT_START_CODE_SIZE = len(NAL_UNIT_START_CODE)
 NAL_UNIT_HEADER_SIZE = 2
+# 16 bit words compared at a time when scanning for start codes
+SCAN_CHUNK_WORDS = 1 << 18
 
 class HevcNalUnitType(IntEnum):
   TRAIL_N = 0         # RBSP structure: slice_segment_layer_rbsp( )
@@ -258,7 +264,8 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
-def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+def hevc_index_slow(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  # reference implementation, walks the stream one NAL unit at a time
   with FileReader(hevc_file_name) as f:
     dat = f.read()
 
@@ -291,6 +298,114 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
 
   return frame_types, len(dat), prefix_dat
 
+def get_ue_fast(bits: int, nbits: int, pos: int) -> tuple[int, int]:
+  # same as get_ue, on the first nbits bits of the stream packed into an int, starting pos bits in
+  remaining = nbits - pos
+  v = bits & ((1 << remaining) - 1)
+  size = 2 * (remaining - v.bit_length()) + 1
+  if v == 0 or size > remaining:
+    raise VideoFileInvalid("invalid exponential-golomb code")
+  return (v >> (remaining - size)) - 1, size
+
+def get_hevc_slice_type_fast(dat, nal_unit_start: int, nal_unit_type: int) -> tuple[int, bool]:
+  # see get_hevc_slice_type, only the first 8 bytes of the slice segment header are needed in valid streams
+  rbsp_start = nal_unit_start + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE
+  header = dat[rbsp_start:rbsp_start + 8]
+  nbits = 8 * len(header)
+  if nbits == 0:
+    return get_hevc_slice_type(dat, nal_unit_start, HevcNalUnitType(nal_unit_type))
+
+  bits = int.from_bytes(header, "big")
+  is_first_slice = bits >> (nbits - 1) & 1 == 1
+  if not is_first_slice:
+    return (-1, is_first_slice)
+
+  pos = 1
+  if HevcNalUnitType.BLA_W_LP <= nal_unit_type <= HevcNalUnitType.RSV_IRAP_VCL23:
+    pos += 1
+  try:
+    _, size = get_ue_fast(bits, nbits, pos)
+    slice_type, _ = get_ue_fast(bits, nbits, pos + size)
+  except VideoFileInvalid:
+    # long codes may extend past the header bytes
+    return get_hevc_slice_type(dat, nal_unit_start, HevcNalUnitType(nal_unit_type))
+
+  if slice_type > 2:
+    raise VideoFileInvalid("slice_type must be 0, 1, or 2")
+  return slice_type, is_first_slice
+
+def find_hevc_nal_units(dat) -> tuple[np.ndarray, np.ndarray]:
+  """Returns the index of every NAL unit start code in the stream and the NAL unit types, -1 if the header is cut off"""
+  arr = np.frombuffer(dat, dtype=np.uint8)
+  # a start code at an even index has a 00 00 16 bit word at its start, at an odd index a 00 01 word after its first byte.
+  # both are rare in coded data, so they're a cheap prefilter for the byte-wise check. they only differ in one bit, so a
+  # single masked compare finds both, done in chunks so the temporary arrays stay in cache
+  words = np.frombuffer(dat, dtype='<u2', count=len(dat) // 2)
+  masked = np.empty(min(len(words), SCAN_CHUNK_WORDS), dtype=np.uint16)
+  is_candidate = np.empty(len(masked), dtype=bool)
+  word_idxs = [np.empty(0, dtype=np.intp)]
+  for chunk_start in range(0, len(words), SCAN_CHUNK_WORDS):
+    chunk = words[chunk_start:chunk_start + SCAN_CHUNK_WORDS]
+    np.bitwise_and(chunk, 0xFEFF, out=masked[:len(chunk)])
+    np.equal(masked[:len(chunk)], 0, out=is_candidate[:len(chunk)])
+    word_idxs.append(np.flatnonzero(is_candidate[:len(chunk)]) + chunk_start)
+  word_idx = np.concatenate(word_idxs)
+  candidates = 2 * word_idx - (words[word_idx] != 0)
+  candidates = candidates[(candidates >= 0) & (candidates + NAL_UNIT_START_CODE_SIZE <= len(arr))]
+  # start codes can't overlap, so every 00 00 01 in the stream starts a NAL unit
+  starts = candidates[(arr[candidates] == 0) & (arr[candidates + 1] == 0) & (arr[candidates + 2] == 1)]
+
+  types = np.full(len(starts), -1, dtype=np.int64)
+  has_header = starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE <= len(arr)
+  types[has_header] = (arr[starts[has_header] + NAL_UNIT_START_CODE_SIZE] >> 1) & 0x3F
+  return starts, types
+
+@contextlib.contextmanager
+def open_hevc_data(hevc_file_name: str):
+  # local files are memory-mapped instead of read
+  fn = resolve_name(hevc_file_name)
+  if fn.startswith(("http://", "https://")) or os.path.getsize(fn) == 0:
+    with FileReader(fn) as f:
+      yield f.read()
+    return
+
+  with open(fn, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dat:
+    yield dat
+
+def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
+  with open_hevc_data(hevc_file_name) as dat:
+    if len(dat) < NAL_UNIT_START_CODE_SIZE + 1:
+      raise VideoFileInvalid("data is too short")
+
+    if dat[0] != 0x00:
+      raise VideoFileInvalid("first byte must be 0x00")
+
+    starts, types = find_hevc_nal_units(dat)
+    ends = np.append(starts[1:], len(dat))
+    relevant = (types < 0) | np.isin(types, HEVC_PARAMETER_SET_NAL_UNITS) | np.isin(types, HEVC_CODED_SLICE_SEGMENT_NAL_UNITS)
+
+    prefix_dat = []
+    frame_types = list()
+
+    i = 1 # skip past first byte 0x00
+    try:
+      require_nal_unit_start(dat, i)
+      for i, end, nal_unit_type in zip(starts[relevant].tolist(), ends[relevant].tolist(), types[relevant].tolist(), strict=True):
+        if nal_unit_type < 0:
+          raise VideoFileInvalid("data to short to contain nal unit header")
+        elif nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
+          prefix_dat.append(dat[i:end])
+        else:
+          slice_type, is_first_slice = get_hevc_slice_type_fast(dat, i, nal_unit_type)
+          if is_first_slice:
+            frame_types.append((slice_type, i))
+    except Exception as e:
+      if not allow_corrupt:
+        raise
+      print(f"ERROR: NAL unit skipped @ {i}\n", str(e))
+
+    return frame_types, len(dat), b"".join(prefix_dat)
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument("input_file", type=str)